@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Native asyncio FTP client (control and passive data channel)
+"""
+
+import asyncio
+from ftplib import error_reply, error_temp, error_perm, error_proto, parse227, parse229
+
+__all__ = ["AsyncFTP"]
+
+CRLF = '\r\n'
+
+class AsyncFTP():
+    """
+    AsyncFTP is a class: AsyncFTP(), a minimal asyncio FTP client
+
+    Only what the downloaders need is implemented: login, simple commands,
+    SIZE/MDTM, passive binary retrieval and line based listings.
+    Replies are checked the same way as ftplib, so the usual ftplib errors
+    (error_perm, error_temp, ...) are raised.
+
+    Parameters
+    ----------
+    host, user, passwd, acct :  string
+        Same as ftplib.FTP(), an empty user means anonymous login
+    port : int, default 21
+        Control port
+    timeout : float, default 60
+        Timeout in seconds for connecting and for every network read
+    ----------
+    """
+    def __init__(self, host='', port=21, user='', passwd='', acct='', timeout=60):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.acct = acct
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.welcome = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        self.welcome = await self.getresp()
+        return self.welcome
+
+    async def login(self):
+        user = self.user or 'anonymous'
+        passwd = self.passwd
+        if user == 'anonymous' and passwd in ('', '-'):
+            passwd = 'anonymous@'
+        resp = await self.sendcmd('USER ' + user)
+        if resp[0] == '3':
+            resp = await self.sendcmd('PASS ' + passwd)
+        if resp[0] == '3':
+            resp = await self.sendcmd('ACCT ' + self.acct)
+        if resp[0] != '2':
+            raise error_reply(resp)
+        await self.voidcmd('TYPE I')
+        return resp
+
+    async def _getline(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise EOFError('Connection closed by {}'.format(self.host))
+        return line.decode('latin-1').rstrip('\r\n')
+
+    async def _getmultiline(self):
+        line = await self._getline()
+        if line[3:4] == '-':
+            code = line[:3]
+            while True:
+                nextline = await self._getline()
+                line = line + '\n' + nextline
+                if nextline[:3] == code and nextline[3:4] != '-':
+                    break
+        return line
+
+    async def getresp(self):
+        resp = await self._getmultiline()
+        c = resp[:1]
+        if c in {'1', '2', '3'}:
+            return resp
+        if c == '4':
+            raise error_temp(resp)
+        if c == '5':
+            raise error_perm(resp)
+        raise error_proto(resp)
+
+    async def sendcmd(self, cmd):
+        self.writer.write((cmd + CRLF).encode('latin-1'))
+        await self.writer.drain()
+        return await self.getresp()
+
+    async def voidcmd(self, cmd):
+        resp = await self.sendcmd(cmd)
+        if resp[0] != '2':
+            raise error_reply(resp)
+        return resp
+
+    async def size(self, filename):
+        # None if SIZE is not supported by the server
+        try:
+            resp = await self.sendcmd('SIZE ' + filename)
+        except error_perm as e:
+            if str(e)[:3] in ('500', '502'):
+                return None
+            raise
+        if resp[:3] == '213':
+            return int(resp[3:].strip())
+
+    async def mdtm(self, filename):
+        resp = await self.sendcmd('MDTM ' + filename)
+        if resp[:3] == '213':
+            return resp[3:].strip()
+
+    async def size_mdtm(self, filename):
+        # (size, mtime) in one round trip, None for what the server does not support
+        self.writer.write('SIZE {0}{1}MDTM {0}{1}'.format(filename, CRLF).encode('latin-1'))
+        await self.writer.drain()
+        values = []
+        error = None
+        for i in range(2):
+            try:
+                resp = await self.getresp()
+                values.append(resp[3:].strip() if resp[:3] == '213' else None)
+            except (error_perm, error_temp) as e:
+                values.append(None)
+                if str(e)[:3] not in ('500', '502') and error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return (int(values[0]) if values[0] is not None else None), values[1]
+
+    async def _open_data(self):
+        # passive mode, always connect back to the control host (like ftplib)
+        peer = self.writer.get_extra_info('peername')
+        if len(peer) == 2: # IPv4
+            host, port = parse227(await self.sendcmd('PASV'))
+        else:
+            host, port = parse229(await self.sendcmd('EPSV'), peer)
+        host = peer[0]
+        return await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+
+    async def transfercmd(self, cmd, rest=None):
+        # returns the (reader, writer) pair of the data connection
+        reader, writer = await self._open_data()
+        try:
+            if rest is not None:
+                await self.sendcmd('REST {}'.format(rest))
+            resp = await self.sendcmd(cmd)
+            if resp[0] != '1':
+                raise error_reply(resp)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def retrbinary(self, cmd, callback, blocksize=65536, rest=None):
+        reader, writer = await self.transfercmd(cmd, rest)
+        try:
+            while True:
+                data = await asyncio.wait_for(reader.read(blocksize), self.timeout)
+                if not data:
+                    break
+                callback(data)
+        finally:
+            writer.close()
+        return await self.getresp()
+
+    async def retrlines(self, cmd, callback=print):
+        reader, writer = await self.transfercmd(cmd)
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if not line:
+                    break
+                callback(line.decode('utf-8', 'replace').rstrip('\r\n'))
+        finally:
+            writer.close()
+        return await self.getresp()
+
+    async def quit(self):
+        try:
+            resp = await self.voidcmd('QUIT')
+        finally:
+            await self.close()
+        return resp
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, EOFError):
+                pass
+        self.reader = self.writer = None
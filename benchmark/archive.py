@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Synthetic GNSS archive trees with the layouts of quick_start.py
+"""
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from gtime import GTime, GT_list
+from url_template import iter_urls
+
+__all__ = ["LAYOUTS", "layout", "file_sizes", "build_tree"]
+
+HK_SITES = ['hkcl', 'hkks', 'hkkt', 'hklm', 'hklt', 'hkmw', 'hknp', 'hkoh', 'hkpc', 'hkqt', 'hksc', 'hksl', 'hkss', 'hkst', 'hktk', 'hkws', 'kyc1', 't430']
+COD_NAMES = ['CODGPSTWGPSTD.CLK.Z', 'CODGPSTWGPSTD.EPH.Z', 'CODGPSTWGPSTD.ERP.Z', 'P1C1YYMONTH.DCB.Z', 'P1P2YYMONTH.DCB.Z', 'CODGPSTWGPSTD.ION.Z']
+
+# name: (pattern, keys of the request dictionary besides GTIME), as in quick_start.py
+LAYOUTS = {
+    'igs': ('/pub/gps/products/GPSTW/igsGPSTWGPSTD.sp3.Z', {}), # example_1
+    'hkcors': ('/rinex2/YYYY/DDD/SSSS/5s/SSSSDDD0.YYd.gz', {'SSSS': HK_SITES}), # example_2
+    'code': ('/CODE/YYYY/FNAMES', {'FNAMES': COD_NAMES}), # example_3
+}
+
+def layout(name, days=7, begin=None):
+    # (pattern, request dictionary) of a layout over days
+    pattern, keys = LAYOUTS[name]
+    begin = begin or GTime(year=2020, doy=1)
+    dic = dict(keys)
+    dic['GTIME'] = GT_list(begin, begin + (days - 1))
+    return pattern, dic
+
+def file_sizes(count, distribution='fixed', size=300000, seed=0):
+    """
+    File sizes in bytes
+
+    distribution: 'fixed' (all size), 'lognormal' (median size) or 'mixed'
+    (mostly size, one in twenty files 50 times larger, like high-rate data)
+    """
+    rnd = random.Random(seed)
+    if distribution == 'fixed':
+        return [size] * count
+    if distribution == 'lognormal':
+        return [max(int(rnd.lognormvariate(0, 1) * size), 1) for i in range(count)]
+    if distribution == 'mixed':
+        return [size * 50 if rnd.random() < 0.05 else size for i in range(count)]
+    raise ValueError('Unknown size distribution {}'.format(distribution))
+
+def build_tree(root, name, days=7, distribution='fixed', size=300000, seed=0):
+    """
+    Write a synthetic tree of layout name under root
+
+    Return (pattern, dic, urls, total bytes); files hold pseudo random
+    (incompressible) bytes, existing files of the right size are kept.
+    """
+    pattern, dic = layout(name, days)
+    urls = sorted(set(iter_urls(pattern, dic)))
+    sizes = file_sizes(len(urls), distribution, size, seed)
+    block = random.Random(seed).randbytes(1 << 20)
+    for url, nbytes in zip(urls, sizes):
+        path = os.path.join(root, url.lstrip('/'))
+        if os.path.exists(path) and os.path.getsize(path) == nbytes:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            left = nbytes
+            while left > 0:
+                f.write(block[:min(left, len(block))])
+                left -= len(block)
+    return pattern, dic, urls, sum(sizes)
@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of downloader / HTTP_Downloader against local stand-in servers
+
+    python benchmark/bench.py                  # full matrix, results in benchmark/results/
+    python benchmark/bench.py --quick          # small matrix
+    python benchmark/bench.py --receive        # receive path only: ftplib 8 KiB blocks vs Receiver
+    python benchmark/bench.py --compare old.json new.json
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import timeit
+import shutil
+import logging
+import argparse
+import platform
+import threading
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+from servers import serve
+from archive import build_tree, layout
+from gtime import GTime, GT_list
+from ftplib import FTP
+from ftp_downloader import downloader
+from http_downloader import HTTP_Downloader
+from receive import Receiver
+import requests
+
+# (layout, days, size distribution, size)
+FILE_SETS = [
+    ('igs', 21, 'fixed', 1 << 20),
+    ('hkcors', 3, 'lognormal', 300000),
+    ('code', 7, 'mixed', 100000),
+]
+QUICK_FILE_SETS = [('hkcors', 1, 'lognormal', 300000)]
+
+# server conditions, downloaders run adaptive against a connection limit
+CONDITIONS = {
+    'lan': {},
+    'wan': {'latency': 0.02, 'bandwidth': 4e6},
+    'flaky': {'latency': 0.02, 'bandwidth': 4e6, 'fail_rate': 0.05, 'max_connections': 6},
+}
+CONCURRENCY = [1, 4, 8]
+QUICK_CONCURRENCY = [1, 4]
+RECEIVE_SIZE = 256 << 20 # bytes per session of the receive benchmarks
+RECEIVE_SESSIONS = [1, 4]
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def _download(protocol, host, port, urls, out, concurrency, adaptive):
+    # one download_by_urls into an empty out directory, return the downloader
+    shutil.rmtree(out, ignore_errors=True)
+    os.makedirs(out)
+    if protocol == 'ftp':
+        dl = downloader(host, port=port, ftp_num=concurrency, retries=5, adaptive=adaptive)
+    else:
+        dl = HTTP_Downloader(threads=concurrency, retries=5, adaptive=adaptive)
+        urls = ['http://{}:{}{}'.format(host, port, url) for url in urls]
+    with contextlib.redirect_stdout(io.StringIO()):
+        dl.download_by_urls(urls, out)
+    return dl
+
+def run_transfer(protocol, host, port, urls, out, concurrency, adaptive=False):
+    """
+    Download urls into an empty out directory, return wall time, bytes, peak memory and failures
+
+    Peak memory comes from a second, untimed run: tracemalloc slows down every allocation
+    """
+    start = time.perf_counter()
+    dl = _download(protocol, host, port, urls, out, concurrency, adaptive)
+    wall = time.perf_counter() - start
+    nbytes = sum(entry.stat().st_size for entry in os.scandir(out) if entry.is_file())
+    tracemalloc.start()
+    try:
+        _download(protocol, host, port, urls, out, concurrency, adaptive)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'wall_seconds': round(wall, 4), 'bytes': nbytes, 'throughput': round(nbytes / wall, 1),
+            'peak_memory': peak, 'failed': len(dl.failures)}
+
+def transfer_benchmarks(root, file_sets, conditions, concurrency, protocols=('ftp', 'http')):
+    results = []
+    out = os.path.join(root, 'out')
+    for name, days, distribution, size in file_sets:
+        pattern, dic, urls, total = build_tree(os.path.join(root, 'archive'), name, days, distribution, size)
+        for condition in conditions:
+            for protocol in protocols:
+                host, port, process = serve(protocol, os.path.join(root, 'archive'), **CONDITIONS[condition])
+                try:
+                    for level in concurrency:
+                        result = {'name': '{}/{}/{}/{}/c{}'.format(protocol, name, distribution, condition, level),
+                                  'protocol': protocol, 'layout': name, 'distribution': distribution,
+                                  'files': len(urls), 'total_bytes': total, 'condition': condition,
+                                  'concurrency': level}
+                        adaptive = bool(CONDITIONS[condition].get('max_connections'))
+                        result['adaptive'] = adaptive
+                        result.update(run_transfer(protocol, host, port, urls, out, level, adaptive))
+                        print('{name:40s} {wall_seconds:8.2f}s {throughput:14.0f} B/s peak {peak_memory:>10d} B '
+                              'failed {failed}'.format(**result))
+                        results.append(result)
+                finally:
+                    process.terminate()
+                    process.join()
+    return results
+
+def _receive_ftp(host, port, url, path, mode):
+    # one file over a fresh session, 'legacy' is the retrbinary + f.write path used before Receiver
+    ftp = FTP()
+    ftp.connect(host, port)
+    ftp.login()
+    ftp.voidcmd('TYPE I')
+    if mode == 'legacy':
+        with open(path, 'ab') as f:
+            ftp.retrbinary('RETR {}'.format(url), f.write)
+    else:
+        with ftp.transfercmd('RETR {}'.format(url)) as conn:
+            mode.receive(conn.recv_into, path, RECEIVE_SIZE, lambda data: None)
+        ftp.voidresp()
+    ftp.quit()
+
+def _receive_http(host, port, url, path, mode):
+    with requests.get('http://{}:{}{}'.format(host, port, url), stream=True) as response:
+        if mode == 'legacy':
+            with open(path, 'ab') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        else:
+            mode.receive(response.iter_content(chunk_size=mode.blocksize), path, RECEIVE_SIZE, lambda data: None)
+
+def receive_benchmarks(root, sessions=RECEIVE_SESSIONS, protocols=('ftp', 'http')):
+    """
+    Old and new receive paths on RECEIVE_SIZE files per session, no server limits
+
+    Return wall time, throughput and client CPU seconds per GB (the server
+    runs in its own process) per protocol / path / session count.
+    """
+    results = []
+    archive, out = os.path.join(root, 'receive'), os.path.join(root, 'out')
+    os.makedirs(archive, exist_ok=True)
+    block = os.urandom(1 << 20)
+    for i in range(max(sessions)):
+        with open(os.path.join(archive, 'big{}.dat'.format(i)), 'wb') as f:
+            for j in range(RECEIVE_SIZE >> 20):
+                f.write(block)
+    modes = [('legacy', 'legacy'), ('receiver', Receiver()), ('receiver_dontneed', Receiver(dontneed=True))]
+    for protocol in protocols:
+        host, port, process = serve(protocol, archive)
+        fetch = _receive_ftp if protocol == 'ftp' else _receive_http
+        try:
+            for level in sessions:
+                for name, mode in modes:
+                    shutil.rmtree(out, ignore_errors=True)
+                    os.makedirs(out)
+                    threads = [threading.Thread(target=fetch, args=(host, port, '/big{}.dat'.format(i),
+                                                                      os.path.join(out, 'big{}.dat'.format(i)), mode))
+                               for i in range(level)]
+                    cpu, start = time.process_time(), time.perf_counter()
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+                    wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+                    nbytes = sum(entry.stat().st_size for entry in os.scandir(out))
+                    result = {'name': 'receive/{}/{}/c{}'.format(protocol, name, level), 'wall_seconds': round(wall, 4),
+                              'bytes': nbytes, 'throughput': round(nbytes / wall, 1),
+                              'cpu_per_gb': round(cpu / nbytes * 1e9, 4), 'failed': int(nbytes != level * RECEIVE_SIZE)}
+                    print('{name:40s} {wall_seconds:8.2f}s {throughput:14.0f} B/s cpu {cpu_per_gb:7.3f}s/GB '
+                          'failed {failed}'.format(**result))
+                    results.append(result)
+        finally:
+            process.terminate()
+            process.join()
+    shutil.rmtree(archive, ignore_errors=True)
+    return results
+
+def micro_benchmarks(repeat=5):
+    # best of repeat runs, seconds per call
+    results = []
+    gt_begin, gt_end = GTime(year=2010, doy=1), GTime(year=2019, doy=365)
+    pattern, dic = layout('code', 365, GTime(year=2013, doy=1))
+    hk_pattern, hk_dic = layout('hkcors', 365, GTime(year=2018, doy=1))
+    dl = downloader()
+    cases = [
+        ('GT_list/10y', lambda: GT_list(gt_begin, gt_end), 1),
+        ('generate_urls/code/365d', lambda: dl.generate_urls(pattern, dic), 1),
+        ('generate_urls/hkcors/365d', lambda: dl.generate_urls(hk_pattern, hk_dic), 1),
+        ('iter_urls/hkcors/365d/first', lambda: next(iter(dl.iter_urls(hk_pattern, hk_dic))), 100),
+    ]
+    for name, func, number in cases:
+        best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+        print('{:40s} {:12.6f}s'.format(name, best))
+        results.append({'name': name, 'seconds': best})
+    return results
+
+def compare(old_path, new_path, threshold=0.1):
+    """
+    Print per-benchmark ratios of two result files, return the names slower by more than threshold
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    slower = []
+    for kind, key in (('transfers', 'wall_seconds'), ('receive', 'cpu_per_gb'), ('micro', 'seconds')):
+        before = {r['name']: r[key] for r in old.get(kind, [])}
+        for r in new.get(kind, []):
+            if r['name'] not in before or not before[r['name']]:
+                continue
+            ratio = r[key] / before[r['name']]
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = ' SLOWER'
+                slower.append(r['name'])
+            elif ratio < 1 - threshold:
+                flag = ' faster'
+            print('{:40s} {:10.4f} -> {:10.4f} x{:.2f}{}'.format(r['name'], before[r['name']], r[key], ratio, flag))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite with local FTP / HTTP stand-in servers')
+    parser.add_argument('--quick', action='store_true', help='small matrix')
+    parser.add_argument('--out', help='result JSON (default benchmark/results/bench_<time>.json)')
+    parser.add_argument('--root', help='work directory for archive trees (default a temporary one)')
+    parser.add_argument('--conditions', nargs='+', choices=sorted(CONDITIONS), help='server conditions')
+    parser.add_argument('--concurrency', nargs='+', type=int, help='sessions / threads levels')
+    parser.add_argument('--protocols', nargs='+', choices=['ftp', 'http'], default=['ftp', 'http'])
+    parser.add_argument('--no-transfers', action='store_true', help='micro benchmarks only')
+    parser.add_argument('--receive', action='store_true', help='receive path benchmarks only')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+
+    logging.disable(logging.WARNING) # retries are expected under failure injection
+    conditions = args.conditions or (['lan', 'wan'] if args.quick else list(CONDITIONS))
+    concurrency = args.concurrency or (QUICK_CONCURRENCY if args.quick else CONCURRENCY)
+    file_sets = QUICK_FILE_SETS if args.quick else FILE_SETS
+    results = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                        'platform': platform.platform(), 'commit': _git_commit(), 'quick': args.quick}}
+    if not args.receive:
+        results['micro'] = micro_benchmarks()
+    if not args.no_transfers:
+        root = args.root or tempfile.mkdtemp(prefix='gnss_bench_')
+        try:
+            if args.receive: # RECEIVE_SIZE bytes per session, on request only
+                results['receive'] = receive_benchmarks(root, protocols=args.protocols)
+            else:
+                results['transfers'] = transfer_benchmarks(root, file_sets, conditions, concurrency, args.protocols)
+        finally:
+            if args.root is None:
+                shutil.rmtree(root, ignore_errors=True)
+    out = args.out or os.path.join(HERE, 'results', 'bench_{}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.realpath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results: {}'.format(out))
+
+if __name__ == "__main__":
+    main()
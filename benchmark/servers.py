@@ -0,0 +1,425 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in FTP and HTTP servers (stdlib only) serving a directory tree
+
+Latency, bandwidth caps, failure injection and connection limits are
+configurable per server. serve() runs a server in its own process, so it
+does not share the GIL (or tracemalloc) with the downloader under test.
+"""
+
+import os
+import time
+import random
+import socket
+import threading
+import socketserver
+import multiprocessing
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+__all__ = ["FTPServer", "HTTPServer", "serve"]
+
+
+class _FTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        srv = self.server
+        with srv.lock:
+            srv.active += 1
+            too_many = srv.max_connections and srv.active > srv.max_connections
+        try:
+            if too_many:
+                self.reply('421 Too many users, sorry')
+                return
+            self.reply('220 local stand-in FTP ready')
+            self.cwd = '/'
+            self.rest = 0
+            self.pasv = None
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                line = line.decode('utf-8').rstrip('\r\n')
+                cmd, _, arg = line.partition(' ')
+                cmd = cmd.upper()
+                if srv.latency:
+                    time.sleep(srv.latency)
+                method = getattr(self, 'ftp_' + cmd, None)
+                if method is None:
+                    self.reply('502 Command not implemented')
+                elif method(arg) is False:
+                    return
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with srv.lock:
+                srv.active -= 1
+
+    # helpers
+    def _path(self, arg):
+        path = os.path.normpath(os.path.join(self.cwd, arg or '.')).replace(os.sep, '/')
+        return path, os.path.join(self.server.root, path.lstrip('/'))
+
+    def _data_conn(self):
+        if self.pasv is None:
+            self.reply('425 Use PASV first')
+            return None
+        self.pasv.settimeout(10)
+        try:
+            conn, _ = self.pasv.accept()
+        finally:
+            self.pasv.close()
+            self.pasv = None
+        return conn
+
+    # commands
+    def ftp_USER(self, arg):
+        self.reply('331 Password required')
+
+    def ftp_PASS(self, arg):
+        self.reply('230 Logged in')
+
+    def ftp_TYPE(self, arg):
+        self.reply('200 Type set')
+
+    def ftp_NOOP(self, arg):
+        self.reply('200 NOOP ok')
+
+    def ftp_FEAT(self, arg):
+        self.wfile.write(b'211-Features:\r\n MLSD\r\n SIZE\r\n MDTM\r\n REST STREAM\r\n')
+        self.reply('211 End')
+
+    def ftp_OPTS(self, arg):
+        self.reply('200 OK')
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "{}"'.format(self.cwd))
+
+    def ftp_CWD(self, arg):
+        path, real = self._path(arg)
+        if os.path.isdir(real):
+            self.cwd = path
+            self.reply('250 OK')
+        else:
+            self.reply('550 No such directory')
+
+    def ftp_QUIT(self, arg):
+        self.reply('221 Bye')
+        return False
+
+    def ftp_PASV(self, arg):
+        if self.pasv is not None:
+            self.pasv.close()
+        self.pasv = socket.socket()
+        self.pasv.bind((self.server.server_address[0], 0))
+        self.pasv.listen(1)
+        host, port = self.pasv.getsockname()
+        self.reply('227 Entering Passive Mode ({},{},{})'.format(host.replace('.', ','), port >> 8, port & 0xff))
+
+    def ftp_EPSV(self, arg):
+        if self.pasv is not None:
+            self.pasv.close()
+        self.pasv = socket.socket()
+        self.pasv.bind((self.server.server_address[0], 0))
+        self.pasv.listen(1)
+        self.reply('229 Entering Extended Passive Mode (|||{}|)'.format(self.pasv.getsockname()[1]))
+
+    def ftp_REST(self, arg):
+        self.rest = int(arg)
+        self.reply('350 Restarting at {}'.format(self.rest))
+
+    def ftp_ABOR(self, arg):
+        self.reply('226 Abort ok')
+
+    def ftp_SIZE(self, arg):
+        path, real = self._path(arg)
+        if os.path.isfile(real):
+            self.reply('213 {}'.format(os.path.getsize(real)))
+        else:
+            self.reply('550 No such file')
+
+    def ftp_MDTM(self, arg):
+        path, real = self._path(arg)
+        if os.path.isfile(real):
+            self.reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(real))))
+        else:
+            self.reply('550 No such file')
+
+    def _listing(self, arg, fmt):
+        path, real = self._path(arg)
+        if not os.path.isdir(real):
+            if self.pasv is not None:
+                self.pasv.close()
+                self.pasv = None
+            self.reply('550 No such directory')
+            return
+        conn = self._data_conn()
+        if conn is None:
+            return
+        self.reply('150 Here comes the listing')
+        lines = []
+        for name in sorted(os.listdir(real)):
+            st = os.stat(os.path.join(real, name))
+            lines.append(fmt(name, st))
+        conn.sendall(''.join(lines).encode('utf-8'))
+        conn.close()
+        self.reply('226 Transfer complete')
+
+    def ftp_MLSD(self, arg):
+        def fmt(name, st):
+            kind = 'dir' if os.path.isdir(os.path.join(self._path(arg)[1], name)) else 'file'
+            modify = time.strftime('%Y%m%d%H%M%S', time.gmtime(st.st_mtime))
+            return 'type={};size={};modify={}; {}\r\n'.format(kind, st.st_size, modify, name)
+        self._listing(arg, fmt)
+
+    def ftp_NLST(self, arg):
+        self._listing(arg, lambda name, st: name + '\r\n')
+
+    def ftp_RETR(self, arg):
+        srv = self.server
+        path, real = self._path(arg)
+        rest, self.rest = self.rest, 0
+        if not os.path.isfile(real):
+            if self.pasv is not None:
+                self.pasv.close()
+                self.pasv = None
+            self.reply('550 No such file')
+            return
+        if srv.fail_rate and random.random() < srv.fail_rate:
+            if self.pasv is not None:
+                self.pasv.close()
+                self.pasv = None
+            self.reply('451 Injected local error')
+            return
+        conn = self._data_conn()
+        if conn is None:
+            return
+        self.reply('150 Opening BINARY mode data connection')
+        chunk = 65536
+        try:
+            with open(real, 'rb') as f:
+                f.seek(rest)
+                start = time.time()
+                sent = 0
+                while True:
+                    data = f.read(chunk)
+                    if not data:
+                        break
+                    conn.sendall(data)
+                    sent += len(data)
+                    if srv.bandwidth:
+                        ahead = sent / srv.bandwidth - (time.time() - start)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            conn.close()
+            self.reply('226 Transfer complete')
+        except OSError:
+            conn.close()
+            self.reply('426 Connection closed; transfer aborted')
+
+
+class FTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    FTPServer is a class: FTPServer(root), a local stand-in for archive FTP servers
+
+    Parameters
+    ----------
+    root : string
+        Directory served as '/'
+    latency : float, default 0
+        Seconds slept before answering every control command
+    bandwidth : float, default 0 (unlimited)
+        Per-connection transfer cap in bytes/s
+    fail_rate : float, default 0
+        Probability that a RETR answers with a transient 451 error
+    max_connections : int, default 0 (unlimited)
+        Sessions above this limit are refused with 421
+    ----------
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, host='127.0.0.1', port=0, latency=0, bandwidth=0, fail_rate=0, max_connections=0):
+        self.root = os.path.realpath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self.max_connections = max_connections
+        self.active = 0
+        self.lock = threading.Lock()
+        super().__init__((host, port), _FTPHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        srv = self.server
+        with srv.lock:
+            srv.active += 1
+            too_many = srv.max_connections and srv.active > srv.max_connections
+        try:
+            if too_many:
+                self.raw_requestline = self.rfile.readline(65537)
+                if self.parse_request():
+                    self.close_connection = True
+                    self._empty(503)
+                return
+            super().handle()
+        finally:
+            with srv.lock:
+                srv.active -= 1
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        srv = self.server
+        if srv.latency:
+            time.sleep(srv.latency)
+        with srv.lock:
+            srv.requests += 1
+        real = os.path.join(srv.root, self.path.split('?')[0].lstrip('/'))
+        if not os.path.isfile(real):
+            return self._empty(404)
+        if srv.fail_rate and random.random() < srv.fail_rate:
+            return self._empty(503)
+        st = os.stat(real)
+        size = st.st_size
+        etag = '"{}-{}"'.format(hex(int(st.st_mtime_ns))[2:], size)
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        if self.headers.get('If-None-Match') == etag:
+            return self._empty(304, etag, last_modified)
+        since = self.headers.get('If-Modified-Since')
+        if since and self.headers.get('If-None-Match') is None:
+            try:
+                if int(st.st_mtime) <= parsedate_to_datetime(since).timestamp():
+                    return self._empty(304, etag, last_modified)
+            except (TypeError, ValueError):
+                pass
+        start, end = 0, size - 1
+        status = 200
+        rng = self.headers.get('Range')
+        if self.headers.get('If-Range') not in (None, etag, last_modified):
+            rng = None # changed since the part was started, send it whole
+        if rng and rng.startswith('bytes='):
+            a, _, b = rng[6:].partition('-')
+            start = int(a) if a else max(size - int(b), 0)
+            end = int(b) if (a and b) else size - 1
+            end = min(end, size - 1)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.end_headers()
+        if head:
+            return
+        with open(real, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            t0 = time.time()
+            sent = 0
+            while left > 0:
+                data = f.read(min(65536, left))
+                if not data:
+                    break
+                self.wfile.write(data)
+                left -= len(data)
+                sent += len(data)
+                if srv.bandwidth:
+                    ahead = sent / srv.bandwidth - (time.time() - t0)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def _empty(self, code, etag=None, last_modified=None):
+        self.send_response(code)
+        if etag:
+            self.send_header('ETag', etag)
+        if last_modified:
+            self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class HTTPServer(ThreadingHTTPServer):
+    """
+    HTTPServer is a class: HTTPServer(root), a local stand-in for archive HTTP(S) servers
+
+    Parameters
+    ----------
+    root : string
+        Directory served as '/'
+    latency : float, default 0
+        Seconds slept before answering every request
+    bandwidth : float, default 0 (unlimited)
+        Per-connection transfer cap in bytes/s
+    fail_rate : float, default 0
+        Probability that a GET answers with a transient 503
+    max_connections : int, default 0 (unlimited)
+        Connections above this limit are answered with 503
+    ----------
+    """
+    daemon_threads = True
+
+    def __init__(self, root, host='127.0.0.1', port=0, latency=0, bandwidth=0, fail_rate=0, max_connections=0):
+        self.root = os.path.realpath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self.max_connections = max_connections
+        self.active = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        super().__init__((host, port), _HTTPHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _run(kind, root, options, conn):
+    server = (FTPServer if kind == 'ftp' else HTTPServer)(root, **options)
+    conn.send(server.server_address)
+    server.serve_forever()
+
+def serve(kind, root, **options):
+    """
+    Start an 'ftp' or 'http' server on root in a child process
+
+    Return (host, port, process), stop it with process.terminate()
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run, args=(kind, root, options, child), daemon=True)
+    process.start()
+    host, port = parent.recv()
+    return host, port, process
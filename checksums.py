@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Checksum verification against the archives' per-directory MD5SUMS / SHA512SUMS files
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import posixpath
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from manifest import Manifest
+
+__all__ = ["Verifier", "ChecksumError", "parse_sums", "file_digest"]
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gnss_ftp_downloader')
+# checksum files looked up in every remote directory, strongest first
+SUM_FILES = (('SHA512SUMS', 'sha512'), ('SHA256SUMS', 'sha256'), ('MD5SUMS', 'md5'))
+BLOCK = 1 << 20
+
+class ChecksumError(IOError):
+    # received file does not match the archive's checksum (retried like an incomplete transfer)
+    pass
+
+def parse_sums(text):
+    """
+    Parse md5sum / sha512sum output ('<hex> [*]<name>') or BSD style ('MD5 (<name>) = <hex>')
+
+    Return {name: hex digest}, names without directories
+    """
+    sums = {}
+    for line in text.splitlines():
+        line = line.strip()
+        match = re.match(r'^[A-Za-z0-9-]+ \((.+)\) = ([0-9a-fA-F]+)$', line)
+        if match:
+            name, digest = match.groups()
+        else:
+            parts = line.split(None, 1)
+            if len(parts) != 2 or not re.fullmatch(r'[0-9a-fA-F]+', parts[0]):
+                continue
+            digest, name = parts[0], parts[1].lstrip('*')
+        sums[posixpath.basename(name.strip())] = digest.lower()
+    return sums
+
+def file_digest(path, algorithm, blocksize=BLOCK):
+    # hex digest of a local file
+    h = hashlib.new(algorithm)
+    with open(path, 'rb', buffering=0) as f:
+        buf = bytearray(blocksize)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+def _check(path, algorithm, digest):
+    # [pool worker] (path, True if it matches)
+    try:
+        return path, file_digest(path, algorithm) == digest
+    except OSError:
+        return path, False
+
+class Verifier():
+    """
+    Verifier is a class: Verifier(), integrity checks of downloads
+
+    The checksum file of a remote directory (SHA512SUMS, SHA256SUMS or
+    MD5SUMS, the first found) is fetched once and cached like the
+    listings. Downloads are hashed while they are received; files that
+    match are recorded with their size and mtime in a Manifest, so later
+    runs skip them without reading them again (skip-if-verified). Files in
+    directories without a checksum file are only checked for existence,
+    as before.
+
+    Parameters
+    ----------
+    cache_dir : string, default '~/.cache/gnss_ftp_downloader'
+        Directory of checksums_<host>.json (remote sums) and of
+        verified.sqlite if manifest is None, None keeps both in memory only
+    ttl : float, default 86400
+        Seconds before the checksum file of a directory is fetched again
+    workers : int, default None (number of CPUs)
+        Threads (or processes) of verify_files()
+    processes : bool, default False
+        Hash on a process pool instead of threads
+    manifest : Manifest, default None
+        Manifest recording the verified files, the downloader's own one if it has one
+    ----------
+
+    Method
+    ----------
+    expected(self, host, url, fetch)
+        (algorithm, hex digest) of a remote file, None if the archive has none
+    hasher(self, algorithm, part=None)
+        Incremental hash, primed with the bytes already in part
+    verified(self, path, algorithm, digest)
+        True if path matched digest before and has not changed since
+    verify_files(self, items)
+        Hash [(path, algorithm, digest)] on the pool, return the mismatches
+    ----------
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=86400, workers=None, processes=False, manifest=None):
+        self.cache_dir = cache_dir
+        self.manifest = manifest
+        self.ttl = ttl
+        self.workers = workers or os.cpu_count() or 1
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.hosts = {} # host: {directory: {'time', 'algorithm', 'sums'}}
+        self.dir_locks = {} # (host, directory): Lock, one fetch per directory
+        self.changed = set() # hosts with unsaved changes
+
+    def _file(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _load(self, name):
+        if self.cache_dir is not None and os.path.exists(self._file(name)):
+            try:
+                with open(self._file(name)) as f:
+                    return json.load(f)
+            except ValueError:
+                pass # broken cache file
+        return {}
+
+    def _dump(self, name, data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self._file(name), os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self._file(name))
+
+    def _host_file(self, host):
+        return 'checksums_{}.json'.format(host.replace(os.sep, '_'))
+
+    def _host(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = self._load(self._host_file(host))
+            return self.hosts[host]
+
+    def save(self):
+        # write changed caches
+        if self.manifest is not None:
+            self.manifest.commit()
+        if self.cache_dir is None:
+            return
+        with self.lock:
+            todo = [(self._host_file(h), dict(self.hosts[h])) for h in self.changed if h in self.hosts]
+            self.changed = set()
+        for name, data in todo:
+            self._dump(name, data)
+
+    def expected(self, host, url, fetch):
+        """
+        (algorithm, hex digest) of url, None if its directory has no checksum file listing it
+
+        fetch(path) returns the text of a remote file, None if it is missing.
+        """
+        directory, name = posixpath.split(url)
+        listings = self._host(host)
+        with self.lock:
+            dir_lock = self.dir_locks.setdefault((host, directory), threading.Lock())
+        with dir_lock:
+            entry = listings.get(directory)
+            if entry is None or time.time() - entry['time'] > self.ttl:
+                entry = {'time': time.time(), 'algorithm': None, 'sums': {}}
+                for sum_file, algorithm in SUM_FILES:
+                    text = fetch(posixpath.join(directory, sum_file))
+                    if text is not None:
+                        entry.update(algorithm=algorithm, sums=parse_sums(text))
+                        break
+                with self.lock:
+                    listings[directory] = entry
+                    self.changed.add(host)
+        digest = entry['sums'].get(name)
+        return (entry['algorithm'], digest) if digest else None
+
+    def hasher(self, algorithm, part=None):
+        # hash object for a transfer into part, the bytes of a resumed part file are read first
+        h = hashlib.new(algorithm)
+        if part is not None and os.path.exists(part):
+            with open(part, 'rb') as f:
+                for block in iter(lambda: f.read(BLOCK), b''):
+                    h.update(block)
+        return h
+
+    def _manifest(self):
+        with self.lock:
+            if self.manifest is None:
+                if self.cache_dir is None:
+                    self.manifest = Manifest(':memory:')
+                else:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    self.manifest = Manifest(self._file('verified.sqlite'))
+            return self.manifest
+
+    def record(self, path, algorithm, digest):
+        # path matches digest now
+        st = os.stat(path)
+        self._manifest().record_verified(os.path.realpath(path), st.st_size, st.st_mtime_ns, algorithm, digest)
+
+    def verified(self, path, algorithm, digest):
+        # matched digest before and unchanged (size, mtime) since
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return self._manifest().verified(os.path.realpath(path)) == [st.st_size, st.st_mtime_ns, algorithm, digest]
+
+    def verify_files(self, items):
+        """
+        Check [(path, algorithm, digest)] in bulk, return the paths that do not match
+
+        Files verified before (and unchanged) are not read again; the
+        others are hashed on a thread pool (hashlib releases the GIL on
+        large blocks) or a process pool.
+        """
+        todo = [item for item in items if not self.verified(*item)]
+        if not todo:
+            return []
+        digests = {path: (algorithm, digest) for path, algorithm, digest in todo}
+        executor = (ProcessPoolExecutor if self.processes else ThreadPoolExecutor)(min(self.workers, len(todo)))
+        with executor:
+            results = list(executor.map(_check, *zip(*todo), chunksize=8 if self.processes else 1))
+        bad = []
+        for path, ok in results:
+            if ok:
+                self.record(path, *digests[path])
+            else:
+                bad.append(path)
+        self.save()
+        return bad
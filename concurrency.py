@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Adaptive concurrency: tune the number of active sessions at runtime
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from ftplib import error_temp, error_perm
+
+__all__ = ["AdaptiveLimiter", "is_throttle"]
+
+THROTTLE_WORDS = ('too many', 'connection limit', 'try again later', 'maximum number')
+
+def is_throttle(e):
+    # True if exception e means the server refuses more sessions / requests
+    if isinstance(e, ConnectionRefusedError):
+        return True
+    if isinstance(e, (error_temp, error_perm)):
+        msg = str(e).lower()
+        return msg[:3] in ('421', '530') and any(w in msg for w in THROTTLE_WORDS)
+    status = getattr(getattr(e, 'response', None), 'status_code', None) # requests.HTTPError
+    return status in (429, 503)
+
+class AdaptiveLimiter():
+    """
+    AdaptiveLimiter is a class: AdaptiveLimiter(), a gate whose width follows the server
+
+    Transfers report their bytes, duration and error. Every window (about
+    `limit` transfers) the aggregate throughput is compared with the last
+    window: the limit grows by one while throughput improves, steps back
+    when it drops, and is halved at once when the server throttles
+    (421/530 "too many users", HTTP 429/503, refused connections). The
+    throttled level becomes a ceiling, raised again after ten clean windows.
+
+    Parameters
+    ----------
+    min_limit, max_limit : int, default 1, 8
+        Bounds of the number of concurrent transfers
+    initial : int, default None (min_limit)
+        Starting limit
+    ----------
+
+    Attribute
+    ----------
+    limit : int
+        Current concurrency level
+    history : list
+        (time, limit, bytes/s, mean seconds per transfer) at every window
+    ----------
+
+    """
+    def __init__(self, min_limit=1, max_limit=8, initial=None):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = min(max(initial or min_limit, min_limit), self.max_limit)
+        self.active = 0
+        self.cond = threading.Condition()
+        self.history = []
+        self.last_rate = None
+        self.direction = 1
+        self.ceiling = self.max_limit # lowered to the last throttled level
+        self.clean_windows = 0
+        self._new_window()
+
+    def _new_window(self):
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_seconds = 0
+        self.window_count = 0
+
+    def _set_limit(self, limit, rate=None, latency=None):
+        self.limit = min(max(int(limit), self.min_limit), self.ceiling)
+        self.history.append((time.time(), self.limit, rate, latency))
+        self.cond.notify_all()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, nbytes=0, seconds=0, error=None):
+        with self.cond:
+            self.active -= 1
+            if error is not None and is_throttle(error):
+                # multiplicative decrease, restart measuring
+                self.direction = 1
+                self.last_rate = None
+                self.clean_windows = 0
+                self.ceiling = max(self.limit - 1, self.min_limit)
+                self._set_limit(self.limit // 2)
+                self._new_window()
+                return
+            self.window_bytes += nbytes
+            self.window_seconds += seconds
+            self.window_count += 1
+            if self.window_count >= max(self.limit, 4):
+                self._adjust()
+            self.cond.notify()
+
+    def _adjust(self):
+        # hill climbing on the aggregate throughput of the window
+        elapsed = max(time.time() - self.window_start, 1e-6)
+        rate = self.window_bytes / elapsed
+        latency = self.window_seconds / self.window_count
+        if self.last_rate is not None:
+            if rate < self.last_rate * 0.95:
+                self.direction = -self.direction # got worse, step back
+            elif rate < self.last_rate * 1.05 and self.direction < 0:
+                self.direction = 1 # flat after a step back, probe upwards again
+        self.last_rate = rate
+        self.clean_windows += 1
+        if self.clean_windows >= 10 and self.ceiling < self.max_limit:
+            # no throttling for a while, allow probing one level higher
+            self.ceiling += 1
+            self.clean_windows = 0
+        self._set_limit(self.limit + self.direction, rate, latency)
+        self._new_window()
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold one transfer slot, the block sets stats['nbytes'] of the yielded dict
+        """
+        self.acquire()
+        stats = {'nbytes': 0}
+        start = time.time()
+        try:
+            yield stats
+        except BaseException as e:
+            self.release(stats['nbytes'], time.time() - start, e)
+            raise
+        self.release(stats['nbytes'], time.time() - start)
@@ -2,22 +2,126 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import posixpath
 import threading
 import fcntl
-from queue import Queue
-from ftplib import FTP
-from gtime import GTime, GT_list
+import asyncio
+from io import BytesIO
+from contextlib import nullcontext
+from ftplib import FTP, error_perm, error_temp
+from async_ftp import AsyncFTP
+from ftp_listing import ListingCache, has_wildcard
+from manifest import Manifest, file_md5, checksum
+from url_template import url_fields, fields_replace, iter_urls
+from ftp_pool import get_pool, is_broken
+from concurrency import AdaptiveLimiter, is_throttle
+from scheduler import RetryScheduler
+from workqueue import LeaseQueue
+from segmented import SEGMENT_SIZE, segment_file, ftp_range, fetch_segments
+from concurrent.futures import ThreadPoolExecutor
+from metrics import NULL_TRANSFER
+from checksums import Verifier, ChecksumError, file_digest
+from receive import BLOCKSIZE, Receiver, recover_part
 
 import logging
 import time
 
+QUEUE_SIZE = 10000 # max URLs waiting in the download queue
+
 # gadgets
 def url_replace(to_replace, gt):
-    to_replace = to_replace.replace("YYYY",str(gt.year)).replace("DDD",str(gt.doy).zfill(3)).replace("YY",str(gt.year)[-2:]).replace("MONTH",str(gt.month).zfill(2)[-2:])
-    to_replace = to_replace.replace("HH",str(gt.hour).zfill(2)).replace("CH",gt.H).replace("MM",str(gt.min).zfill(2))
-    to_replace = to_replace.replace("GPSTW",str(gt.gps_week).zfill(4)).replace("GPSTD",str(gt.gps_dow))
-    to_replace = to_replace.replace("GPSLW",str((gt-1).gps_week).zfill(4)).replace("GPSLD",str((gt-1).gps_dow))
-    return to_replace
+    return fields_replace(to_replace, url_fields(gt))
+
+def part_file(save):
+    # unfinished transfers are written to <name>.part
+    return save + '.part'
+
+def part_offset(part, size=None):
+    # bytes already received in part file, restart if it is longer than remote
+    recover_part(part) # stream killed while writing <part>.seg
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if size is not None and offset > size:
+        os.remove(part)
+        offset = 0
+    return offset
+
+def finish_part(part, save, size=None):
+    # check part file against remote size and move it into place
+    got = os.path.getsize(part)
+    if size is not None and got != size:
+        if got > size:
+            os.remove(part)
+        raise IOError('Incomplete transfer {}: {} of {} bytes'.format(part, got, size))
+    os.replace(part, save)
+
+def remove_empty(path):
+    # remove 0 size file
+    if os.path.exists(path) and os.path.getsize(path) == 0:
+        os.remove(path)
+
+def validator_file(part):
+    # remote validators (FTP MDTM, HTTP ETag / Last-Modified) of the file a part was started from
+    return part + '.validators'
+
+def read_validators(part):
+    # recorded validators of part, None if there is no record
+    try:
+        with open(validator_file(part)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def keep_validators(part, validators):
+    with open(validator_file(part), 'w') as f:
+        json.dump(validators, f)
+
+def drop_validators(part):
+    if os.path.exists(validator_file(part)):
+        os.remove(validator_file(part))
+
+def resume_offset(part, size, mtime):
+    """
+    Bytes of part to resume from: a part is kept only if the remote file
+    still has the size and MDTM recorded when the part was started, so a
+    product reissued in place is not spliced onto the stale bytes. Parts
+    without a record are started over. The MDTM of a new part is recorded.
+    """
+    offset = part_offset(part, size)
+    if offset and read_validators(part) != {'MDTM': mtime}:
+        os.remove(part)
+        offset = 0
+    if not offset:
+        keep_validators(part, {'MDTM': mtime})
+    return offset
+
+def discard(data):
+    # data callback of blocks already written by the Receiver
+    pass
+
+def ftp_stat(ftp, url, size=True):
+    """
+    (size, mtime) of url with TYPE I, MDTM and SIZE sent at once (one round trip)
+
+    None for what the server does not support (500 / 502), other errors
+    are raised after all replies are read.
+    """
+    cmds = ['TYPE I', 'MDTM {}'.format(url)] + (['SIZE {}'.format(url)] if size else [])
+    for cmd in cmds:
+        ftp.putcmd(cmd)
+    replies = []
+    error = None
+    for cmd in cmds:
+        try:
+            replies.append(ftp.getresp()[3:].strip())
+        except (error_perm, error_temp) as e:
+            replies.append(None)
+            if str(e)[:3] not in ('500', '502') and error is None:
+                error = e
+    if error is not None:
+        raise error
+    mtime = replies[1]
+    return (int(replies[2]) if size and replies[2] is not None else None), mtime
 
 class downloader(FTP):
     """
@@ -27,103 +131,578 @@ class downloader(FTP):
     ----------
     host, user, passwd, acct :  string
         Inherited from FTP()
+    port : int, default 21
+        FTP control port
     ftp_num : int, default 1
-        Numbers of downloading threads
+        Numbers of downloading threads (upper bound if adaptive)
     log : bool, default True
         Make a log
+    listing : ListingCache, default None
+        Cache of remote directory listings used by download(prefilter=True),
+        a ListingCache() in '~/.cache/gnss_ftp_downloader' is made if None
+    manifest : Manifest or string, default None
+        SQLite manifest (or its path) of downloaded files. If given, download()
+        only queues files that are new, changed on the server (size / mtime
+        from the cached listings) or failed before
+    adaptive : bool, default False
+        Tune the number of active sessions between min_sessions and ftp_num
+        from the measured throughput and server errors [see AdaptiveLimiter],
+        the level in use is self.concurrency
+    min_sessions : int, default 1
+        Lower bound of the adaptive number of sessions
+    retries : int, default 3
+        Retry budget per URL for transient errors [see RetryScheduler]
+    segment_size : int, default 64 MiB
+        Files larger than this are fetched as byte ranges over all ftp_num
+        sessions at once (REST + early abort), None to disable
+    pipeline : Pipeline, default None
+        Decode (.Z, .gz, Hatanaka) finished files on a process pool while
+        the transfers go on [see pipeline.Pipeline]
+    metrics : Metrics, default None
+        Record per-file phases and per-session / per-host aggregates
+        [see metrics.Metrics]
+    rate_limit : RateLimiter, default None
+        Connection caps, request and byte rates shared with other downloaders
+        and processes [see ratelimit.RateLimiter], not used by download_async()
+    weight : float, default 1
+        Share of this downloader in the rate limits of a host
+    verify : Verifier or bool, default None
+        Check downloads against the MD5SUMS / SHA512SUMS files of the remote
+        directories, hashed while they are received; mismatches are retried
+        and existing files are skipped only once verified [see
+        checksums.Verifier], True for a Verifier(), not used by download_async()
+    blocksize : int, default 1 MiB
+        Bytes per socket read / disk write / callback [see receive.Receiver]
+    direct, dontneed : bool, default False
+        Write with O_DIRECT, or drop written pages from the page cache, so
+        bulk downloads do not evict it [see receive.Receiver]
     ----------
 
     Method
     ----------
-    download(self, pattern, dic={}, out='.', overwrite=False)
+    download(self, pattern, dic={}, out='.', overwrite=False, prefilter=False)
         Download from ftp by url pattern and request dictionary
+    download_async(self, pattern, dic={}, out='.', overwrite=False, sessions=None, prefilter=False)
+        Same as download(), driven by asyncio sessions instead of threads
+    verify_files(self, pattern, dic={}, out='.', workers=None)
+        Check existing files against the archive checksums, download mismatches again
+    plan(self, pattern, dic={}, out='.', path=None, **kwargs)
+        Dry run: existence, sizes, local state and time estimate [see planner.Planner]
+    download_plan(self, plan, overwrite=False)
+        Download the entries of a plan left to do
     ----------
 
     """
-    def __init__(self, host='', user='', passwd='', acct='', ftp_num=1, log=True):
+    def __init__(self, host='', user='', passwd='', acct='', ftp_num=1, log=True, port=21, listing=None, manifest=None,
+                 adaptive=False, min_sessions=1, retries=3, segment_size=SEGMENT_SIZE,
+                 pipeline=None, metrics=None, rate_limit=None, weight=1, verify=None,
+                 blocksize=BLOCKSIZE, direct=False, dontneed=False):
 
         self.host = host
+        self.port = port
         self.user = user
         self.passwd = passwd
         self.acct = acct
         self.ftp_num = ftp_num
         self.log = True
+        self.listing = listing
+        self.manifest = Manifest(manifest) if isinstance(manifest, str) else manifest
+        self.changed = set()
+        self.limiter = AdaptiveLimiter(min_sessions, ftp_num, initial=min_sessions) if adaptive else None
+        self.retries = retries
+        self.failures = []
+        self.run_time = None
+        self.segment_size = segment_size
+        self.segments = None
+        self.pipeline = pipeline
+        self.metrics = metrics
+        self.rate_limit = rate_limit
+        self.weight = weight
+        self.rate_job = None
+        self.ready = threading.Event() # set while a run is set up (pool, metrics, rate limits)
+        self.verify = Verifier() if verify is True else verify or None
+        if self.verify is not None and self.verify.manifest is None:
+            self.verify.manifest = self.manifest # verified files kept with the downloads
+        self.verifying = False # checksums are looked up by the threads of _run() only
+        self.receiver = Receiver(blocksize, direct=direct, dontneed=dontneed)
+        self.sizes = {} # url: remote size known from a plan, no SIZE per file
+
+    @property
+    def concurrency(self):
+        # number of sessions in use
+        return self.limiter.limit if self.limiter is not None else self.ftp_num
+
+    def _slot(self):
+        # transfer slot of the adaptive limiter, set stats['nbytes'] when done
+        return self.limiter.slot() if self.limiter is not None else nullcontext({'nbytes': 0})
+
+    def _connect(self):
+        # a new logged in FTP session
+        start = time.time()
+        f = FTP()
+        f.connect(self.host, self.port)
+        f.login(self.user, self.passwd, self.acct)
+        if self.metrics is not None:
+            self.metrics.connected(self.host, time.time() - start, id(f))
+        return f
+
+    def _transfer(self, url):
+        # timings of one file, a no-op without metrics
+        return self.metrics.transfer(self.host, url) if self.metrics is not None else NULL_TRANSFER
+
+    def _connection(self):
+        # connection of the rate limiter, held while a transfer is in flight
+        return self.rate_job.connection(self.host) if self.rate_job is not None else nullcontext()
+
+    def _request(self):
+        if self.rate_job is not None:
+            self.rate_job.request(self.host)
+
+    def _throttled(self, write):
+        # charge received blocks to the byte rate of the rate limiter
+        return self.rate_job.writer(self.host, write) if self.rate_job is not None else write
+
+    def _fetch_text(self, url):
+        # small remote file (checksum list) as text, None if it does not exist
+        buf = BytesIO()
+        with self._connection(), self.pool.session() as ftp:
+            self._request()
+            try:
+                ftp.retrbinary('RETR {}'.format(url), buf.write)
+            except error_perm:
+                return None # 550
+        return buf.getvalue().decode('utf-8', 'replace')
+
+    def _expected(self, url):
+        # (algorithm, digest) of url from the archive's checksum file, None if unknown
+        if not self.verifying:
+            return None
+        return self.verify.expected(self.host, url, self._fetch_text)
+
+    def filter_urls(self, urls):
+        """
+        Drop URLs missing on the server and expand wildcards in file names,
+        using one cached MLSD/NLST listing per remote directory. Listing
+        errors are raised, unlisted directories are not taken as missing
+        """
+        if self.listing is None:
+            self.listing = ListingCache()
+        try:
+            return self.listing.filter_urls(self.host, urls, self._connect, self.ftp_num)
+        except Exception as e:
+            print('Error when listing directories on {}'.format(self.host))
+            if self.log:
+                logging.warning('Error when listing directories on {}: {}'.format(self.host, e))
+            raise
+
+    def _remote_info(self, url):
+        # (size, mtime) from the cached listing, None if unknown
+        entries = self.listing.get(self.host, posixpath.dirname(url)) if self.listing is not None else None
+        if entries and url.split('/')[-1] in entries:
+            return tuple(entries[url.split('/')[-1]])
+        return None, None
+
+    def _skip(self, url, save):
+        # skip existing file, files changed on the server are always downloaded again
+        if self.overwrite or url in self.changed:
+            return False
+        if self.pipeline is not None and self.pipeline.decoded(save):
+            return True # download was decoded and removed before
+        if not os.path.exists(save):
+            return False
+        try:
+            expected = self._expected(url)
+        except Exception:
+            return False # checksum file unreachable, _retrieve() looks it up again (with retries)
+        if expected is not None and not self.verify.verified(save, *expected):
+            # skip-if-verified, files that do not match are downloaded again
+            if file_digest(save, expected[0]) != expected[1]:
+                return False
+            self.verify.record(save, *expected)
+        if self.manifest is not None:
+            size, mtime = self._remote_info(url)
+            if size is not None and os.path.getsize(save) != size:
+                return False
+            self.manifest.record(self.host, url, size, mtime, save, 'done',
+                                 checksum(*expected) if expected is not None else file_md5(save))
+        return True
+
+    def _record(self, url, save, ok, expected=None):
+        # write transfer result to the manifest, expected: (algorithm, digest) the file was verified against
+        if self.manifest is None:
+            return
+        size, mtime = self._remote_info(url)
+        if ok:
+            size = os.path.getsize(save) if size is None else size
+            self.manifest.record(self.host, url, size, mtime, save, 'done',
+                                 checksum(*expected) if expected is not None else file_md5(save))
+        else:
+            self.manifest.record(self.host, url, size, mtime, save, 'failed')
     
+    def iter_urls(self, pattern, dic={}):
+        # lazy url generator by pattern and dic, in dictionary order [see url_template.UrlTemplate]
+        return iter_urls(pattern, dic)
+
     def generate_urls(self, pattern, dic={}):
         # make url list by pattern and dic
-        url_list = [pattern]
-        for key,values in dic.items():
-            url_tmp = []
-            zfill_length = len(key)
-            if key == 'GTIME':
-                for url in url_list:
-                    for gt in values:
-                        url_tmp.append(url_replace(url, gt))
+        return list(self.iter_urls(pattern, dic))
+
+    def _segmented(self, size, part):
+        # split large files, a started part file is resumed as one stream
+        return (self.segments is not None and size is not None and size > self.segment_size
+                and not os.path.exists(part))
+
+    def _retrieve(self, url, part, t=NULL_TRANSFER):
+        # fetch url into part file with a pooled session, return remote size
+        expected = self._expected(url)
+        digest = None
+        with self._connection(), self.pool.session() as ftp:
+            t.session = id(ftp)
+            t.mark('session')
+            if url in self.sizes:
+                size = self.sizes[url]
+                mtime = ftp_stat(ftp, url, size=False)[1]
             else:
-                for url in url_list:
-                    for v in values:
-                        url_tmp.append(url.replace(key, str(v).zfill(zfill_length)))
-            url_list = url_tmp.copy()
-        return list(set(url_list))
+                size, mtime = ftp_stat(ftp, url)
+            t.mark('control')
+            segmented = self._segmented(size, part)
+            if segmented:
+                keep_validators(part, {'MDTM': mtime})
+            else:
+                offset = resume_offset(part, size, mtime)
+                callback = discard
+                if expected is not None:
+                    # hash while receiving, a resumed part is read once first
+                    h = self.verify.hasher(expected[0], part)
+                    callback = h.update
+                if offset != size:
+                    # resume from the bytes we already have
+                    self._request()
+                    with ftp.transfercmd('RETR {}'.format(url), rest=offset or None) as conn: # TYPE I set by ftp_stat()
+                        self.receiver.receive(conn.recv_into, part, size, self._throttled(t.writer(callback)))
+                    ftp.voidresp()
+                if expected is not None:
+                    digest = h.hexdigest()
+        if segmented:
+            self._retrieve_segments(url, part, size)
+            if expected is not None:
+                digest = file_digest(part, expected[0]) # ranges arrive out of order
+        if expected is not None and (size is None or os.path.getsize(part) == size) and digest != expected[1]:
+            os.remove(part)
+            raise ChecksumError('Checksum mismatch {}: {} {} expected'.format(url, expected[0], expected[1]))
+        return size
+
+    def _retrieve_segments(self, url, part, size):
+        # fetch url as byte ranges over several pooled sessions, then move it to part
+        seg = segment_file(part)
 
-    def _download_url(self, ftp):
+        def _fetch_range(fd, start, end):
+            with self._connection(), self.pool.session() as ftp:
+                self._request()
+                received = ftp_range(ftp, url, fd, start, end, size, self.receiver.blocksize)
+            if self.rate_job is not None:
+                self.rate_job.consume(self.host, received)
+            return received
+
+        try:
+            fetch_segments(_fetch_range, seg, size, self.segment_size, self.segments, self.ftp_num)
+        except BaseException:
+            if os.path.exists(seg):
+                os.remove(seg)
+            raise
+        os.replace(seg, part)
+
+    def _download_url(self):
         # download url [call by threads]
         while True:
             url = self.queue.get()
             save = self.out + os.sep + url.split('/')[-1]
-            if (not self.overwrite) and os.path.exists(save):
+            if self._skip(url, save):
+                if self.metrics is not None:
+                    self.metrics.skipped(url)
                 self.queue.task_done()
                 continue
+            part = part_file(save)
+            t = self._transfer(url)
+            received = part_offset(part)
             try:
-                with open(save, 'wb') as f:
-                    fcntl.flock(f,fcntl.LOCK_EX | fcntl.LOCK_NB) # lock file
-                    ftp.retrbinary('RETR {}'.format(url), f.write)
-                    fcntl.flock(f,fcntl.LOCK_UN) # release lock
-                    f.close()
+                with self._slot() as stats:
+                    try:
+                        size = self._retrieve(url, part, t)
+                    except Exception as e:
+                        if not is_broken(e):
+                            raise
+                        # dropped session, resume once with a fresh one
+                        size = self._retrieve(url, part, t)
+                    stats['nbytes'] = os.path.getsize(part) - received
+                finish_part(part, save, size)
+                drop_validators(part)
+                t.done(stats['nbytes'])
+                self.changed.discard(url) # downloaded again
+                expected = self._expected(url)
+                if expected is not None:
+                    self.verify.record(save, *expected) # hashed in _retrieve()
+                self._record(url, save, True, expected)
+                if self.pipeline is not None:
+                    self.pipeline.submit(save)
                 # print('{} -> {}'.format(url, save))
-            except:
-                print('Error when downloading {} -> {}'.format(url, save))
-                if self.log:
-                    logging.warning('Error when downloading {} -> {}'.format(url, save))
-                if os.path.getsize(save) == 0:
-                    # remove 0 size file
-                    os.remove(save)
+            except Exception as e:
+                nbytes = max(part_offset(part) - received, 0)
+                remove_empty(part)
+                self.sizes.pop(url, None) # the plan may be stale, ask the server on retry
+                delay = self.queue.retry(url, e)
+                t.done(nbytes, e, delay is not None)
+                if delay is None:
+                    self.changed.discard(url)
+                    print('Error when downloading {} -> {}'.format(url, save))
+                    if self.log:
+                        logging.warning('Error when downloading {} -> {}: {}'.format(url, save, e))
+                    self._record(url, save, False)
+                else:
+                    if self.metrics is not None:
+                        self.metrics.queued(url, retry=True)
+                    if self.log:
+                        logging.info('Retry {} in {:.1f}s: {}'.format(url, delay, e))
+                if self.limiter is not None and is_throttle(e):
+                    # server limit reached, idle sessions count against it too
+                    self.pool.shrink(self.concurrency)
             self.queue.task_done()
 
-    def download_by_urls(self, urls, out='.', overwrite=False):
-        # download url list by muti-threading
+    def download_by_urls(self, urls, out='.', overwrite=False, report=None):
+        # download url list by muti-threading, failures are written to report (json) if given
         if isinstance(urls, str):
             urls = [urls] # change to list
+        # retry queue (bounded, urls may be a generator)
+        self._run(RetryScheduler(maxsize=QUEUE_SIZE, retries=self.retries), urls, out, overwrite, report)
+
+    def download_from_queue(self, work_queue, out='.', overwrite=False, report=None, batch=None):
+        """
+        Work on a shared job: download URLs leased from work_queue until the job is done
+
+        Any number of processes (on several machines with a shared file
+        system) can run this on one WorkQueue; crashed workers' URLs are
+        reclaimed when their lease expires [see workqueue.WorkQueue].
+
+        Parameters
+        ----------
+        work_queue : WorkQueue
+            Shared queue, filled by work_queue.add(self.iter_urls(pattern, dic))
+        out : string, default '.'
+            Output directory
+        overwrite : bool, default False
+            Overwrite existing file
+        report : string, default None
+            JSON file of the URLs of the job that failed for good
+        batch : int, default None (2 * ftp_num)
+            URLs claimed at once
+        ----------
+        """
+        queue = LeaseQueue(work_queue, batch=batch or 2 * self.ftp_num, retries=self.retries)
+        self._run(queue, (), out, overwrite, report)
+
+    def _run(self, queue, urls, out, overwrite, report):
+        # run download threads on queue, feeding urls into it
         self.out = os.path.realpath(out)
         self.overwrite = overwrite
-        # threads list and queue
         thread_list = []
-        ftp_list = []
-        self.queue = Queue()
-        # put urls to queue
-        for url in urls:
-            self.queue.put(url)
-        print('All URL generated')
-        # ftp login
-        for i in range(self.ftp_num):
-            f = FTP(host=self.host, user=self.user, passwd=self.passwd, acct=self.acct)
-            f.login()
-            ftp_list.append(f)
+        self.queue = queue
+        # sessions log in lazily (in parallel) and are shared per host
+        self.pool = get_pool(self.host, self.port, self.user, self._connect, self.ftp_num)
+        # ranges of large files run on their own threads, sessions are still capped by the pool
+        if self.segment_size and self.ftp_num > 1:
+            self.segments = ThreadPoolExecutor(self.ftp_num)
+        if self.pipeline is not None:
+            self.pipeline.start()
+        if self.metrics is not None:
+            self.metrics.start()
+        if self.rate_limit is not None:
+            self.rate_job = self.rate_limit.job(weight=self.weight)
+        self.verifying = self.verify is not None
+        self.ready.set()
         print('Downloading...')
         # start threads
         for i in range(self.ftp_num):
-            t_parse = threading.Thread(target=self._download_url, args=(ftp_list[i],))
+            t_parse = threading.Thread(target=self._download_url)
             thread_list.append(t_parse)
-            t_parse.setDaemon(True)
+            t_parse.daemon = True
             t_parse.start()
+        # put urls to queue while downloading
+        for url in urls:
+            if self.metrics is not None:
+                self.metrics.queued(url)
+            self.queue.put(url)
+        print('All URL generated')
         # wait until all tasks done
         self.queue.join()
+        self.ready.clear()
+        if self.segments is not None:
+            self.segments.shutdown()
+            self.segments = None
+        if self.verifying:
+            self.verifying = False
+            self.verify.save()
         # ftp bye
-        for f in ftp_list:
-            f.quit()
+        self.pool.close()
+        if self.rate_job is not None:
+            self.rate_job.close()
+            self.rate_job = None
+        if self.pipeline is not None:
+            self.pipeline.join()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.limiter is not None:
+            print('Adaptive concurrency of {}: {} sessions'.format(self.host, self.concurrency))
+            if self.log:
+                logging.info('Adaptive concurrency of {}: {} sessions'.format(self.host, self.concurrency))
+        if self.manifest is not None:
+            self.manifest.commit()
+        self._report(report)
         return
 
-    def download(self, pattern, dic={}, out='.', overwrite=False):
+    def _report(self, report):
+        # final list of urls that never succeeded
+        self.failures = self.queue.report()
+        if self.failures:
+            print('{} files failed'.format(len(self.failures)) + (', see {}'.format(report) if report else ''))
+            if report is not None:
+                self.queue.write_report(report)
+
+    async def _download_url_async(self, queue):
+        # download url [asyncio worker, one FTP session per worker]
+        ftp = None
+        while True:
+            url = await queue.get()
+            if url is None:
+                queue.task_done()
+                break
+            save = self.out + os.sep + url.split('/')[-1]
+            if self._skip(url, save):
+                if self.metrics is not None:
+                    self.metrics.skipped(url)
+                queue.task_done()
+                continue
+            part = part_file(save)
+            t = self._transfer(url)
+            received = part_offset(part)
+            try:
+                if ftp is None:
+                    # lazy login, all sessions log in concurrently
+                    start = time.time()
+                    ftp = AsyncFTP(self.host, self.port, self.user, self.passwd, self.acct)
+                    await ftp.connect()
+                    await ftp.login()
+                    if self.metrics is not None:
+                        self.metrics.connected(self.host, time.time() - start, id(ftp))
+                t.session = id(ftp)
+                t.mark('session')
+                size, mtime = await ftp.size_mdtm(url)
+                t.mark('control')
+                offset = resume_offset(part, size, mtime)
+                with open(part, 'ab') as f:
+                    fcntl.flock(f,fcntl.LOCK_EX | fcntl.LOCK_NB) # lock file
+                    if offset != size:
+                        # resume from the bytes we already have
+                        await ftp.retrbinary('RETR {}'.format(url), t.writer(f.write), self.receiver.blocksize,
+                                             rest=offset or None)
+                    fcntl.flock(f,fcntl.LOCK_UN) # release lock
+                finish_part(part, save, size)
+                drop_validators(part)
+                t.done(size - received if size is not None else os.path.getsize(save) - received)
+                self._record(url, save, True)
+                if self.pipeline is not None:
+                    await asyncio.get_running_loop().run_in_executor(None, self.pipeline.submit, save)
+            except Exception as e:
+                t.done(max(part_offset(part) - received, 0), e)
+                print('Error when downloading {} -> {}'.format(url, save))
+                if self.log:
+                    logging.warning('Error when downloading {} -> {}: {}'.format(url, save, e))
+                remove_empty(part)
+                self._record(url, save, False)
+                if ftp is not None and is_broken(e):
+                    # broken session, reconnect on next url
+                    await ftp.close()
+                    ftp = None
+            queue.task_done()
+        if ftp is not None:
+            try:
+                await ftp.quit()
+            except Exception:
+                await ftp.close()
+
+    async def download_by_urls_async(self, urls, out='.', overwrite=False, sessions=None):
+        """
+        Coroutine version of download_by_urls()
+
+        Several downloaders (e.g. different hosts) can run in one event loop:
+            await asyncio.gather(d1.download_by_urls_async(u1), d2.download_by_urls_async(u2))
+
+        Parameters
+        ----------
+        urls : string, list or iterable
+            URLs made by generate_urls() or iter_urls()
+        out : string, default '.'
+            Output directory
+        overwrite : bool, default False
+            Overwrite existing file
+        sessions : int, default None (ftp_num)
+            Number of concurrent FTP sessions
+        ----------
+        """
+        if isinstance(urls, str):
+            urls = [urls] # change to list
+        self.out = os.path.realpath(out)
+        self.overwrite = overwrite
+        sessions = sessions or self.ftp_num
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+        async def _put_urls():
+            # feed the queue while downloading, urls may be a generator
+            for url in urls:
+                if self.metrics is not None:
+                    self.metrics.queued(url)
+                await queue.put(url)
+            print('All URL generated')
+            for i in range(sessions):
+                await queue.put(None) # stop signal for each worker
+
+        print('Downloading...')
+        if self.pipeline is not None:
+            self.pipeline.start()
+        if self.metrics is not None:
+            self.metrics.start()
+        await asyncio.gather(_put_urls(), *[self._download_url_async(queue) for i in range(sessions)])
+        if self.pipeline is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.pipeline.join)
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.manifest is not None:
+            self.manifest.commit()
+        return
+
+    def _prepare_out(self, out):
+        # check output directory and logging settings
+        out_dir = os.path.realpath(out) + os.sep
+        if not os.path.exists(out_dir):
+            os.mkdir(out_dir)
+        self.run_time = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+        if self.log:
+            logging.basicConfig(level=logging.DEBUG, filename='{}{}.log'.format(out_dir, self.run_time), filemode='a',
+                                format= '%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+        return out_dir
+
+    def _make_urls(self, pattern, dic, prefilter):
+        # lazy urls, unless remote listings are needed
+        url_list = self.iter_urls(pattern, dic)
+        wildcard = has_wildcard(pattern.split('/')[-1]) or \
+            any(has_wildcard(str(v)) for key, values in dic.items() if key != 'GTIME' for v in values)
+        if prefilter or self.manifest is not None or wildcard:
+            url_list = self.filter_urls(url_list)
+        if self.manifest is not None:
+            # incremental sync: only new, changed or failed files
+            url_list, self.changed = self.manifest.diff(self.host, url_list, self._remote_info)
+        return url_list
+
+    def download(self, pattern, dic={}, out='.', overwrite=False, prefilter=False):
         """
         Download from ftp by url pattern and request dictionary
 
@@ -144,25 +723,140 @@ class downloader(FTP):
         dic : dictionary
             Replace the keys in pattern string with values
             Note that there are some keys kept for special use:
-                1. 'GTIME' : GTime list
+                1. 'GTIME' : GTime list or GTimeArray
         out : string, default '.'(current directory)
             Output directory
         overwrite: bool, default False
             Overwrite existing file
+        prefilter: bool, default False
+            List remote directories first (cached, see ListingCache) and only
+            request existing files. Always on if file names contain wildcards
+            like 'SSSS*.YYd.gz'
+        ----------
+        Transient errors are retried with backoff, files that never succeeded
+        are listed in failed_<run time>.json in the output directory
         ----------
         """
-        # check output directory
-        out_dir = os.path.realpath(out) + os.sep
-        if not os.path.exists(out_dir):
-            os.mkdir(out_dir)
-        # logging settings
-        if self.log:
-            run_time = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-            logging.basicConfig(level=logging.DEBUG, filename='{}{}.log'.format(out_dir, run_time), filemode='a',
-                                format= '%(asctime)s - %(pathname)s[line:%(lineno)d] - %(levelname)s: %(message)s')
+        # check output directory and logging settings
+        out_dir = self._prepare_out(out)
         # download
-        url_list = self.generate_urls(pattern, dic)
-        self.download_by_urls(url_list, out_dir, overwrite)
+        url_list = self._make_urls(pattern, dic, prefilter)
+        if isinstance(url_list, list) and not url_list:
+            print('Nothing to download')
+            return
+        self.download_by_urls(url_list, out_dir, overwrite, '{}failed_{}.json'.format(out_dir, self.run_time))
+
+    def verify_files(self, pattern, dic={}, out='.', workers=None):
+        """
+        Check existing files against the archive checksums, download mismatches again
+
+        Local files of pattern and dic are hashed in bulk on the pool of the
+        Verifier (files verified before and unchanged since are not read);
+        files that do not match are downloaded again.
+
+        Parameters
+        ----------
+        pattern, dic, out :
+            Same as download()
+        workers : int, default None
+            Hashing threads / processes, the Verifier's workers if None
+        ----------
+        Return the URLs whose files did not match
+        """
+        if self.verify is None:
+            self.verify = Verifier(manifest=self.manifest)
+        if workers is not None:
+            self.verify.workers = workers
+        out_dir = self._prepare_out(out)
+        self.pool = get_pool(self.host, self.port, self.user, self._connect, self.ftp_num)
+        self.verifying = True
+        try:
+            items, urls = [], {}
+            for url in self.iter_urls(pattern, dic):
+                save = out_dir + url.split('/')[-1]
+                if not os.path.exists(save):
+                    continue
+                expected = self._expected(url)
+                if expected is not None:
+                    items.append((save, ) + expected)
+                    urls[save] = url
+            bad = [urls[save] for save in self.verify.verify_files(items)]
+        finally:
+            self.verifying = False
+            self.pool.close()
+        if bad:
+            print('{} files do not match their checksums, downloading again'.format(len(bad)))
+            if self.log:
+                logging.warning('Checksum mismatch: {}'.format(', '.join(bad)))
+            self.changed = set(bad) # not skipped as existing
+            self.download_by_urls(bad, out_dir, False, '{}failed_{}.json'.format(out_dir, self.run_time))
+            self.changed = set()
+        return bad
+
+    def plan(self, pattern, dic={}, out='.', path=None, **kwargs):
+        """
+        Dry run of download(): which URLs exist, their sizes, the local state and a wall time estimate
+
+        Parameters
+        ----------
+        pattern, dic, out :
+            Same as download()
+        path : string, default None
+            Plan file (JSON) for download_plan()
+        kwargs :
+            method, probe_seconds, levels [see planner.Planner.plan()]
+        ----------
+        """
+        from planner import Planner
+        return Planner(self).plan(pattern, dic, out, path, **kwargs)
+
+    def download_plan(self, plan, overwrite=False):
+        """
+        Download the entries of a plan (file or dict) left to do
+
+        Nothing is listed again and the planned sizes replace the SIZE
+        command per file; entries that fail are asked again on retry.
+        Entries changed on the server are downloaded again.
+        """
+        from planner import load_plan, TODO_STATES
+        plan = load_plan(plan)
+        if plan['host'] != self.host:
+            print('Plan of {} used for {}'.format(plan['host'], self.host))
+        out_dir = self._prepare_out(plan['out'])
+        todo = [e for e in plan['entries'] if e['state'] in TODO_STATES or (overwrite and e['state'] == 'done')]
+        if not todo:
+            print('Nothing to download')
+            return
+        self.sizes = {e['url']: e['size'] for e in todo if e['size'] is not None}
+        self.changed = {e['url'] for e in todo if e['state'] == 'changed'}
+        try:
+            self.download_by_urls([e['url'] for e in todo], out_dir, overwrite,
+                                  '{}failed_{}.json'.format(out_dir, self.run_time))
+        finally:
+            self.sizes = {}
+            self.changed = set()
+
+    def download_async(self, pattern, dic={}, out='.', overwrite=False, sessions=None, prefilter=False):
+        """
+        Download from ftp by url pattern and request dictionary, using asyncio
+
+        One event loop drives all FTP sessions, so hundreds of concurrent
+        transfers cost a coroutine each instead of an OS thread each.
+
+        Parameters
+        ----------
+        pattern, dic, out, overwrite, prefilter :
+            Same as download()
+        sessions : int, default None (ftp_num)
+            Number of concurrent FTP sessions
+        ----------
+        """
+        out_dir = self._prepare_out(out)
+        url_list = self._make_urls(pattern, dic, prefilter)
+        if isinstance(url_list, list) and not url_list:
+            print('Nothing to download')
+            return
+        asyncio.run(self.download_by_urls_async(url_list, out_dir, overwrite, sessions))
     
 if __name__ == "__main__":
     pass
\ No newline at end of file
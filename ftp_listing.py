@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Remote directory listing cache, used to prefilter URLs before RETR
+"""
+
+import os
+import json
+import time
+import fnmatch
+import threading
+import posixpath
+from queue import Queue, Empty
+from ftplib import error_perm
+
+__all__ = ["ListingCache", "has_wildcard"]
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gnss_ftp_downloader')
+
+def has_wildcard(name):
+    return any(c in name for c in '*?[')
+
+def ftp_listdir(ftp, directory):
+    """
+    List a remote directory by MLSD (NLST as fallback)
+
+    Return {name: [size, mtime]}, size and mtime are None if unknown
+    An empty dict is returned for missing directories (550), other
+    errors are raised
+    """
+    entries = {}
+    try:
+        for name, facts in ftp.mlsd(directory, facts=['type', 'size', 'modify']):
+            if facts.get('type', 'file') != 'file':
+                continue
+            size = int(facts['size']) if 'size' in facts else None
+            entries[name] = [size, facts.get('modify')]
+        return entries
+    except error_perm as e:
+        if str(e).startswith('550'):
+            return entries # missing directory
+        if not str(e).startswith(('500', '501', '502', '504')):
+            raise
+    try:
+        for name in ftp.nlst(directory):
+            entries[posixpath.basename(name)] = [None, None]
+    except error_perm as e:
+        if not str(e).startswith('550'):
+            raise # missing directory or empty listing otherwise
+    return entries
+
+def _quit(ftp):
+    # end a session without masking the error that ended its work
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+class ListingCache():
+    """
+    ListingCache is a class: ListingCache(), persistent cache of remote directory listings
+
+    Parameters
+    ----------
+    cache_dir : string, default '~/.cache/gnss_ftp_downloader'
+        Directory holding one listing_<host>.json file per host,
+        None keeps the cache in memory only
+    ttl : float, default 3600
+        Seconds before a cached listing is considered stale
+    ----------
+
+    Method
+    ----------
+    listdir(self, host, directory, ftp)
+        Cached listing of a remote directory: {name: [size, mtime]}
+    filter_urls(self, host, urls, connect, workers=1)
+        Drop URLs missing on the server and expand shell-style wildcards
+    ----------
+
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=3600):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def _cache_file(self, host):
+        return os.path.join(self.cache_dir, 'listing_{}.json'.format(host.replace(os.sep, '_')))
+
+    def _host(self, host):
+        # load host listings from disk once
+        with self.lock:
+            if host not in self.hosts:
+                listings = {}
+                if self.cache_dir is not None and os.path.exists(self._cache_file(host)):
+                    try:
+                        with open(self._cache_file(host)) as f:
+                            listings = json.load(f)
+                    except ValueError:
+                        listings = {} # broken cache file
+                self.hosts[host] = listings
+            return self.hosts[host]
+
+    def save(self, host):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_file = self._cache_file(host)
+        with self.lock:
+            data = json.dumps(self.hosts.get(host, {}))
+        tmp = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, cache_file)
+
+    def get(self, host, directory):
+        # cached entries or None if missing / expired
+        listing = self._host(host).get(directory)
+        if listing is None or time.time() - listing['time'] > self.ttl:
+            return None
+        return listing['entries']
+
+    def put(self, host, directory, entries):
+        listings = self._host(host)
+        with self.lock:
+            listings[directory] = {'time': time.time(), 'entries': entries}
+
+    def invalidate(self, host, directory=None):
+        listings = self._host(host)
+        with self.lock:
+            if directory is None:
+                listings.clear()
+            else:
+                listings.pop(directory, None)
+
+    def listdir(self, host, directory, ftp):
+        entries = self.get(host, directory)
+        if entries is None:
+            entries = ftp_listdir(ftp, directory)
+            self.put(host, directory, entries)
+        return entries
+
+    def fetch(self, host, directories, connect, workers=1):
+        """
+        Refresh all stale listings of directories, with workers FTP sessions
+
+        connect() must return a logged in ftplib.FTP. A session that fails
+        (login refused, 4xx reply, dropped connection) hands its directory
+        back to the other sessions, so a server capping connections only
+        means fewer workers. If directories are still unlisted when all
+        sessions are done, the first error is raised: unlisted directories
+        are never taken for missing ones
+        """
+        todo = [d for d in set(directories) if self.get(host, d) is None]
+        if not todo:
+            return
+        queue = Queue()
+        for d in todo:
+            queue.put(d)
+
+        errors = []
+
+        def _list_dirs():
+            try:
+                ftp = connect()
+            except Exception as e:
+                errors.append(e)
+                return
+            try:
+                while True:
+                    try:
+                        d = queue.get_nowait()
+                    except Empty:
+                        break
+                    try:
+                        self.put(host, d, ftp_listdir(ftp, d))
+                    except Exception:
+                        queue.put(d) # left to the other sessions
+                        raise
+            except Exception as e:
+                errors.append(e)
+            finally:
+                _quit(ftp)
+
+        thread_list = [threading.Thread(target=_list_dirs) for i in range(min(workers, len(todo)))]
+        for t in thread_list:
+            t.start()
+        for t in thread_list:
+            t.join()
+        self.save(host)
+        if errors and any(self.get(host, d) is None for d in todo):
+            raise errors[0]
+
+    def filter_urls(self, host, urls, connect, workers=1):
+        """
+        Keep URLs existing on host and expand wildcards in file names
+
+        Parameters
+        ----------
+        host : string
+            FTP host
+        urls : list
+            Remote paths, file names may contain shell-style wildcards, e.g. 'SSSS*.YYd.gz'
+        connect : function
+            Return a logged in ftplib.FTP, called once per listing worker
+        workers : int, default 1
+            Number of parallel listing sessions
+        ----------
+        Raise the listing error if a directory could not be listed
+        """
+        urls = list(urls)
+        self.fetch(host, [posixpath.dirname(url) for url in urls], connect, workers)
+        kept = []
+        for url in urls:
+            directory, name = posixpath.split(url)
+            entries = self.get(host, directory) or {}
+            if has_wildcard(name):
+                kept.extend(posixpath.join(directory, n) for n in sorted(fnmatch.filter(entries, name)))
+            elif name in entries:
+                kept.append(url)
+        return list(dict.fromkeys(kept))
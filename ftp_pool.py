@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Self-healing FTP connection pool with keepalive and reconnect
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from ftplib import error_temp, error_proto, error_reply
+
+__all__ = ["FTPPool", "get_pool", "is_broken"]
+
+def is_broken(e):
+    # True if the session can not be used any more after exception e
+    if isinstance(e, error_temp):
+        return str(e)[:3] == '421' # service closing control connection
+    return isinstance(e, (EOFError, ConnectionError, TimeoutError, error_proto, error_reply))
+
+class FTPPool():
+    """
+    FTPPool is a class: FTPPool(connect, max_size), a pool of FTP sessions to one host
+
+    Sessions are created lazily by the thread that needs one (so logins run
+    in parallel), checked out per transfer, checked with NOOP when they have
+    been idle for a while and replaced transparently when broken. Idle
+    sessions are kept alive with NOOP by a background thread.
+
+    Parameters
+    ----------
+    connect : function
+        Return a new logged in ftplib.FTP
+    max_size : int, default 1
+        Max number of sessions to the host
+    check_idle : float, default 5
+        Sessions idle for longer than this are checked with NOOP on checkout
+    keepalive : float, default 60
+        Interval of NOOP keepalive for idle sessions, 0 to disable
+    ----------
+
+    Method
+    ----------
+    session(self)
+        Context manager checking out a healthy session
+    shrink(self, size)
+        Quit idle sessions above size (e.g. after the server throttled us)
+    close(self)
+        Quit all idle sessions
+    ----------
+
+    """
+    def __init__(self, connect, max_size=1, check_idle=5, keepalive=60):
+        self.connect = connect
+        self.max_size = max_size
+        self.check_idle = check_idle
+        self.keepalive = keepalive
+        self.idle = [] # [(ftp, last used time)]
+        self.size = 0 # sessions alive, idle or checked out
+        self.cond = threading.Condition()
+        self.keeper = None
+        self.closed = False
+
+    def _healthy(self, ftp):
+        try:
+            ftp.voidcmd('NOOP')
+            return True
+        except Exception:
+            self._close(ftp)
+            return False
+
+    def _close(self, ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    def get(self):
+        # check out a session, wait if max_size sessions are in use
+        with self.cond:
+            self.closed = False
+            while True:
+                if self.idle:
+                    ftp, last = self.idle.pop() # most recently used first
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    ftp, last = None, None
+                    break
+                self.cond.wait()
+        if ftp is not None and (time.time() - last < self.check_idle or self._healthy(ftp)):
+            return ftp
+        try:
+            # login outside the lock, so threads log in concurrently
+            return self.connect()
+        except BaseException:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def put(self, ftp, broken=False):
+        # check in a session, broken ones are closed and replaced on demand
+        if broken:
+            self._close(ftp)
+        with self.cond:
+            if broken:
+                self.size -= 1
+            else:
+                self.idle.append((ftp, time.time()))
+                self._start_keeper()
+            self.cond.notify()
+
+    @contextmanager
+    def session(self):
+        ftp = self.get()
+        try:
+            yield ftp
+        except BaseException as e:
+            self.put(ftp, broken=is_broken(e))
+            raise
+        self.put(ftp)
+
+    def _start_keeper(self):
+        if self.keepalive and (self.keeper is None or not self.keeper.is_alive()):
+            self.keeper = threading.Thread(target=self._keep_alive, daemon=True)
+            self.keeper.start()
+
+    def _keep_alive(self):
+        # NOOP idle sessions before the server times them out
+        while True:
+            time.sleep(self.keepalive)
+            with self.cond:
+                if self.closed:
+                    return
+                now = time.time()
+                stale = [item for item in self.idle if now - item[1] >= self.keepalive]
+                for item in stale:
+                    self.idle.remove(item)
+            for ftp, last in stale:
+                if self._healthy(ftp):
+                    self.put(ftp)
+                else:
+                    with self.cond:
+                        self.size -= 1
+                        self.cond.notify()
+
+    def shrink(self, size):
+        # quit idle sessions until at most size sessions are alive
+        with self.cond:
+            drop = []
+            while self.idle and self.size > size:
+                drop.append(self.idle.pop(0)[0]) # least recently used first
+                self.size -= 1
+        for ftp in drop:
+            try:
+                ftp.quit()
+            except Exception:
+                self._close(ftp)
+
+    def close(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.closed = True
+            self.cond.notify_all()
+        for ftp, last in idle:
+            try:
+                ftp.quit()
+            except Exception:
+                self._close(ftp)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(host, port, user, connect, max_size=1):
+    """
+    Shared pool of host, so several downloaders to one host respect one cap
+
+    max_size of an existing pool is raised if a larger one is requested
+    """
+    with _pools_lock:
+        key = (host, port, user)
+        if key not in _pools:
+            _pools[key] = FTPPool(connect, max_size)
+        pool = _pools[key]
+    with pool.cond:
+        pool.max_size = max(pool.max_size, max_size)
+        pool.cond.notify_all()
+    return pool
@@ -1,9 +1,13 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
 
-from dataclasses import dataclass, field
+import math
+import numbers
 from gtime_conv import *
 
+MJD_JD = 2400000.5
+GPS_START_MJD = 44244 # MJD of 1980-01-06
+
 def GT_list(begin_gt, end_gt):
     gtl = [begin_gt]
     while begin_gt != end_gt:
@@ -11,12 +15,40 @@ def GT_list(begin_gt, end_gt):
         gtl.append(begin_gt)
     return gtl
 
-@dataclass(order=True)
+def _parse_dict(input_dict):
+    # constructor keywords from a dict with any case of keys
+    d = {key.lower(): value for key, value in input_dict.items()}
+    if 'jd' in d:
+        return {'jd': float(d['jd'])}
+    if 'year' in d and 'doy' in d:
+        return {'year': int(d['year']), 'doy': int(d['doy'])}
+    if 'year' in d and 'month' in d and 'day' in d:
+        return {'year': int(d['year']), 'month': int(d['month']), 'day': int(d['day']),
+                'hour': int(d['hour']) if 'hour' in d else None,
+                'min': int(d['min']) if 'min' in d else None,
+                'sec': int(d['sec']) if 'sec' in d else None}
+    if 'gpsw' in d or 'gps_week' in d:
+        kwargs = {'gps_week': int(d['gpsw']) if 'gpsw' in d else int(d['gps_week'])}
+        if 'gpsd' in d or 'gps_dow' in d:
+            kwargs['gps_dow'] = int(d['gpsd']) if 'gpsd' in d else int(d['gps_dow'])
+        elif 'gpss' in d or 'gps_sow' in d:
+            kwargs['gps_sow'] = int(d['gpss']) if 'gpss' in d else int(d['gps_sow'])
+        return kwargs
+    return {}
+
+def _seconds(hour, min, sec):
+    return (int(hour) if hour is not None else 0) * 3600 + (int(min) if min is not None else 0) * 60 + \
+           (float(sec) if sec is not None else 0.0)
+
 class GTime():
     """
     GTime is a class: GTime()
     Interpretation: Represent all kinds of GPS Time.
 
+    Stored as integer MJD day plus seconds of day: day steps (gt + 1) are
+    exact and cost one integer addition, the calendar fields are computed
+    on first access and cached.
+
     Parameters
     ----------
     year :  int or string
@@ -25,11 +57,11 @@ class GTime():
         Month of year
     day : int or string
         Day of month
-    hour :  int or string, only if year, month, day are given
+    hour :  int or string, only if year, month, day (or year, doy) are given
         Hour of the day
-    min :   int or string, only if year, month, day are given
+    min :   int or string, only if year, month, day (or year, doy) are given
         Minutes of the day
-    sec : int, float or string, only if year, month, day are given
+    sec : int, float or string, only if year, month, day (or year, doy) are given
         Seconds of the day
 
     jd : float
@@ -58,102 +90,93 @@ class GTime():
         eg. GTime(gps_week=1992, gps_dow=0)
     Format 5 : GTime(gps_week, gps_sow)
         eg. GTime(gps_week=1996, gps_sow=345600)
+    Any format may also be given as a dict, eg. GTime({'year': 2018, 'doy': 100})
     ----------
 
     """
-    # init by dataclass.field
-    year:int = field(default=None, compare=False)
-    month:int = field(default=None, compare=False)
-    day:int = field(default=None, compare=False)
-    hour:int = field(default=None, compare=False)
-    min:int = field(default=None, compare=False)
-    sec:float = field(default=None, compare=False)
-    jd:float = None
-    doy:int = field(default=None, compare=False)
-    gps_week:int = field(default=None, compare=False)
-    gps_dow:int = field(default=None, compare=False)
-    gps_sow:int = field(default=None, compare=False)
-
-    def _parse_dict(self, input_dict):
-        keys = list(map(str.lower, input_dict.keys()))
-        if 'jd' in keys:
-            self.jd = float(input_dict['jd'])
-        elif 'year' in keys and 'doy' in keys:
-            self.year = int(input_dict['year'])
-            self.doy = int(input_dict['doy'])
-        elif 'year' in keys and 'month' in keys and 'day' in keys:
-            self.year = int(input_dict['year'])
-            self.month = int(input_dict['month'])
-            self.day = int(input_dict['day'])
-            self.hour = int(input_dict['hour']) if 'hour' in keys else None
-            self.min = int(input_dict['min']) if 'min' in keys else None
-            self.sec = int(input_dict['sec']) if 'sec' in keys else None
-        elif 'gpsw' in keys or 'gps_week' in keys:
-            self.gps_week = int(input_dict['gpsw']) if 'gpsw' in keys else int(input_dict['gps_week'])
-            if 'gpsd' in keys or 'gps_dow' in keys:
-                self.gps_dow = int(input_dict['gpsd']) if 'gpsd' in keys else int(input_dict['gps_dow'])
-            elif 'gpss' in keys or 'gps_sow' in keys:
-                self.gps_sow = int(input_dict['gpss']) if 'gpss' in keys else int(input_dict['gps_sow'])
-
-    def __post_init__(self):
-        # print(self.year)
-        if isinstance(self.year, dict): # when init by dict, args are in self.year
-            self._parse_dict(self.year.copy())
-
-        self.datetime = None
-        self.mjd = None
-        if self.jd is not None:
-            pass
-        elif (self.year and self.doy) is not None:
-            # self.jd = doy2jd(self.year, self.doy)
-            self.datetime = [int(self.year), 1, int(self.doy), 0, 0, 0]
-            # self._set_datetime_()
-            self.jd = ymdhms2jd(self.datetime)
-            self.datetime, self.doy = jd2ymdhms(self.jd)
-            self.datetime[3] = int(self.hour) if self.hour is not None else 0
-            self.datetime[4] = int(self.min) if self.min is not None else 0
-            self.datetime[5] = float(self.sec) if self.sec is not None else 0
-            for i in (4,3):
-                self.datetime[i] += self.datetime[i+1]//60
-                self.datetime[i+1] %= 60
-            overday = self.datetime[3]//24
-            self.datetime[3] %= 24
-            self.datetime[2] += overday
-            self.jd += self.datetime[5]/86400 + self.datetime[4]/1440 + self.datetime[3]/24 + overday
-            self._set_datetime_()
-        elif (self.year and self.month and self.day) is not None:
-            self.datetime = [int(self.year), int(self.month), int(self.day), 0, 0, 0]
-            self.datetime[3] = int(self.hour) if self.hour is not None else 0
-            self.datetime[4] = int(self.min) if self.min is not None else 0
-            self.datetime[5] = float(self.sec) if self.sec is not None else 0
-            self._set_datetime_()
-            self.jd = ymdhms2jd(self.datetime)
-        elif self.gps_week is not None:
-            self.gps_week = int(self.gps_week)
-            self.gps_dow = int(self.gps_dow) if self.gps_dow is not None else None
-            self.gps_sow = float(self.gps_sow) if self.gps_sow is not None else None
-            self.jd = gpst2jd(self.gps_week, self.gps_dow, self.gps_sow)
+    __slots__ = ('_mjd', '_sod', '_date', '_clock')
+
+    def __init__(self, year=None, month=None, day=None, hour=None, min=None, sec=None, jd=None,
+                 doy=None, gps_week=None, gps_dow=None, gps_sow=None):
+        if isinstance(year, dict): # when init by dict, args are in year
+            GTime.__init__(self, **_parse_dict(year))
+            return
+        if jd is not None:
+            mjd = float(jd) - MJD_JD
+            mjd_day = math.floor(mjd)
+            self._set(mjd_day, (mjd - mjd_day) * 86400)
+        elif year is not None and doy is not None:
+            self._set(doy2mjd(int(year), int(doy)), _seconds(hour, min, sec))
+        elif year is not None and month is not None and day is not None:
+            self._set(civil2mjd(int(year), int(month), int(day)), _seconds(hour, min, sec))
+        elif gps_week is not None:
+            if gps_sow is None:
+                if gps_dow is None:
+                    raise ValueError("Lack of parameters!")
+                gps_sow = int(gps_dow) * 86400
+            self._set(GPS_START_MJD + int(gps_week) * 7, float(gps_sow))
         else:
             raise ValueError('GTime constructor not properly called!')
-        self._set_byjd_(self.jd) # initialize by jd
-        self.H = chr(97 + self.hour) # character of hour
-
-    def _set_datetime_(self):
-        self.year, self.month, self.day, self.hour, self.min, self.sec = self.datetime
-
-    def _set_byjd_(self, jd):
-        self.mjd = jd - 2400000.5
-        if (self.datetime or self.doy) is None:
-            self.datetime, self.doy = jd2ymdhms(jd)
-            self._set_datetime_()
-        elif self.datetime is None:
-            self.datetime, tmp = jd2ymdhms(jd)
-            self._set_datetime_()
-        elif self.doy is None:
-            tmp, self.doy = jd2ymdhms(jd)
-        if (self.gps_week and self.gps_dow and self.gps_sow) is None:
-            self.gps_week, self.gps_dow, self.gps_sow = jd2gpst(jd) 
-    
+
+    def _set(self, mjd_day, sod):
+        # normalize to 0 <= sod < 86400, rounded to microseconds
+        sod = round(sod, 6)
+        if not 0 <= sod < 86400:
+            over = int(sod // 86400)
+            mjd_day += over
+            sod -= over * 86400
+        self._mjd = int(mjd_day)
+        self._sod = float(sod)
+        self._date = None
+        self._clock = None
+
+    @staticmethod
+    def _from(mjd_day, sod, clock=None):
+        # sod already normalized, skips __init__
+        gt = object.__new__(GTime)
+        gt._mjd = mjd_day
+        gt._sod = sod
+        gt._date = None
+        gt._clock = clock
+        return gt
+
+    # derived fields, computed on first access and cached
+    def _ymd(self):
+        if self._date is None:
+            self._date = mjd2civil(self._mjd) # (year, month, day, doy)
+        return self._date
+
+    def _hms(self):
+        if self._clock is None:
+            hour = int(self._sod // 3600)
+            minute = int(self._sod % 3600 // 60)
+            self._clock = (hour, minute, self._sod - hour * 3600 - minute * 60, chr(97 + hour)) # H: character of hour
+        return self._clock
+
+    year = property(lambda self: self._ymd()[0])
+    month = property(lambda self: self._ymd()[1])
+    day = property(lambda self: self._ymd()[2])
+    doy = property(lambda self: self._ymd()[3])
+    hour = property(lambda self: self._hms()[0])
+    min = property(lambda self: self._hms()[1])
+    sec = property(lambda self: self._hms()[2])
+    H = property(lambda self: self._hms()[3])
+    gps_week = property(lambda self: (self._mjd - GPS_START_MJD) // 7)
+    gps_dow = property(lambda self: (self._mjd - GPS_START_MJD) % 7)
+    gps_sow = property(lambda self: (self._mjd - GPS_START_MJD) % 7 * 86400 + self._sod)
+
+    @property
+    def datetime(self):
+        return list(self._ymd()[:3] + self._hms()[:3])
+
+    @property
+    def mjd(self):
+        return self._mjd + self._sod / 86400
+
+    @property
+    def jd(self):
+        return self.mjd + MJD_JD
+
     def __str__(self):
         pt = """
         DateTime: {}/{}/{} {}:{}:{}
@@ -164,19 +187,65 @@ class GTime():
                 self.doy, round(self.jd, 4), round(self.mjd, 4),
                 self.gps_week, self.gps_dow, round(self.gps_sow, 4))
         return pt
-    
+
+    def __repr__(self):
+        return 'GTime(year={!r}, month={!r}, day={!r}, hour={!r}, min={!r}, sec={!r}, jd={!r}, doy={!r}, ' \
+               'gps_week={!r}, gps_dow={!r}, gps_sow={!r})'.format(
+                self.year, self.month, self.day, self.hour, self.min, self.sec, self.jd, self.doy,
+                self.gps_week, self.gps_dow, self.gps_sow)
+
+    # ordering and equality by time (as jd)
+    def __eq__(self, other):
+        if not isinstance(other, GTime):
+            return NotImplemented
+        return self._mjd == other._mjd and self._sod == other._sod
+
+    def __ne__(self, other):
+        if not isinstance(other, GTime):
+            return NotImplemented
+        return self._mjd != other._mjd or self._sod != other._sod
+
+    def __lt__(self, other):
+        if not isinstance(other, GTime):
+            return NotImplemented
+        return (self._mjd, self._sod) < (other._mjd, other._sod)
+
+    def __le__(self, other):
+        if not isinstance(other, GTime):
+            return NotImplemented
+        return (self._mjd, self._sod) <= (other._mjd, other._sod)
+
+    def __gt__(self, other):
+        if not isinstance(other, GTime):
+            return NotImplemented
+        return (self._mjd, self._sod) > (other._mjd, other._sod)
+
+    def __ge__(self, other):
+        if not isinstance(other, GTime):
+            return NotImplemented
+        return (self._mjd, self._sod) >= (other._mjd, other._sod)
+
+    def __hash__(self):
+        return hash((self._mjd, self._sod))
+
     def __add__(self, other):
-        if isinstance(other, (int, float)):
-            return GTime(jd=(self.jd + other))
+        if type(other) is int or isinstance(other, numbers.Integral): # whole days: O(1), time of day unchanged
+            return GTime._from(self._mjd + int(other), self._sod, self._clock)
+        elif isinstance(other, numbers.Real):
+            gt = GTime.__new__(GTime)
+            gt._set(self._mjd, self._sod + float(other) * 86400)
+            return gt
         elif isinstance(other, GTime):
             return GTime(jd=(self.jd + other.jd))
         else:
             raise TypeError("Unsupported operand type!")
 
     def __sub__(self, other):
-        if isinstance(other, (int, float)):
-            return GTime(jd=(self.jd - other))
+        if type(other) is int:
+            return GTime._from(self._mjd - other, self._sod, self._clock)
+        elif isinstance(other, numbers.Real):
+            return self + (-other)
         elif isinstance(other, GTime):
             return GTime(jd=(self.jd - other.jd))
         else:
-            raise TypeError("Unsupported operand type!")
\ No newline at end of file
+            raise TypeError("Unsupported operand type!")
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+Vectorized GNSS time: GTimeArray and array versions of the gtime_conv functions
+"""
+
+import numpy as np
+from gtime import GTime
+
+__all__ = ["GTimeArray", "ymdhms2jd_array", "jd2ymdhms_array", "jd2gpst_array", "gpst2jd_array"]
+
+MJD_JD = 2400000.5
+MJD_UNIX = 40587 # MJD of 1970-01-01
+GPS_START_MJD = 44244 # MJD of 1980-01-06
+UNIT_SECONDS = {'day': 86400, 'hour': 3600, 'minute': 60, 'second': 1}
+
+# calendar core: days from 1970-01-01 <-> proleptic Gregorian (y, m, d)
+def _days_from_civil(year, month, day):
+    year = np.asarray(year, dtype=np.int64) - (np.asarray(month) <= 2)
+    month = np.asarray(month, dtype=np.int64)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + np.asarray(day, dtype=np.int64) - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def _civil_from_days(days):
+    z = np.asarray(days, dtype=np.int64) + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = yoe + era * 400 + (month <= 2)
+    return year, month, day
+
+def _split_jd(jd):
+    # float JD -> (integer MJD day, seconds of day), rounded to microseconds
+    mjd = np.asarray(jd, dtype=np.float64) - MJD_JD
+    day = np.floor(mjd).astype(np.int64)
+    sod = np.round((mjd - day) * 86400, 6)
+    over = sod >= 86400
+    return day + over, np.where(over, sod - 86400, sod)
+
+def ymdhms2jd_array(year, month, day, hour=0, min=0, sec=0):
+    """
+    Datetime(ymdhms) arrays to Julian date array
+    """
+    mjd = _days_from_civil(year, month, day) + MJD_UNIX
+    sod = np.asarray(hour) * 3600 + np.asarray(min) * 60 + np.asarray(sec, dtype=np.float64)
+    return mjd + sod / 86400 + MJD_JD
+
+def jd2ymdhms_array(jd):
+    """
+    Julian date array to datetime(ymdhms) arrays and day of year
+
+    Return (year, month, day, hour, min, sec, doy)
+    """
+    mjd, sod = _split_jd(jd)
+    return _ymdhms(mjd, sod)
+
+def _ymdhms(mjd, sod):
+    year, month, day = _civil_from_days(mjd - MJD_UNIX)
+    doy = mjd - MJD_UNIX - _days_from_civil(year, 1, 1) + 1
+    hour = (sod // 3600).astype(np.int64)
+    minute = ((sod - hour * 3600) // 60).astype(np.int64)
+    sec = sod - hour * 3600 - minute * 60
+    return year, month, day, hour, minute, sec, doy
+
+def jd2gpst_array(jd):
+    """
+    Julian date array to GPS time arrays (GPS week, GPS day of week, GPS seconds of week)
+    """
+    mjd, sod = _split_jd(jd)
+    return _gpst(mjd, sod)
+
+def _gpst(mjd, sod):
+    days = mjd - GPS_START_MJD
+    gps_week = days // 7
+    gps_dow = days - gps_week * 7
+    return gps_week, gps_dow, gps_dow * 86400 + sod
+
+def gpst2jd_array(gps_week, gps_dow=None, gps_sow=None):
+    """
+    GPS time arrays to Julian date array
+    """
+    if gps_sow is None:
+        if gps_dow is None:
+            raise ValueError("Lack of parameters!")
+        gps_sow = np.asarray(gps_dow) * 86400
+    gps_sow = np.asarray(gps_sow, dtype=np.float64)
+    mjd = GPS_START_MJD + np.asarray(gps_week, dtype=np.int64) * 7 + gps_sow // 86400
+    return mjd + (gps_sow % 86400) / 86400 + MJD_JD
+
+class GTimeArray():
+    """
+    GTimeArray is a class: GTimeArray(), a NumPy array of GNSS times
+
+    Times are stored as integer MJD days plus seconds of day, so ranges with
+    day / hour / minute steps do not accumulate float drift. All columns are
+    computed vectorized; iterating yields GTime objects.
+
+    Parameters
+    ----------
+    jd : array_like of float
+        Julian dates
+    mjd, sod : array_like, only if jd is not given
+        Integer MJD days and seconds of day
+    ----------
+
+    Constructors
+    ----------
+    GTimeArray(jd=[2458849.5, 2458850.5])
+    GTimeArray.from_gtimes(gtl)
+    GTimeArray.range(begin_gt, end_gt, step=1, unit='day')
+        eg. GTimeArray.range(GTime(year=2020,doy=1), GTime(year=2020,doy=2), unit='hour')
+    ----------
+
+    Columns
+    ----------
+    jd, mjd, year, month, day, hour, min, sec, doy, gps_week, gps_dow, gps_sow, H
+    ----------
+
+    """
+    def __init__(self, jd=None, mjd=None, sod=None):
+        if jd is not None:
+            self._mjd, self._sod = _split_jd(np.atleast_1d(jd))
+        elif mjd is not None:
+            self._mjd = np.atleast_1d(np.asarray(mjd, dtype=np.int64))
+            self._sod = np.zeros(self._mjd.shape) if sod is None else np.atleast_1d(np.asarray(sod, dtype=np.float64))
+        else:
+            raise ValueError('GTimeArray constructor not properly called!')
+        self._cache = {}
+
+    @classmethod
+    def from_gtimes(cls, gtl):
+        gtl = list(gtl)
+        mjd = _days_from_civil([g.year for g in gtl], [g.month for g in gtl], [g.day for g in gtl]) + MJD_UNIX
+        sod = np.array([g.hour * 3600 + g.min * 60 + g.sec for g in gtl], dtype=np.float64)
+        return cls(mjd=mjd, sod=sod)
+
+    @classmethod
+    def range(cls, begin_gt, end_gt, step=1, unit='day'):
+        # all times from begin_gt to end_gt (included), every step units
+        begin = cls.from_gtimes([begin_gt])
+        end = cls.from_gtimes([end_gt])
+        step_sec = step * UNIT_SECONDS[unit]
+        span = (end._mjd[0] - begin._mjd[0]) * 86400 + (end._sod[0] - begin._sod[0])
+        offsets = np.arange(int(span // step_sec) + 1, dtype=np.int64) * step_sec + begin._sod[0]
+        return cls(mjd=begin._mjd[0] + offsets // 86400, sod=offsets % 86400)
+
+    def _column(self, name):
+        if not self._cache:
+            year, month, day, hour, minute, sec, doy = _ymdhms(self._mjd, self._sod)
+            gps_week, gps_dow, gps_sow = _gpst(self._mjd, self._sod)
+            self._cache.update(year=year, month=month, day=day, hour=hour, min=minute, sec=sec, doy=doy,
+                               gps_week=gps_week, gps_dow=gps_dow, gps_sow=gps_sow)
+        return self._cache[name]
+
+    year = property(lambda self: self._column('year'))
+    month = property(lambda self: self._column('month'))
+    day = property(lambda self: self._column('day'))
+    hour = property(lambda self: self._column('hour'))
+    min = property(lambda self: self._column('min'))
+    sec = property(lambda self: self._column('sec'))
+    doy = property(lambda self: self._column('doy'))
+    gps_week = property(lambda self: self._column('gps_week'))
+    gps_dow = property(lambda self: self._column('gps_dow'))
+    gps_sow = property(lambda self: self._column('gps_sow'))
+
+    @property
+    def mjd(self):
+        return self._mjd + self._sod / 86400
+
+    @property
+    def jd(self):
+        return self.mjd + MJD_JD
+
+    @property
+    def H(self):
+        # character of hour
+        return (self.hour + 97).astype(np.uint8).view('S1').astype(str)
+
+    def url_fields(self):
+        """
+        Strings of every pattern key [see url_replace()] for each time, computed vectorized
+        """
+        year = self.year.astype(str)
+        last_week, last_dow, _ = _gpst(self._mjd - 1, self._sod)
+        columns = {
+            'YYYY': year,
+            'DDD': np.char.zfill(self.doy.astype(str), 3),
+            'YY': np.array([y[-2:] for y in year]),
+            'MONTH': np.char.zfill(self.month.astype(str), 2),
+            'HH': np.char.zfill(self.hour.astype(str), 2),
+            'CH': self.H,
+            'MM': np.char.zfill(self.min.astype(str), 2),
+            'GPSTW': np.char.zfill(self.gps_week.astype(str), 4),
+            'GPSTD': self.gps_dow.astype(str),
+            'GPSLW': np.char.zfill(last_week.astype(str), 4),
+            'GPSLD': last_dow.astype(str),
+        }
+        keys = list(columns)
+        return [dict(zip(keys, row)) for row in zip(*[columns[k].tolist() for k in keys])]
+
+    def __len__(self):
+        return len(self._mjd)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            index = range(len(self))[index] # bounds check and negative index
+            year, month, day, hour, minute, sec, doy = _ymdhms(self._mjd[index:index + 1], self._sod[index:index + 1])
+            return GTime(year=int(year[0]), month=int(month[0]), day=int(day[0]),
+                         hour=int(hour[0]), min=int(minute[0]), sec=float(sec[0]))
+        return GTimeArray(mjd=self._mjd[index], sod=self._sod[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_gtimes(self):
+        return list(self)
+
+    def __repr__(self):
+        return 'GTimeArray(n={}, jd=[{}, {}])'.format(len(self), *(self.jd[[0, -1]] if len(self) else ('', '')))
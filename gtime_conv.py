@@ -4,7 +4,16 @@
 Time convert functions
 """
 
-__all__ = ["ymdhms2jd","doy2jd","jd2ymdhms","jd2gpst","gpst2jd"]
+import functools
+
+__all__ = ["ymdhms2jd","doy2jd","jd2ymdhms","jd2gpst","gpst2jd",
+           "civil2mjd","doy2mjd","mjd2civil","civil2mjd_list","mjd2civil_list"]
+
+# days before each month (index 1..12, 13 = days of the year), common and leap years
+DAYS_TO_MONTH = ((0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365),
+                 (0, 0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335, 366))
+MJD_0001 = -678575 # MJD of 0001-01-01 (proleptic Gregorian)
+CACHE_SIZE = 1 << 14 # dates kept by mjd2civil, about 45 years of days
 
 def ymdhms2jd(datetime):
     """
@@ -17,8 +26,6 @@ def ymdhms2jd(datetime):
     # leap_year
     years_from_1600 = year - 1600    
     leap_days =  (years_from_1600 - 1)//4 - (years_from_1600 + 99)//100 + (years_from_1600 + 399)//400 + 1
-    if years_from_1600 == 0:
-        leap_days -= 1
 
     leap_year = False
     if years_from_1600 % 4 == 0 and (years_from_1600 % 100 != 0 or years_from_1600 % 400 == 0):
@@ -65,8 +72,6 @@ def jd2ymdhms(jd):
     while day_of_year <= 0:
         century = years_from_1600//100
         day_of_year = days_from_1600 - years_from_1600*365 - (years_from_1600 - 1)//4 + (years_from_1600 + 99)//100 - (years_from_1600 + 399)//400 - 1
-        if years_from_1600 == 0:
-            day_of_year += 1
         if day_of_year <=0:
             years_from_1600 -= 1
     real_doy = day_of_year # real day of year
@@ -134,4 +139,57 @@ def gpst2jd(gps_week, gps_dow=None, gps_sow=None):
     fraction  = (gps_sow % 86400) / 86400
     mjd = gps_start_mjd + gps_sow // 86400 + gps_week * 7 + 1
     jd = mjd + 2400000.5 + fraction
-    return jd
\ No newline at end of file
+    return jd
+
+# loop-free core on integer MJD days (proleptic Gregorian calendar)
+def _is_leap(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+def civil2mjd(year, month, day):
+    """
+    (year, month, day) to integer MJD, day may run past the month
+    """
+    y = year - 1
+    return MJD_0001 + y*365 + y//4 - y//100 + y//400 + DAYS_TO_MONTH[_is_leap(year)][month] + day - 1
+
+def doy2mjd(year, doy):
+    """
+    (year, day of year) to integer MJD
+    """
+    y = year - 1
+    return MJD_0001 + y*365 + y//4 - y//100 + y//400 + doy - 1
+
+def _mjd2civil(mjd):
+    # closed form in 400-year eras starting March 1st (H. Hinnant, chrono-compatible algorithms)
+    z = mjd + 678881 # days from 0000-03-01
+    era = z // 146097
+    doe = z - era*146097
+    yoe = (doe - doe//1460 + doe//36524 - doe//146096) // 365
+    doy_mar = doe - (365*yoe + yoe//4 - yoe//100)
+    mp = (5*doy_mar + 2) // 153
+    day = doy_mar - (153*mp + 2)//5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    year = yoe + era*400 + (month <= 2)
+    return year, month, day, DAYS_TO_MONTH[_is_leap(year)][month] + day
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def mjd2civil(mjd):
+    """
+    Integer MJD to (year, month, day, day of year), memoized
+    """
+    return _mjd2civil(mjd)
+
+def civil2mjd_list(years, months, days):
+    """
+    Sequences of (year, month, day) to a list of integer MJD
+    """
+    return [civil2mjd(y, m, d) for y, m, d in zip(years, months, days)]
+
+def mjd2civil_list(mjds, cache=True):
+    """
+    Sequence of integer MJD to a list of (year, month, day, day of year)
+
+    cache=False skips the memo (one pass over many distinct days).
+    """
+    func = mjd2civil if cache else _mjd2civil
+    return [func(int(mjd)) for mjd in mjds]
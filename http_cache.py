@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+HTTP validator cache: ETag / Last-Modified per URL for conditional requests
+"""
+
+import os
+import json
+import threading
+
+__all__ = ["ValidatorCache", "NOT_MODIFIED"]
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gnss_ftp_downloader')
+NOT_MODIFIED = 'not modified' # HTTP_Downloader._retrieve() result of a 304
+
+class ValidatorCache():
+    """
+    ValidatorCache is a class: ValidatorCache(), persistent ETag / Last-Modified of downloaded URLs
+
+    With a cache, HTTP_Downloader(overwrite=True) sends If-None-Match /
+    If-Modified-Since for files it downloaded before, so products reissued
+    in place are fetched again while unchanged ones cost one 304 over the
+    kept-alive connection. Entries hold the size and mtime of the local
+    file; if it changed or is gone the entry is dropped and the next
+    request is unconditional.
+
+    Parameters
+    ----------
+    path : string, default '~/.cache/gnss_ftp_downloader/http_validators.json'
+        Cache file, None keeps the cache in memory only
+    ----------
+
+    Method
+    ----------
+    conditional(self, url, save)
+        Request headers for url, {} if save is not the file the validators belong to
+    seen(self, url, headers)
+        Keep the validators of a response until its file is in place
+    store(self, url, save)
+        Record the validators seen for url with the state of save
+    save(self)
+        Write the cache file
+    ----------
+    """
+    def __init__(self, path=os.path.join(DEFAULT_CACHE_DIR, 'http_validators.json')):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None # url: {'etag', 'last_modified', 'local', 'size', 'mtime_ns'}
+        self.pending = {} # url: (etag, last modified) of a transfer in flight
+        self.changed = False
+
+    def _entries(self):
+        with self.lock:
+            if self.entries is None:
+                self.entries = {}
+                if self.path is not None and os.path.exists(self.path):
+                    try:
+                        with open(self.path) as f:
+                            self.entries = json.load(f)
+                    except ValueError:
+                        pass # broken cache file
+            return self.entries
+
+    def invalidate(self, url):
+        entries = self._entries()
+        with self.lock:
+            if entries.pop(url, None) is not None:
+                self.changed = True
+
+    def conditional(self, url, save):
+        # If-None-Match / If-Modified-Since headers, the entry is dropped if save changed or is missing
+        entry = self._entries().get(url)
+        if entry is None:
+            return {}
+        try:
+            st = os.stat(save)
+        except OSError:
+            st = None
+        if (st is None or entry['local'] != os.path.realpath(save)
+                or [st.st_size, st.st_mtime_ns] != [entry['size'], entry['mtime_ns']]):
+            self.invalidate(url)
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def seen(self, url, headers):
+        # validators of a 200 / 206 response
+        with self.lock:
+            self.pending[url] = (headers.get('ETag'), headers.get('Last-Modified'))
+
+    def store(self, url, save):
+        # the file of url is in place, record its validators (none: no entry)
+        entries = self._entries()
+        with self.lock:
+            etag, last_modified = self.pending.pop(url, (None, None))
+            if etag is None and last_modified is None:
+                if entries.pop(url, None) is not None:
+                    self.changed = True
+                return
+            st = os.stat(save)
+            entries[url] = {'etag': etag, 'last_modified': last_modified, 'local': os.path.realpath(save),
+                            'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            self.changed = True
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            if not self.changed or self.entries is None:
+                return
+            data = json.dumps(self.entries)
+            self.changed = False
+        os.makedirs(os.path.dirname(os.path.realpath(self.path)), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
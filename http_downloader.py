@@ -3,24 +3,231 @@
 
 import os
 import threading
-from ftp_downloader import downloader
+from ftp_downloader import (downloader, QUEUE_SIZE, part_file, part_offset, finish_part, remove_empty, discard,
+                            read_validators, keep_validators, drop_validators)
 from gtime import GTime, GT_list
 import pandas as pd
 import requests
-from queue import Queue
-import fcntl
 import logging
 import time
+from contextlib import nullcontext
+from concurrency import AdaptiveLimiter
+from scheduler import RetryScheduler
+from segmented import SEGMENT_SIZE, segment_file, http_range, fetch_segments
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from metrics import NULL_TRANSFER
+from receive import Receiver
+from http_cache import ValidatorCache, NOT_MODIFIED
+
+def content_size(response, offset=0):
+    # full remote size from Content-Range / Content-Length, None if unknown
+    if response.status_code == 206 and '/' in response.headers.get('Content-Range', ''):
+        total = response.headers['Content-Range'].rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    if length is None or response.headers.get('Content-Encoding'):
+        return None
+    return int(length) + (offset if response.status_code == 206 else 0)
+
+def http_validators(headers):
+    # ETag / Last-Modified of a response, recorded for If-Range when a part is started
+    return {key: headers.get(key) for key in ('ETag', 'Last-Modified')}
+
+def resume_part(part):
+    """
+    (offset, headers, validators) to resume part: Range and If-Range with the
+    validators recorded when the part was started, so a file reissued in
+    place comes back whole (200) instead of being appended to the stale
+    bytes. Parts without a record are started over.
+    """
+    offset = part_offset(part)
+    if not offset:
+        return 0, {}, {}
+    validators = read_validators(part)
+    if validators is None:
+        os.remove(part) # unknown origin, cannot tell whether it is stale
+        return 0, {}, {}
+    headers = {'Range': 'bytes={}-'.format(offset)}
+    etag = validators.get('ETag')
+    if etag and not etag.startswith('W/'):
+        headers['If-Range'] = etag # weak tags are not allowed in If-Range
+    elif validators.get('Last-Modified'):
+        headers['If-Range'] = validators['Last-Modified']
+    return offset, headers, validators
 
 # TODO: to a package
 class HTTP_Downloader():
-    def __init__(self, threads=2):
+    """
+    HTTP_Downloader is a class: HTTP_Downloader(), multi-threading HTTP(S) downloader
+
+    Parameters
+    ----------
+    threads : int, default 2
+        Numbers of downloading threads (upper bound if adaptive)
+    adaptive : bool, default False
+        Tune the number of active threads between min_threads and threads from
+        the measured throughput and server errors [see AdaptiveLimiter],
+        the level in use is self.concurrency
+    min_threads : int, default 1
+        Lower bound of the adaptive number of threads
+    retries : int, default 3
+        Retry budget per URL for transient errors [see RetryScheduler]
+    auth : tuple or requests auth, default None
+        Credentials, e.g. ('user', 'password') for Earthdata login (cddis),
+        ~/.netrc is used by requests if None
+    chunk_size : int, default 1 MiB
+        Bodies are streamed to disk in blocks of this size [see receive.Receiver]
+    segment_size : int, default 64 MiB
+        Files larger than this are fetched as byte ranges over all threads
+        at once if the server accepts Range, None to disable
+    pipeline : Pipeline, default None
+        Decode (.Z, .gz, Hatanaka) finished files on a process pool while
+        the transfers go on [see pipeline.Pipeline]
+    metrics : Metrics, default None
+        Record per-file phases and per-session / per-host aggregates
+        [see metrics.Metrics]
+    rate_limit : RateLimiter, default None
+        Connection caps, request and byte rates shared with other downloaders
+        and processes [see ratelimit.RateLimiter]
+    weight : float, default 1
+        Share of this downloader in the rate limits of a host
+    direct, dontneed : bool, default False
+        Write with O_DIRECT, or drop written pages from the page cache, so
+        bulk downloads do not evict it [see receive.Receiver]
+    validators : ValidatorCache, string or bool, default None
+        ETag / Last-Modified of downloaded URLs (a ValidatorCache, its path
+        or True for the default one); with overwrite, files downloaded
+        before are requested conditionally and a 304 leaves them as they
+        are [see http_cache.ValidatorCache]
+    ----------
+
+    Every thread keeps one requests.Session, so connections (TCP + TLS) are
+    reused with keep-alive and cookies / auth redirects persist across files.
+    """
+    def __init__(self, threads=2, adaptive=False, min_threads=1, retries=3, auth=None, chunk_size=1 << 20,
+                 segment_size=SEGMENT_SIZE, pipeline=None,
+                 metrics=None, rate_limit=None, weight=1, direct=False, dontneed=False, validators=None):
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.122 Safari/537.36",
             "Cookie": ""
         }
         self.threads = threads
         self.log = True
+        self.limiter = AdaptiveLimiter(min_threads, threads, initial=min_threads) if adaptive else None
+        self.retries = retries
+        self.failures = []
+        self.auth = auth
+        self.chunk_size = chunk_size
+        self.local = threading.local()
+        self.segment_size = segment_size
+        self.segments = None
+        self.pipeline = pipeline
+        self.metrics = metrics
+        self.rate_limit = rate_limit
+        self.weight = weight
+        self.rate_job = None
+        self.ready = threading.Event() # set while a run is set up (sessions, metrics, rate limits)
+        self.receiver = Receiver(chunk_size, direct=direct, dontneed=dontneed)
+        if validators is True:
+            validators = ValidatorCache()
+        elif isinstance(validators, str):
+            validators = ValidatorCache(validators)
+        self.validators = validators
+
+    def _session(self):
+        # keep-alive session of the calling thread
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update({k: v for k, v in self.headers.items() if v})
+            session.auth = self.auth
+            self.local.session = session
+        return session
+
+    @property
+    def concurrency(self):
+        # number of threads in use
+        return self.limiter.limit if self.limiter is not None else self.threads
+
+    def _slot(self):
+        # transfer slot of the adaptive limiter, set stats['nbytes'] when done
+        return self.limiter.slot() if self.limiter is not None else nullcontext({'nbytes': 0})
+
+    def _transfer(self, url):
+        # timings of one file, a no-op without metrics
+        return self.metrics.transfer(urlsplit(url).netloc, url) if self.metrics is not None else NULL_TRANSFER
+
+    def _connection(self, host):
+        # connection of the rate limiter, held while a request is in flight
+        return self.rate_job.connection(host) if self.rate_job is not None else nullcontext()
+
+    def _request(self, host):
+        if self.rate_job is not None:
+            self.rate_job.request(host)
+
+    def _throttled(self, host, write):
+        # charge received blocks to the byte rate of the rate limiter
+        return self.rate_job.writer(host, write) if self.rate_job is not None else write
+
+    def _retrieve(self, url, part, t=NULL_TRANSFER, headers=None):
+        # fetch url into part file, return remote size (NOT_MODIFIED for a 304 to conditional headers)
+        # resume from the bytes we already have, if the file did not change since
+        offset, resume, validators = resume_part(part)
+        headers = dict(headers or {}, **resume)
+        session = self._session()
+        t.session = id(session)
+        t.mark('session')
+        host = urlsplit(url).netloc
+        self._request(host)
+        with self._connection(host), session.get(url, headers=headers, stream=True) as response:
+            t.mark('control')
+            if response.status_code == 416:
+                # nothing left to fetch, part file is already complete
+                if self.validators is not None:
+                    self.validators.seen(url, validators)
+                total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+                return int(total) if total.isdigit() else offset
+            if response.status_code == 304:
+                return NOT_MODIFIED
+            response.raise_for_status()
+            size = content_size(response, offset)
+            if response.status_code == 200:
+                keep_validators(part, http_validators(response.headers)) # new part, or If-Range did not match
+            if self.validators is not None:
+                self.validators.seen(url, response.headers)
+            if (self.segments is not None and response.status_code == 200 and size is not None
+                    and size > self.segment_size and response.headers.get('Accept-Ranges') == 'bytes'):
+                segmented = True # drop this stream, fetch ranges instead
+            else:
+                segmented = False
+                # a 200 means the server ignored Range, restart
+                self.receiver.receive(response.iter_content(chunk_size=self.receiver.blocksize), part, size,
+                                      self._throttled(host, t.writer(discard)), restart=response.status_code == 200)
+        if segmented:
+            self._retrieve_segments(url, part, size)
+        return size
+
+    def _retrieve_segments(self, url, part, size):
+        # fetch url as byte ranges over the sessions of the segment threads, then move it to part
+        seg = segment_file(part)
+        host = urlsplit(url).netloc
+
+        def _fetch_range(fd, start, end):
+            with self._connection(host):
+                self._request(host)
+                received = http_range(self._session(), url, fd, start, end, self.chunk_size)
+            if self.rate_job is not None:
+                self.rate_job.consume(host, received)
+            return received
+
+        try:
+            fetch_segments(_fetch_range, seg, size, self.segment_size, self.segments, self.threads)
+        except BaseException:
+            if os.path.exists(seg):
+                os.remove(seg)
+            raise
+        os.replace(seg, part)
 
     def _download_url(self):
         # download url [call by threads]
@@ -28,47 +235,108 @@ class HTTP_Downloader():
             url = self.queue.get()
             file_name = url.split('/')[-1]
             save = self.out + os.sep + file_name
-            if (not self.overwrite) and os.path.exists(save):
+            if (not self.overwrite) and (os.path.exists(save) or
+                                         (self.pipeline is not None and self.pipeline.decoded(save))):
+                if self.metrics is not None:
+                    self.metrics.skipped(url)
                 self.queue.task_done()
                 continue
+            part = part_file(save)
+            t = self._transfer(url)
+            received = part_offset(part)
+            # files downloaded before are asked for only if they changed (not for a started part)
+            headers = self.validators.conditional(url, save) if self.validators is not None and not received else None
             try:
-                with open(save, 'wb') as f:
-                    fcntl.flock(f,fcntl.LOCK_EX | fcntl.LOCK_NB) # lock file
-                    response = requests.get(url,headers=self.headers)
-                    f.write(response.content)
-                    fcntl.flock(f,fcntl.LOCK_UN) # release lock
-                    f.close()
-                print('{} -> {}'.format(url, save))
-            except:
-                print('Error when downloading {} -> {}'.format(url, save))
-                if self.log:
-                    logging.warning('Error when downloading {} -> {}'.format(url, save))
-                if os.path.getsize(save) == 0:
-                    # remove 0 size file
-                    os.remove(save)
+                with self._slot() as stats:
+                    size = self._retrieve(url, part, t, headers)
+                    stats['nbytes'] = part_offset(part) - received
+                if size == NOT_MODIFIED:
+                    if self.metrics is not None:
+                        self.metrics.skipped(url, t)
+                else:
+                    finish_part(part, save, size)
+                    drop_validators(part)
+                    t.done(stats['nbytes'])
+                    if self.validators is not None:
+                        self.validators.store(url, save)
+                    print('{} -> {}'.format(url, save))
+                    if self.pipeline is not None:
+                        self.pipeline.submit(save)
+            except Exception as e:
+                nbytes = max(part_offset(part) - received, 0)
+                remove_empty(part)
+                delay = self.queue.retry(url, e)
+                t.done(nbytes, e, delay is not None)
+                if delay is None:
+                    print('Error when downloading {} -> {}'.format(url, save))
+                    if self.log:
+                        logging.warning('Error when downloading {} -> {}: {}'.format(url, save, e))
+                else:
+                    if self.metrics is not None:
+                        self.metrics.queued(url, retry=True)
+                    if self.log:
+                        logging.info('Retry {} in {:.1f}s: {}'.format(url, delay, e))
             self.queue.task_done()
 
-    def download_by_urls(self, urls, out='.', overwrite=False):
-        # download url list by muti-threading
+    def download_by_urls(self, urls, out='.', overwrite=False, report=None):
+        # download url list by muti-threading, failures are written to report (json) if given
         if isinstance(urls, str):
             urls = [urls] # change to list
+        # retry queue (bounded, urls may be a generator)
+        self._run(RetryScheduler(maxsize=QUEUE_SIZE, retries=self.retries), urls, out, overwrite, report)
+
+    def _run(self, queue, urls, out, overwrite, report):
+        # run download threads on queue, feeding urls into it
         self.out = os.path.realpath(out)
         self.overwrite = overwrite
-        # threads list and queue
         thread_list = []
-        self.queue = Queue()
-        # put urls to queue
-        for url in urls:
-            self.queue.put(url)
-        print('All URL generated, Downloading...')
+        self.queue = queue
+        # ranges of large files run on their own threads and sessions
+        if self.segment_size and self.threads > 1:
+            self.segments = ThreadPoolExecutor(self.threads)
+        if self.pipeline is not None:
+            self.pipeline.start()
+        if self.metrics is not None:
+            self.metrics.start()
+        if self.rate_limit is not None:
+            self.rate_job = self.rate_limit.job(weight=self.weight)
+        self.ready.set()
+        print('Downloading...')
         # start threads
         for i in range(self.threads):
             t_parse = threading.Thread(target=self._download_url)
             thread_list.append(t_parse)
-            t_parse.setDaemon(True)
+            t_parse.daemon = True
             t_parse.start()
+        # put urls to queue while downloading
+        for url in urls:
+            if self.metrics is not None:
+                self.metrics.queued(url)
+            self.queue.put(url)
+        print('All URL generated')
         # wait until all tasks done
         self.queue.join()
+        self.ready.clear()
+        if self.segments is not None:
+            self.segments.shutdown()
+            self.segments = None
+        if self.rate_job is not None:
+            self.rate_job.close()
+            self.rate_job = None
+        if self.pipeline is not None:
+            self.pipeline.join()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.validators is not None:
+            self.validators.save()
+        if self.limiter is not None:
+            print('Adaptive concurrency: {} threads'.format(self.concurrency))
+        # final list of urls that never succeeded
+        self.failures = self.queue.report()
+        if self.failures:
+            print('{} files failed'.format(len(self.failures)) + (', see {}'.format(report) if report else ''))
+            if report is not None:
+                self.queue.write_report(report)
         return
 
 def main():
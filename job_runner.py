@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Job runner: download many (host, pattern, dic, out) entries of a JSON job file, all hosts at once
+
+    python job_runner.py daily.json
+    python job_runner.py daily.json --summary summary.json --events events.jsonl
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from urllib.parse import urlsplit
+from gtime import GTime, GT_list
+from url_template import iter_urls
+from ftp_downloader import downloader
+from ratelimit import RateLimiter
+from metrics import Metrics
+
+__all__ = ["JobRunner", "load_jobs", "parse_gtime", "request_dic"]
+
+def load_jobs(path):
+    # job file -> dict
+    with open(path) as f:
+        return json.load(f)
+
+def _gtime(value):
+    # GTime from a GTime dict or 'today' / 'today-N' (UTC date)
+    if isinstance(value, str):
+        match = re.fullmatch(r'today(-\d+)?', value.strip())
+        if match is None:
+            raise ValueError('Unknown time {}'.format(value))
+        now = time.gmtime()
+        return GTime(year=now.tm_year, month=now.tm_mon, day=now.tm_mday) + int(match.group(1) or 0)
+    return GTime(value)
+
+def parse_gtime(value):
+    """
+    'GTIME' of a job file to a GTime list (or GTimeArray)
+
+    {'begin': t, 'end': t, 'step': 1, 'unit': 'day'} with t a GTime dict
+    (e.g. {'year': 2020, 'doy': 1}) or 'today' / 'today-N', or a list of t
+    """
+    if isinstance(value, dict):
+        begin, end = _gtime(value['begin']), _gtime(value['end'])
+        step, unit = value.get('step', 1), value.get('unit', 'day')
+        if step == 1 and unit == 'day':
+            return GT_list(begin, end)
+        from gtime_array import GTimeArray # hours / minutes, needs numpy
+        return GTimeArray.range(begin, end, step, unit)
+    return [_gtime(v) for v in value]
+
+def request_dic(dic):
+    # request dictionary of a job file entry
+    dic = dict(dic)
+    if 'GTIME' in dic:
+        dic['GTIME'] = parse_gtime(dic['GTIME'])
+    return dic
+
+class JobRunner():
+    """
+    JobRunner is a class: JobRunner(jobs), every entry of a job file run at the same time
+
+    All entries start together, each on its own downloader. Per-host
+    concurrency is enforced across entries: FTP sessions of one host come
+    from one shared pool, and a shared RateLimiter caps the connections
+    (and optional rates) of every host, so the wall time is about that of
+    the slowest host instead of the sum. One Metrics collects the combined
+    summary.
+
+    Job file (JSON)
+    ----------
+    {
+      "hosts": {"ftp.aiub.unibe.ch": {"connections": 10, "bandwidth": 20e6}},
+      "total": {"bandwidth": 100e6},
+      "defaults": {"ftp_num": 4, "retries": 3},
+      "jobs": [
+        {"name": "igs", "host": "gdc.cddis.eosdis.nasa.gov",
+         "pattern": "/pub/gps/products/GPSTW/igsGPSTWGPSTD.sp3.Z",
+         "dic": {"GTIME": {"begin": "today-7", "end": "today-1"}}, "out": "igs"},
+        {"name": "hkcors", "host": "ftp.geodetic.gov.hk", "ftp_num": 10,
+         "pattern": "/rinex2/YYYY/DDD/SSSS/5s/SSSSDDD0.YYd.gz",
+         "dic": {"GTIME": {"begin": {"year": 2018, "doy": 68}, "end": {"year": 2018, "doy": 70}},
+                 "SSSS": ["hkcl", "hkks"]}, "out": "hk"},
+        {"name": "ionex", "protocol": "http", "host": "https://cddis.nasa.gov",
+         "pattern": "/archive/gnss/products/ionex/YYYY/DDD/igsgDDD0.YYi.Z",
+         "dic": {"GTIME": {"begin": "today-3", "end": "today-1"}}, "out": "ionex",
+         "options": {"auth": ["user", "password"]}}
+      ]
+    }
+    ----------
+    hosts : limits per host [see ratelimit.RateLimiter], 'connections'
+        defaults to the largest ftp_num / threads of the host's entries
+    total : limits over all hosts
+    defaults : keys used by entries that do not set them
+    jobs : entries with keys
+        host, pattern, dic, out (default '.'), name, protocol ('ftp' or
+        'http', default from host), port, user, passwd, ftp_num / threads,
+        weight, retries, overwrite, prefilter (ftp), options (other
+        keyword arguments of downloader / HTTP_Downloader)
+    ----------
+
+    Parameters
+    ----------
+    jobs : dict or string
+        Job file contents or path
+    events, prometheus, progress :
+        Metrics outputs [see metrics.Metrics]
+    ----------
+
+    Method
+    ----------
+    run(self)
+        Run all entries, print and return the summary
+    ----------
+    """
+    def __init__(self, jobs, events=None, prometheus=None, progress=True):
+        self.spec = load_jobs(jobs) if isinstance(jobs, str) else jobs
+        defaults = self.spec.get('defaults', {})
+        self.entries = []
+        for i, entry in enumerate(self.spec.get('jobs', [])):
+            entry = dict(defaults, **entry)
+            if 'host' not in entry or 'pattern' not in entry:
+                raise ValueError('Job entry {} needs host and pattern'.format(i))
+            entry.setdefault('protocol', 'http' if re.match(r'https?://', entry['host']) else 'ftp')
+            entry.setdefault('name', '{}#{}'.format(entry['host'], i))
+            entry['key'] = self._host_key(entry)
+            self.entries.append(entry)
+        self.rate_limit = RateLimiter(self._limits(), self.spec.get('total'))
+        self.metrics = Metrics(events, prometheus, progress)
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def _host_key(self, entry):
+        # host name used by the limits: FTP host / HTTP netloc
+        if entry['protocol'] == 'http':
+            return urlsplit(entry['host']).netloc or urlsplit(entry['pattern']).netloc
+        return entry['host']
+
+    def _concurrency(self, entry):
+        return entry.get('threads', entry.get('ftp_num', 1)) if entry['protocol'] == 'http' else entry.get('ftp_num', 1)
+
+    def _limits(self):
+        # per-host limits, connections default to the largest entry concurrency of the host
+        hosts = self.spec.get('hosts', {})
+        limits = {host: dict(value) for host, value in hosts.items()}
+        for entry in self.entries:
+            limit = limits.setdefault(entry['key'], dict(hosts.get('*', {})))
+            if 'connections' not in hosts.get(entry['key'], {}):
+                limit['connections'] = max(limit.get('connections') or 0, self._concurrency(entry))
+        return limits
+
+    def _ftp(self, entry):
+        dl = downloader(entry['host'], entry.get('user', ''), entry.get('passwd', ''), port=entry.get('port', 21),
+                        ftp_num=entry.get('ftp_num', 1), retries=entry.get('retries', 3), metrics=self.metrics,
+                        rate_limit=self.rate_limit, weight=entry.get('weight', 1), **entry.get('options', {}))
+        os.makedirs(entry.get('out', '.'), exist_ok=True)
+        dl.download(entry['pattern'], request_dic(entry.get('dic', {})), entry.get('out', '.'),
+                    entry.get('overwrite', False), entry.get('prefilter', False))
+        return dl.failures
+
+    def _http(self, entry):
+        from http_downloader import HTTP_Downloader # needs requests / pandas
+        options = dict(entry.get('options', {}))
+        if isinstance(options.get('auth'), list):
+            options['auth'] = tuple(options['auth'])
+        dl = HTTP_Downloader(threads=self._concurrency(entry), retries=entry.get('retries', 3), metrics=self.metrics,
+                             rate_limit=self.rate_limit, weight=entry.get('weight', 1), **options)
+        prefix = entry['host'].rstrip('/') if not re.match(r'https?://', entry['pattern']) else ''
+        urls = (prefix + url for url in iter_urls(entry['pattern'], request_dic(entry.get('dic', {}))))
+        out = os.path.realpath(entry.get('out', '.'))
+        os.makedirs(out, exist_ok=True)
+        dl.download_by_urls(urls, out, entry.get('overwrite', False),
+                            os.path.join(out, 'failed_{}.json'.format(time.strftime('%Y%m%d_%H%M%S'))))
+        return dl.failures
+
+    def _run_entry(self, entry):
+        start = time.time()
+        result = {'name': entry['name'], 'host': entry['key'], 'protocol': entry['protocol']}
+        try:
+            failures = self._http(entry) if entry['protocol'] == 'http' else self._ftp(entry)
+            result['failed'] = len(failures)
+        except Exception as e:
+            result['error'] = str(e) or type(e).__name__
+            print('Error in job {}'.format(entry['name']))
+            logging.warning('Error in job {}: {}'.format(entry['name'], e))
+        result['seconds'] = round(time.time() - start, 3)
+        with self.lock:
+            self.results[entry['name']] = result
+
+    def run(self):
+        start = time.time()
+        self.metrics.start() # one summary over all entries
+        threads = [threading.Thread(target=self._run_entry, args=(entry,), daemon=True) for entry in self.entries]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.metrics.stop()
+        snapshot = self.metrics.snapshot()
+        jobs = [self.results[entry['name']] for entry in self.entries]
+        summary = {'wall_seconds': round(time.time() - start, 3),
+                   'job_seconds': round(sum(job['seconds'] for job in jobs), 3),
+                   'jobs': jobs, 'hosts': snapshot['hosts'],
+                   'done': snapshot['done'], 'failed': sum(job.get('failed', 0) for job in jobs),
+                   'retries': snapshot['retries'], 'skipped': snapshot['skipped'], 'bytes': snapshot['bytes']}
+        self.print_summary(summary)
+        return summary
+
+    def print_summary(self, summary):
+        print('{:24s} {:32s} {:>9s} {:>7s}  {}'.format('Job', 'Host', 'Seconds', 'Failed', 'Error'))
+        for job in summary['jobs']:
+            print('{:24s} {:32s} {:9.1f} {:>7}  {}'.format(job['name'][:24], job['host'][:32], job['seconds'],
+                                                           job.get('failed', '-'), job.get('error', '')))
+        print('{:57s} {:>7s} {:>7s} {:>10s}'.format('Host', 'Files', 'Failed', 'MB'))
+        for host, h in summary['hosts'].items():
+            print('{:57s} {:7d} {:7d} {:10.1f}'.format(host[:57], h['files'], h['failed'], h['bytes'] / 1e6))
+        print('Total: {} files, {} failed, {} retries, {} skipped, {:.1f} MB in {:.1f}s (sum of job times {:.1f}s)'.format(
+            summary['done'], summary['failed'], summary['retries'], summary['skipped'], summary['bytes'] / 1e6,
+            summary['wall_seconds'], summary['job_seconds']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download all entries of a JSON job file, all hosts at once')
+    parser.add_argument('jobs', help='job file [see JobRunner]')
+    parser.add_argument('--summary', help='write the summary as JSON')
+    parser.add_argument('--events', help='JSON lines event stream [see metrics.Metrics]')
+    parser.add_argument('--prometheus', help='Prometheus text snapshot file')
+    parser.add_argument('--no-progress', action='store_true', help='no progress lines')
+    args = parser.parse_args(argv)
+    summary = JobRunner(args.jobs, args.events, args.prometheus, not args.no_progress).run()
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=1)
+    return 1 if summary['failed'] or any('error' in job for job in summary['jobs']) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Persistent SQLite download manifest for incremental sync runs
+"""
+
+import time
+import sqlite3
+import hashlib
+import threading
+
+__all__ = ["Manifest", "file_md5", "checksum"]
+
+def file_md5(path, blocksize=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def checksum(algorithm, digest):
+    # checksum column: md5 hex as file_md5(), '<algorithm>:<hex>' for the other archive checksums
+    return digest if algorithm == 'md5' else '{}:{}'.format(algorithm, digest)
+
+class Manifest():
+    """
+    Manifest is a class: Manifest(path), a SQLite (WAL mode) record of downloaded files
+
+    Every file is keyed by host + remote path and records the remote size and
+    modification time, the local path, a checksum and a status ('done' or
+    'failed'). The checksum is the archive's one when the download was
+    verified [see checksum()], the md5 of the file otherwise. Local files
+    that matched an archive checksum are kept in a second table with their
+    size and mtime (skip-if-verified of checksums.Verifier).
+
+    Parameters
+    ----------
+    path : string
+        SQLite database file
+    commit_every : int, default 100
+        Records are committed in batches of this size (and on close())
+    ----------
+
+    Method
+    ----------
+    diff(self, host, urls, remote)
+        URLs that are new, changed on the server or previously failed
+    record(self, host, url, size, mtime, local, status, checksum=None)
+        Record the result of one transfer
+    verified(self, local)
+        [size, mtime_ns, algorithm, digest] of a local file that matched its checksum, None if unknown
+    record_verified(self, local, size, mtime_ns, algorithm, digest)
+        Record a local file that matched its checksum
+    close(self)
+        Commit pending records and close the database
+    ----------
+
+    """
+    def __init__(self, path, commit_every=100):
+        self.path = path
+        self.commit_every = commit_every
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                            host TEXT NOT NULL,
+                            remote TEXT NOT NULL,
+                            size INTEGER,
+                            mtime TEXT,
+                            local TEXT,
+                            checksum TEXT,
+                            status TEXT,
+                            updated REAL,
+                            PRIMARY KEY (host, remote))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS verified (
+                            local TEXT PRIMARY KEY,
+                            size INTEGER,
+                            mtime_ns INTEGER,
+                            algorithm TEXT,
+                            digest TEXT)""")
+        self.db.commit()
+
+    def entries(self, host):
+        # all records of host in one query: {remote: (size, mtime, local, checksum, status)}
+        with self.lock:
+            rows = self.db.execute('SELECT remote, size, mtime, local, checksum, status FROM files WHERE host=?', (host,)).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def diff(self, host, urls, remote):
+        """
+        Compare URLs against the manifest in bulk
+
+        Parameters
+        ----------
+        host : string
+            Remote host
+        urls : list
+            Remote paths
+        remote : function
+            remote(url) -> (size, mtime) from a cached listing, values may be None
+        ----------
+
+        Return (todo, changed): todo is the list of URLs to download, changed
+        the set of URLs already downloaded once but modified on the server
+        """
+        known = self.entries(host)
+        todo = []
+        changed = set()
+        for url in urls:
+            entry = known.get(url)
+            if entry is None or entry[4] != 'done':
+                todo.append(url)
+                continue
+            size, mtime = remote(url)
+            if (size is not None and size != entry[0]) or (mtime is not None and mtime != entry[1]):
+                todo.append(url)
+                changed.add(url)
+        return todo, changed
+
+    def _write(self, sql, values):
+        with self.lock:
+            self.db.execute(sql, values)
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+
+    def record(self, host, url, size, mtime, local, status, checksum=None):
+        self._write('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)',
+                    (host, url, size, mtime, local, checksum, status, time.time()))
+
+    def verified(self, local):
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime_ns, algorithm, digest FROM verified WHERE local=?', (local,)).fetchone()
+        return list(row) if row is not None else None
+
+    def record_verified(self, local, size, mtime_ns, algorithm, digest):
+        self._write('INSERT OR REPLACE INTO verified VALUES (?,?,?,?,?)', (local, size, mtime_ns, algorithm, digest))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Transfer metrics: per-file phases, per-session / per-host aggregates, JSON lines, progress and Prometheus text
+"""
+
+import os
+import json
+import time
+import threading
+
+__all__ = ["Metrics", "Transfer", "NULL_TRANSFER"]
+
+PHASES = ('queue', 'session', 'control', 'first_byte', 'transfer', 'total')
+
+class _NullTransfer():
+    # stands in for a Transfer when metrics are off, every call is a no-op
+    session = None
+
+    def mark(self, phase):
+        pass
+
+    def writer(self, write):
+        return write
+
+    def done(self, nbytes=0, error=None, retry=False):
+        pass
+
+NULL_TRANSFER = _NullTransfer()
+
+class Transfer():
+    """
+    Transfer is a class: Transfer(), timings of one file
+
+    Phases (seconds)
+    ----------
+    queue       put into the queue -> picked by a worker
+    session     session checked out of the pool (includes a new login)
+    control     control commands before the data (FTP TYPE + SIZE, the
+                downloader sends absolute paths instead of CWD) / HTTP
+                request -> response headers
+    first_byte  RETR / body read -> first data block
+    transfer    first data block -> last one
+    total       picked by a worker -> done
+    ----------
+    """
+    __slots__ = ('metrics', 'host', 'url', 'queued', 'start', 'last', 'first', 'phases', 'session')
+
+    def __init__(self, metrics, host, url, queued=None):
+        self.metrics = metrics
+        self.host = host
+        self.url = url
+        self.start = self.last = time.time()
+        self.queued = queued
+        self.first = None
+        self.phases = {}
+        self.session = None
+
+    def mark(self, phase):
+        # end of phase, the next phase starts now
+        now = time.time()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def writer(self, write):
+        # wrap a data callback, the first block ends the first_byte phase
+        def _write(data):
+            if self.first is None:
+                self.first = time.time()
+                self.phases['first_byte'] = self.first - self.last
+            write(data)
+        return _write
+
+    def done(self, nbytes=0, error=None, retry=False):
+        # retry: the attempt failed and the file was queued again, it is not counted as failed
+        end = time.time()
+        if self.first is not None:
+            self.phases['transfer'] = end - self.first
+        if self.queued is not None:
+            self.phases['queue'] = self.start - self.queued
+        self.phases['total'] = end - self.start
+        self.metrics._finish(self, nbytes, error, end, retry)
+
+class Metrics():
+    """
+    Metrics is a class: Metrics(), instrumentation shared by downloaders
+
+    Parameters
+    ----------
+    events : string, default None
+        Path of a JSON lines event stream (one 'transfer' line per file, one
+        'connect' line per login, a 'summary' line at the end)
+    prometheus : string, default None
+        Path of a Prometheus text snapshot, rewritten every interval
+    progress : bool, default True
+        Print a progress / ETA line every interval
+    interval : float, default 10
+        Seconds between progress lines and snapshots
+    ----------
+
+    Method
+    ----------
+    start(self) / stop(self)
+        Called by the downloaders around a run
+    snapshot(self)
+        Per-host and per-session aggregates (dict)
+    progress_line(self)
+        'files done/queued, MB, MB/s, ETA' summary
+    ----------
+
+    Counters are per file: a retried attempt counts in 'retries', the file
+    is counted once as done or failed when its last attempt ends.
+
+    Collection is a few dict updates per file under one lock; nothing is
+    done per data block except the first.
+    """
+    def __init__(self, events=None, prometheus=None, progress=True, interval=10):
+        self.events = events
+        self.prometheus = prometheus
+        self.progress = progress
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.queued_at = {}
+        self.hosts = {}
+        self.sessions = {}
+        self.session_names = {}
+        self.n_queued = 0
+        self.n_done = 0
+        self.n_failed = 0
+        self.n_retries = 0
+        self.n_skipped = 0
+        self.nbytes = 0
+        self.started = None
+        self.stream = None
+        self.reporter = None
+        self.stopped = threading.Event()
+        self.users = 0
+
+    def _host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {'files': 0, 'failed': 0, 'retries': 0, 'bytes': 0, 'connects': 0, 'connect_seconds': 0.0,
+                                'phases': {p: [0.0, 0] for p in PHASES}}
+        return self.hosts[host]
+
+    def _emit(self, event):
+        # one JSON line per event, caller holds the lock
+        if self.stream is not None:
+            self.stream.write(json.dumps(event) + '\n')
+
+    def start(self):
+        with self.lock:
+            self.users += 1
+            if self.users > 1:
+                return # several downloaders share one Metrics
+            self.started = self.started or time.time()
+            if self.events is not None and self.stream is None:
+                self.stream = open(self.events, 'a', buffering=1)
+            self.stopped.clear()
+        if self.progress or self.prometheus:
+            self.reporter = threading.Thread(target=self._report, daemon=True)
+            self.reporter.start()
+
+    def stop(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            self._emit({'event': 'summary', 'time': time.time(), **self._snapshot()})
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+        self.stopped.set()
+        if self.reporter is not None:
+            self.reporter.join() # last report before the final one
+            self.reporter = None
+        if self.progress:
+            print(self.progress_line())
+        if self.prometheus:
+            self.write_prometheus(self.prometheus)
+
+    def _report(self):
+        while not self.stopped.wait(self.interval):
+            if self.progress:
+                print(self.progress_line())
+            if self.prometheus:
+                self.write_prometheus(self.prometheus)
+
+    def queued(self, url, retry=False):
+        # url put into the download queue, retry: again after a failed attempt
+        with self.lock:
+            if url not in self.queued_at and not retry:
+                self.n_queued += 1
+            self.queued_at[url] = time.time()
+
+    def skipped(self, url, transfer=None):
+        # url picked but not downloaded (exists already, or transfer got a 304)
+        with self.lock:
+            if self.queued_at.pop(url, None) is not None or transfer is not None:
+                self.n_skipped += 1
+
+    def transfer(self, host, url):
+        # a worker picked url
+        with self.lock:
+            queued = self.queued_at.pop(url, None)
+        return Transfer(self, host, url, queued)
+
+    def connected(self, host, seconds, session=None):
+        # a new session logged in
+        with self.lock:
+            h = self._host(host)
+            h['connects'] += 1
+            h['connect_seconds'] += seconds
+            self._emit({'event': 'connect', 'time': time.time(), 'host': host, 'seconds': round(seconds, 6),
+                        'session': self._session_name(host, session)})
+
+    def _session_name(self, host, session):
+        if session is None:
+            return None
+        key = (host, session)
+        if key not in self.session_names:
+            self.session_names[key] = '{}#{}'.format(host, sum(1 for k in self.session_names if k[0] == host) + 1)
+        return self.session_names[key]
+
+    def _finish(self, t, nbytes, error, end, retry=False):
+        with self.lock:
+            h = self._host(t.host)
+            if error is None:
+                h['files'] += 1
+                self.n_done += 1
+            elif retry:
+                h['retries'] += 1
+                self.n_retries += 1
+            else:
+                h['failed'] += 1
+                self.n_failed += 1
+            h['bytes'] += nbytes
+            self.nbytes += nbytes
+            for phase, seconds in t.phases.items():
+                acc = h['phases'][phase]
+                acc[0] += seconds
+                acc[1] += 1
+            name = self._session_name(t.host, t.session)
+            if name is not None:
+                s = self.sessions.setdefault(name, {'files': 0, 'bytes': 0, 'busy_seconds': 0.0})
+                s['files'] += 1
+                s['bytes'] += nbytes
+                s['busy_seconds'] += t.phases['total']
+            seconds = t.phases.get('transfer') or t.phases['total']
+            self._emit({'event': 'transfer', 'time': end, 'host': t.host, 'url': t.url, 'session': name,
+                        'ok': error is None, 'retry': retry,
+                        'error': None if error is None else str(error) or type(error).__name__,
+                        'bytes': nbytes, 'rate': round(nbytes / seconds, 1) if seconds > 0 else None,
+                        'phases': {k: round(v, 6) for k, v in t.phases.items()}})
+
+    def _snapshot(self):
+        elapsed = time.time() - self.started if self.started else 0
+        hosts = {}
+        for host, h in self.hosts.items():
+            hosts[host] = {'files': h['files'], 'failed': h['failed'], 'retries': h['retries'], 'bytes': h['bytes'],
+                           'connects': h['connects'], 'connect_seconds': round(h['connect_seconds'], 6),
+                           'mean_phases': {p: round(s / n, 6) for p, (s, n) in h['phases'].items() if n}}
+        return {'elapsed': round(elapsed, 3), 'queued': self.n_queued, 'done': self.n_done, 'failed': self.n_failed,
+                'retries': self.n_retries, 'skipped': self.n_skipped,
+                'bytes': self.nbytes, 'rate': round(self.nbytes / elapsed, 1) if elapsed > 0 else None,
+                'hosts': hosts, 'sessions': {k: dict(v) for k, v in self.sessions.items()}}
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot()
+
+    def progress_line(self):
+        with self.lock:
+            elapsed = time.time() - self.started if self.started else 0
+            finished = self.n_done + self.n_failed
+            left = max(self.n_queued - finished - self.n_skipped, 0)
+            rate = self.nbytes / elapsed if elapsed > 0 else 0
+            eta = left * elapsed / finished if finished else None
+        return 'Progress: {}/{} files ({} failed, {} retries, {} skipped), {:.1f} MB, {:.2f} MB/s, ETA {}'.format(
+            finished + self.n_skipped, self.n_queued, self.n_failed, self.n_retries, self.n_skipped, self.nbytes / 1e6, rate / 1e6,
+            time.strftime('%H:%M:%S', time.gmtime(eta)) if eta is not None else '--:--:--')
+
+    def prometheus_text(self):
+        # Prometheus text exposition format
+        lines = []
+
+        def _metric(name, kind, doc, samples):
+            lines.append('# HELP {} {}'.format(name, doc))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value, *suffix in samples: # suffix: _sum / _count of a summary
+                label = ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels.items())
+                lines.append('{}{}{{{}}} {}'.format(name, ''.join(suffix), label, value))
+
+        with self.lock:
+            hosts = [(host, dict(h, phases={p: list(v) for p, v in h['phases'].items()})) for host, h in self.hosts.items()]
+            sessions = [(name, dict(s)) for name, s in self.sessions.items()]
+        _metric('gnss_transfers_total', 'counter', 'Files transferred',
+                [({'host': host, 'status': 'ok'}, h['files']) for host, h in hosts] +
+                [({'host': host, 'status': 'failed'}, h['failed']) for host, h in hosts])
+        _metric('gnss_retries_total', 'counter', 'Failed attempts queued again',
+                [({'host': host}, h['retries']) for host, h in hosts])
+        _metric('gnss_bytes_total', 'counter', 'Bytes received', [({'host': host}, h['bytes']) for host, h in hosts])
+        _metric('gnss_connects_total', 'counter', 'Sessions logged in', [({'host': host}, h['connects']) for host, h in hosts])
+        _metric('gnss_connect_seconds_total', 'counter', 'Time spent on connect and login',
+                [({'host': host}, round(h['connect_seconds'], 6)) for host, h in hosts])
+        _metric('gnss_phase_seconds', 'summary', 'Time spent per transfer phase',
+                [({'host': host, 'phase': p}, round(v[0], 6), '_sum') for host, h in hosts for p, v in h['phases'].items()] +
+                [({'host': host, 'phase': p}, v[1], '_count') for host, h in hosts for p, v in h['phases'].items()])
+        _metric('gnss_session_bytes_total', 'counter', 'Bytes received per session',
+                [({'session': name}, s['bytes']) for name, s in sessions])
+        _metric('gnss_session_files_total', 'counter', 'Files transferred per session',
+                [({'session': name}, s['files']) for name, s in sessions])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # atomic rewrite, for the node_exporter textfile collector
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident()) # one per writer
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Post-transfer pipeline: decompress downloads (.Z, .gz, Hatanaka) on a process pool
+"""
+
+import os
+import re
+import gzip
+import shutil
+import logging
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, wait
+
+__all__ = ["Pipeline", "unlzw", "decode_file", "decoded_name"]
+
+KEEP = ('decompressed', 'both', 'original')
+CHUNK = 1 << 20
+
+def _which(*names):
+    for name in names:
+        path = shutil.which(name)
+        if path:
+            return path
+    return None
+
+def unlzw(data):
+    """
+    Decode unix compress (.Z, LZW) data, return bytes
+
+    Codes are read in groups of eight (n_bits bytes), as written by
+    compress(1); a group is dropped when the code width changes or the
+    table is cleared.
+    """
+    if data[:2] != b'\x1f\x9d':
+        raise ValueError('Not a .Z (compress) file')
+    maxbits = data[2] & 0x1f
+    block_mode = data[2] & 0x80
+    if not 9 <= maxbits <= 16:
+        raise ValueError('Unsupported .Z maxbits {}'.format(maxbits))
+    maxmaxcode = 1 << maxbits
+    first = 257 if block_mode else 256
+    table = [bytes((i,)) for i in range(256)] + [b''] * (first - 256)
+    out = bytearray()
+    prev = None
+    n_bits = 9
+    p = 3
+    while p < len(data):
+        group = data[p:p + n_bits]
+        p += n_bits
+        value = int.from_bytes(group, 'little')
+        mask = (1 << n_bits) - 1
+        for i in range(len(group) * 8 // n_bits):
+            code = (value >> (i * n_bits)) & mask
+            if block_mode and code == 256:
+                # clear: restart the table at 9 bits with the next group
+                del table[first:]
+                prev = None
+                n_bits = 9
+                break
+            if code < len(table):
+                entry = table[code]
+            elif code == len(table) and prev is not None:
+                entry = prev + prev[:1] # KwKwK
+            else:
+                raise ValueError('Corrupt .Z data at byte {}'.format(p))
+            out += entry
+            if prev is not None and len(table) < maxmaxcode:
+                table.append(prev + entry[:1])
+            prev = entry
+            if len(table) > (1 << n_bits) - 1 and n_bits < maxbits:
+                n_bits += 1 # wider codes from the next group
+                break
+    return bytes(out)
+
+def decoded_name(path, hatanaka=False):
+    """
+    Name after one decoding step, None if path is not encoded
+
+    x.Z, x.gz -> x; with hatanaka: x.crx -> x.rnx, x.YYd -> x.YYo
+    """
+    for ext in ('.Z', '.gz'):
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    if hatanaka:
+        if path.endswith('.crx'):
+            return path[:-4] + '.rnx'
+        if re.search(r'\.\d\d[dD]$', path):
+            return path[:-1] + ('o' if path[-1] == 'd' else 'O')
+    return None
+
+def final_name(path, hatanaka=False):
+    # name after all decoding steps
+    name = decoded_name(path, hatanaka)
+    while name is not None:
+        path = name
+        name = decoded_name(path, hatanaka)
+    return path
+
+def _decode_step(src, dst):
+    # decode one layer of src into dst
+    if src.endswith('.gz'):
+        with gzip.open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, CHUNK)
+    elif src.endswith('.Z'):
+        gz = _which('gzip')
+        if gz is not None:
+            # gzip decodes compress format in C
+            with open(dst, 'wb') as fout:
+                subprocess.run([gz, '-dc', src], stdout=fout, check=True)
+        else:
+            with open(src, 'rb') as fin:
+                data = unlzw(fin.read())
+            with open(dst, 'wb') as fout:
+                fout.write(data)
+    else:
+        crx2rnx = _which('CRX2RNX', 'crx2rnx')
+        if crx2rnx is None:
+            raise FileNotFoundError('CRX2RNX not found for {}'.format(src))
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            subprocess.run([crx2rnx], stdin=fin, stdout=fout, check=True)
+
+def decode_file(path, keep='decompressed', hatanaka=False):
+    """
+    Decode path through all its layers (e.g. x.19d.gz -> x.19d -> x.19o), return the kept files
+
+    Parameters
+    ----------
+    keep : string, default 'decompressed'
+        'decompressed': keep the decoded file only,
+        'both': keep the download and the decoded file,
+        'original': keep the download only (decoding just tests the archive)
+    hatanaka : bool, default False
+        Also convert Hatanaka (.crx / .YYd) with CRX2RNX
+    ----------
+    """
+    src = path
+    dst = decoded_name(src, hatanaka)
+    made = []
+    while dst is not None:
+        tmp = dst + '.tmp'
+        try:
+            _decode_step(src, tmp)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.replace(tmp, dst)
+        if src != path:
+            os.remove(src) # intermediate layer
+        made.append(dst)
+        src, dst = dst, decoded_name(dst, hatanaka)
+    if not made:
+        return [path]
+    if keep == 'original':
+        os.remove(made[-1])
+        return [path]
+    if keep == 'decompressed':
+        os.remove(path)
+        return [made[-1]]
+    return [path, made[-1]]
+
+class Pipeline():
+    """
+    Pipeline is a class: Pipeline(), decoding of finished downloads on a process pool
+
+    Downloaders submit() every finished file; decoding runs in worker
+    processes while the transfers go on. At most backlog files wait for a
+    worker, submit() blocks beyond that.
+
+    Parameters
+    ----------
+    keep : string, default 'decompressed'
+        'decompressed', 'both' or 'original' [see decode_file]
+    hatanaka : bool, default False
+        Also convert Hatanaka compressed RINEX with CRX2RNX (must be in PATH)
+    workers : int, default None (number of CPUs)
+        Number of worker processes
+    backlog : int, default None (2 * workers)
+        Max number of files waiting for a worker
+    ----------
+
+    Method
+    ----------
+    start(self), join(self)
+        Called by the downloaders around a run; join() returns the kept files
+    decoded(self, path)
+        True if path was decoded (and removed) before, so it is not downloaded again
+    ----------
+
+    """
+    def __init__(self, keep='decompressed', hatanaka=False, workers=None, backlog=None):
+        if keep not in KEEP:
+            raise ValueError('keep must be one of {}'.format(KEEP))
+        self.keep = keep
+        self.hatanaka = hatanaka
+        self.workers = workers or os.cpu_count() or 1
+        self.slots = threading.BoundedSemaphore(backlog or 2 * self.workers)
+        self.executor = None
+        self.futures = set()
+        self.outputs = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        # fork the workers now, before the download threads run
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+            self.executor.submit(os.getpid).result()
+
+    def decoded(self, path):
+        final = final_name(path, self.hatanaka)
+        return final != path and self.keep == 'decompressed' and os.path.exists(final)
+
+    def submit(self, path):
+        # queue a finished download for decoding
+        if decoded_name(path, self.hatanaka) is None:
+            return
+        self.start()
+        self.slots.acquire()
+        future = self.executor.submit(decode_file, path, self.keep, self.hatanaka)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(lambda f: self._done(f, path))
+
+    def _done(self, future, path):
+        self.slots.release()
+        with self.lock:
+            self.futures.discard(future)
+            try:
+                self.outputs.extend(future.result())
+            except Exception as e:
+                self.errors.append((path, e))
+                print('Error when decoding {}'.format(path))
+                logging.warning('Error when decoding {}: {}'.format(path, e))
+
+    def join(self):
+        # wait for all decoding, return the kept files
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+        with self.lock:
+            outputs, self.outputs = self.outputs, []
+        return outputs
+
+    def close(self):
+        if self.executor is not None:
+            self.join()
+            self.executor.shutdown()
+            self.executor = None
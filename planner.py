@@ -0,0 +1,300 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Dry-run planner: existence, sizes, local state and a wall time estimate of a download, as a plan file
+"""
+
+import os
+import json
+import time
+import random
+import threading
+from collections import deque
+from ftplib import error_perm, error_temp
+from ftp_listing import ListingCache, has_wildcard
+from ftp_pool import get_pool
+from ftp_downloader import part_file
+
+__all__ = ["Planner", "load_plan", "pipelined_size", "TODO_STATES"]
+
+TODO_STATES = ('new', 'partial', 'changed', 'unknown') # entries the real run downloads
+PIPELINE_DEPTH = 32 # SIZE commands in flight per session
+
+def load_plan(plan):
+    # plan file (or dict) -> dict
+    if isinstance(plan, str):
+        with open(plan) as f:
+            return json.load(f)
+    return plan
+
+def pipelined_size(ftp, urls, depth=PIPELINE_DEPTH):
+    """
+    SIZE of many urls over one session, depth commands sent before their replies are read
+
+    Return {url: size}, None for missing files. Raise error_perm if the
+    server does not support SIZE (after reading all replies).
+    """
+    ftp.voidcmd('TYPE I')
+    sizes = {}
+    pending = deque()
+    unsupported = None
+
+    def _read():
+        nonlocal unsupported
+        url = pending.popleft()
+        try:
+            sizes[url] = int(ftp.getresp()[3:].strip())
+        except error_perm as e:
+            if str(e)[:3] in ('500', '502'):
+                unsupported = e
+            sizes[url] = None # 550
+        except error_temp:
+            sizes[url] = None
+
+    for url in urls:
+        ftp.putcmd('SIZE {}'.format(url))
+        pending.append(url)
+        if len(pending) >= depth:
+            _read()
+    while pending:
+        _read()
+    if unsupported is not None:
+        raise unsupported
+    return sizes
+
+class Planner():
+    """
+    Planner is a class: Planner(dl), dry run of downloader.download()
+
+    The pattern is expanded, existence and sizes come from the cached
+    directory listings [see ListingCache] or from pipelined SIZE commands
+    over several sessions, and every URL gets its local state ('new',
+    'partial', 'changed', 'done', 'missing' on the server, 'unknown' if the
+    server tells neither). A short probe fetches a sample of the files to
+    be downloaded at a few session counts and the wall time of the run is
+    estimated from the measured per-file overhead and per-session rate.
+
+    The plan file (JSON) has the totals, the probe and the estimates, and
+    one entry {url, size, mtime, state, local} per URL. downloader.
+    download_plan(plan) runs it without listing or SIZE per file.
+
+    Parameters
+    ----------
+    dl : downloader
+        Host, credentials, sessions (ftp_num) and listing cache of the run
+    ----------
+
+    Method
+    ----------
+    plan(self, pattern, dic={}, out='.', path=None, method='listing', probe_seconds=5, levels=None)
+        Make (and write) the plan, return it
+    ----------
+    """
+    def __init__(self, dl):
+        self.dl = dl
+
+    def _sessions(self, work, items, workers=None):
+        # run work(ftp, chunk) on min(workers, items) pooled sessions at once, items dealt round robin
+        workers = max(min(workers or self.dl.ftp_num, len(items)), 1)
+        chunks = [items[i::workers] for i in range(workers)]
+        errors = []
+
+        def _run(chunk):
+            try:
+                with self.dl.pool.session() as ftp:
+                    work(ftp, chunk)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=_run, args=(chunk,)) for chunk in chunks if chunk]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    def _sizes(self, urls):
+        # {url: size or None} by pipelined SIZE
+        sizes = {}
+        lock = threading.Lock()
+
+        def _work(ftp, chunk):
+            got = pipelined_size(ftp, chunk)
+            with lock:
+                sizes.update(got)
+
+        self._sessions(_work, urls)
+        return sizes
+
+    def _remote(self, urls, method):
+        # [(url, size, mtime, exists)] with exists True / False / None (unknown), wildcards expanded
+        wildcard = any(has_wildcard(url.split('/')[-1]) for url in urls)
+        if method == 'listing' or wildcard:
+            if self.dl.listing is None:
+                self.dl.listing = ListingCache()
+            found = self.dl.filter_urls(urls) # one listing per directory
+            kept, requested = set(found), set(urls)
+            remote = []
+            for url in [url for url in urls if not has_wildcard(url.split('/')[-1])] + \
+                       [url for url in found if url not in requested]: # wildcard matches
+                size, mtime = self.dl._remote_info(url)
+                remote.append((url, size, mtime, url in kept))
+            unknown = [url for url, size, mtime, exists in remote if exists and size is None]
+        else:
+            remote = [(url, None, None, None) for url in urls]
+            unknown = list(urls)
+        if unknown:
+            try:
+                sizes = self._sizes(unknown) # NLST listings have no sizes
+            except error_perm:
+                sizes = {} # no SIZE on this server
+            merged = []
+            for url, size, mtime, exists in remote:
+                if url in sizes:
+                    size = sizes[url]
+                    if exists is None:
+                        exists = size is not None # 550 for missing files
+                merged.append((url, size, mtime, exists))
+            remote = merged
+        return remote
+
+    def _state(self, save, size, exists):
+        if exists is False:
+            return 'missing'
+        if os.path.exists(save):
+            return 'done' if size is None or os.path.getsize(save) == size else 'changed'
+        if self.dl.pipeline is not None and self.dl.pipeline.decoded(save):
+            return 'done'
+        if os.path.exists(part_file(save)):
+            return 'partial'
+        return 'new' if exists else 'unknown'
+
+    def _probe_level(self, sample, sessions, seconds):
+        # fetch sample files on sessions sessions for about seconds, data discarded
+        stop = time.time() + seconds
+        queue = deque(sample)
+        stats = [] # (seconds to first byte, seconds of data, bytes) per file
+        lock = threading.Lock()
+
+        def _work(ftp, chunk):
+            view = memoryview(bytearray(self.dl.receiver.blocksize))
+            ftp.voidcmd('TYPE I')
+            while time.time() < stop:
+                with lock:
+                    if not queue:
+                        return
+                    url = queue.popleft()
+                start = time.time()
+                received = 0
+                try:
+                    conn = ftp.transfercmd('RETR {}'.format(url))
+                except error_perm:
+                    continue # removed since it was listed
+                with conn:
+                    first = time.time()
+                    while time.time() < stop:
+                        n = conn.recv_into(view)
+                        if not n:
+                            break
+                        received += n
+                end = time.time()
+                try:
+                    ftp.voidresp()
+                except error_temp:
+                    pass # aborted at the end of the probe
+                with lock:
+                    stats.append((first - start, end - first, received))
+
+        self._sessions(_work, list(range(sessions)), sessions)
+        files = len(stats)
+        if not files:
+            return None
+        overhead = sum(s[0] for s in stats) / files
+        data_time = sum(s[1] for s in stats)
+        nbytes = sum(s[2] for s in stats)
+        return {'sessions': sessions, 'files': files, 'bytes': nbytes,
+                'overhead': round(overhead, 4), 'rate': round(nbytes / data_time, 1) if data_time else None}
+
+    def probe(self, entries, seconds=5, levels=None):
+        # per-file overhead and per-session rate at each session count of levels
+        todo = [e for e in entries if e['state'] in TODO_STATES and e['size']]
+        if not todo or not seconds:
+            return []
+        levels = levels or sorted({1, self.dl.ftp_num})
+        results = []
+        for sessions in levels:
+            sample = random.sample(todo, min(len(todo), 16 * sessions))
+            result = self._probe_level([e['url'] for e in sample], sessions, seconds)
+            if result is not None:
+                results.append(result)
+        return results
+
+    def estimate(self, files, nbytes, probe):
+        # {sessions: seconds}, each session works on files / sessions files at the measured rate
+        estimates = {}
+        for p in probe:
+            if p['rate']:
+                estimates[str(p['sessions'])] = round((files * p['overhead'] + nbytes / p['rate']) / p['sessions'], 1)
+        return estimates
+
+    def plan(self, pattern, dic={}, out='.', path=None, method='listing', probe_seconds=5, levels=None):
+        """
+        Dry run of download(pattern, dic, out): make the plan, write it to path if given
+
+        Parameters
+        ----------
+        pattern, dic, out :
+            Same as downloader.download()
+        path : string, default None
+            Plan file (JSON)
+        method : string, default 'listing'
+            'listing': one cached MLSD / NLST per directory, SIZE only where
+            the listing has no sizes; 'size': pipelined SIZE of every URL,
+            cheaper for a few files in huge directories (wildcards are
+            always listed)
+        probe_seconds : float, default 5
+            Seconds of the throughput probe per level, 0 to skip it
+        levels : list, default None ([1, ftp_num])
+            Session counts probed
+        ----------
+        """
+        start = time.time()
+        out = os.path.realpath(out)
+        self.dl.pool = get_pool(self.dl.host, self.dl.port, self.dl.user, self.dl._connect,
+                                max([self.dl.ftp_num] + list(levels or [])))
+        try:
+            urls = list(dict.fromkeys(self.dl.iter_urls(pattern, dic)))
+            entries = []
+            for url, size, mtime, exists in self._remote(urls, method):
+                save = os.path.join(out, url.split('/')[-1])
+                entries.append({'url': url, 'size': size, 'mtime': mtime,
+                                'state': self._state(save, size, exists), 'local': save})
+            probe = self.probe(entries, probe_seconds, levels)
+        finally:
+            self.dl.pool.close()
+        todo = [e for e in entries if e['state'] in TODO_STATES]
+        nbytes = sum(e['size'] or 0 for e in todo)
+        # part files are resumed
+        nbytes -= sum(os.path.getsize(part_file(e['local'])) for e in todo if e['state'] == 'partial')
+        totals = {'urls': len(entries), 'todo': len(todo), 'todo_bytes': nbytes,
+                  'unknown_size': sum(1 for e in todo if e['size'] is None)}
+        for state in ('new', 'partial', 'changed', 'unknown', 'done', 'missing'):
+            totals[state] = sum(1 for e in entries if e['state'] == state)
+        plan = {'version': 1, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': self.dl.host, 'port': self.dl.port,
+                'user': self.dl.user, 'pattern': pattern, 'out': out, 'method': method,
+                'plan_seconds': round(time.time() - start, 3), 'totals': totals, 'probe': probe,
+                'estimates': self.estimate(len(todo), nbytes, probe), 'entries': entries}
+        self.print_plan(plan)
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(plan, f, indent=1)
+        return plan
+
+    def print_plan(self, plan):
+        t = plan['totals']
+        print('{} URLs: {} to download ({:.1f} MB, {} of unknown size), {} done, {} missing on {}'.format(
+            t['urls'], t['todo'], t['todo_bytes'] / 1e6, t['unknown_size'], t['done'], t['missing'], plan['host']))
+        for p in plan['probe']:
+            print('{:3d} sessions: {:.3f}s per file, {:10.0f} B/s per session -> {}s'.format(
+                p['sessions'], p['overhead'], p['rate'] or 0, plan['estimates'].get(str(p['sessions']), '-')))
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Rate limits: token buckets per host and in total, shared by downloaders, jobs and processes
+"""
+
+import os
+import json
+import time
+import fcntl
+import socket
+import threading
+from contextlib import contextmanager
+
+__all__ = ["TokenBucket", "RateLimiter", "Job"]
+
+KINDS = ('requests', 'bandwidth')
+
+class TokenBucket():
+    """
+    TokenBucket is a class: TokenBucket(rate), rate tokens per second, up to burst seconds of them saved
+
+    reserve(n) takes n tokens at once, the bucket may go into debt; the
+    caller waits the returned seconds, so the average rate holds even for
+    takes larger than the bucket. A new bucket starts empty, so jobs that
+    join do not add their burst on top of the others.
+    """
+    def __init__(self, rate, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.rate * self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+    def reserve(self, n=1):
+        # take n tokens, return seconds until they are covered
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def take(self, n=1):
+        time.sleep(self.reserve(n))
+
+class Job():
+    """
+    Job is a class: made by RateLimiter.job(), the share of one downloader run
+
+    Every job has its own buckets, their rates are the limits times
+    weight / (sum of the weights of the jobs active on the host); the
+    connection cap of a host is split the same way (at least one each).
+    """
+    def __init__(self, limiter, name, weight=1):
+        self.limiter = limiter
+        self.name = name
+        self.weight = weight
+        self.hosts = set() # hosts used so far
+        self.buckets = {} # (host or None for total, kind): TokenBucket
+        self.caps = {} # host: connections this job may hold
+        self.connections = {} # host: connections held
+
+    def _use(self, host):
+        if host not in self.hosts:
+            self.limiter._join(self, host)
+
+    def _wait(self, host, kind, n):
+        # take n tokens from the host and total buckets of kind
+        self._use(host)
+        self.limiter._maybe_sync()
+        delay = 0.0
+        for key in ((host, kind), (None, kind)):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                delay = max(delay, bucket.reserve(n))
+        if delay > 0:
+            time.sleep(delay)
+
+    def request(self, host):
+        # before each request (RETR, GET, range)
+        self._wait(host, 'requests', 1)
+
+    def consume(self, host, nbytes):
+        # after receiving nbytes
+        if nbytes > 0:
+            self._wait(host, 'bandwidth', nbytes)
+
+    def writer(self, host, write):
+        # wrap a data callback, every block is charged to the bandwidth buckets
+        def _write(data):
+            write(data)
+            self.consume(host, len(data))
+        return _write
+
+    def connection(self, host):
+        # context manager holding one connection of host
+        self._use(host)
+        return self.limiter.connection(host, self)
+
+    def close(self):
+        self.limiter._leave(self)
+
+class RateLimiter():
+    """
+    RateLimiter is a class: RateLimiter(limits), token buckets shared by downloaders
+
+    Pass one RateLimiter to all downloaders of a process (rate_limit=...),
+    each run is a Job with a weight. Request and byte rates of a host (and
+    in total) are split between the jobs active on it in proportion to
+    their weights, so several jobs can run at the archive's limits instead
+    of each guessing a conservative thread count. With shared, processes
+    using the same state file split the limits between all their jobs and
+    hold the connection caps together.
+
+    Parameters
+    ----------
+    limits : dict, default None
+        {host: {'connections': int, 'requests': per second, 'bandwidth': bytes per second}},
+        host '*' applies to hosts not listed; a missing key means no limit
+    total : dict, default None
+        {'requests': per second, 'bandwidth': bytes per second} over all hosts
+    shared : string, default None
+        State file on local storage shared by processes (file-locked JSON)
+    refresh : float, default 1
+        Seconds between exchanges with the state file / connection polls
+    burst : float, default 1
+        Seconds of saved up tokens a job may spend at once
+    ----------
+
+    Method
+    ----------
+    job(self, name=None, weight=1)
+        A Job for one downloader run, close() it at the end
+    connection(self, host, job=None)
+        Context manager holding one connection (transfer in flight) of host
+    ----------
+
+    Example
+    ----------
+        limits = {'gdc.cddis.eosdis.nasa.gov': {'connections': 8, 'requests': 20, 'bandwidth': 50e6}}
+        rl = RateLimiter(limits, shared='/tmp/gnss_rate.json')
+        downloader(host, ftp_num=8, rate_limit=rl, weight=2)
+    ----------
+    """
+    def __init__(self, limits=None, total=None, shared=None, refresh=1.0, burst=1.0):
+        self.limits = limits or {}
+        self.total = total or {}
+        self.shared = shared
+        self.refresh = refresh
+        self.burst = burst
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.connections = {} # host: connections held in this process
+        self.others = {'jobs': [], 'connections': {}} # other processes, as of the last exchange
+        self.last_sync = 0.0
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), id(self))
+        self.count = 0
+
+    def _limit(self, host, kind):
+        limits = self.limits.get(host, self.limits.get('*', {})) if host is not None else self.total
+        return limits.get(kind)
+
+    def job(self, name=None, weight=1):
+        with self.cond:
+            self.count += 1
+            job = Job(self, name or '{}#{}'.format(self.owner, self.count), weight)
+            self.jobs[job.name] = job
+            self._rebalance()
+        self._maybe_sync(force=True)
+        return job
+
+    def _join(self, job, host):
+        with self.cond:
+            job.hosts.add(host)
+            self._rebalance()
+        self._maybe_sync(force=True)
+
+    def _leave(self, job):
+        with self.cond:
+            self.jobs.pop(job.name, None)
+            self._rebalance()
+        self._maybe_sync(force=True)
+
+    def _active(self):
+        # (weight, hosts) of all jobs, here and in the other processes
+        return [(job.weight, job.hosts) for job in self.jobs.values()] + \
+               [(weight, set(hosts)) for weight, hosts in self.others['jobs']]
+
+    def _rebalance(self):
+        # set the bucket rates and connection caps of the local jobs to their weighted shares [holding cond]
+        active = self._active()
+        all_weight = sum(weight for weight, hosts in active) or 1
+        for job in self.jobs.values():
+            for host in list(job.hosts) + [None]:
+                if host is None:
+                    share = job.weight / all_weight
+                else:
+                    share = job.weight / (sum(weight for weight, hosts in active if host in hosts) or 1)
+                    cap = self._limit(host, 'connections')
+                    if cap:
+                        job.caps[host] = max(1, int(cap * share + 0.5)) # the host cap still holds
+                for kind in KINDS:
+                    limit = self._limit(host, kind)
+                    if not limit:
+                        continue
+                    bucket = job.buckets.get((host, kind))
+                    if bucket is None:
+                        job.buckets[(host, kind)] = TokenBucket(limit * share, self.burst)
+                    else:
+                        bucket.set_rate(limit * share)
+        self.cond.notify_all() # caps may have grown
+
+    def _maybe_sync(self, force=False, take=None, job=None):
+        # exchange state with the other processes; take a connection of host take (for job) if one is free
+        if self.shared is None:
+            return self._free(take, 0, job) if take is not None else None
+        now = time.time()
+        if not force and take is None and now - self.last_sync < self.refresh:
+            return None
+        with self.cond:
+            fd = os.open(self.shared, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r') as f:
+                    text = f.read()
+                try:
+                    state = json.loads(text) if text.strip() else {}
+                except ValueError:
+                    state = {} # torn by a crash, rebuilt by the live processes
+                # processes gone without leaving
+                stale = max(30, 10 * self.refresh)
+                state = {k: v for k, v in state.items() if k != self.owner and now - v.get('time', 0) < stale}
+                others = {'jobs': [], 'connections': {}}
+                for entry in state.values():
+                    others['jobs'].extend((weight, hosts) for weight, hosts in entry.get('jobs', []))
+                    for host, n in entry.get('connections', {}).items():
+                        others['connections'][host] = others['connections'].get(host, 0) + n
+                self.others = others
+                taken = None
+                if take is not None:
+                    taken = self._free(take, others['connections'].get(take, 0), job)
+                state[self.owner] = {'time': now, 'connections': self.connections,
+                                     'jobs': [(job.weight, sorted(job.hosts)) for job in self.jobs.values()]}
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, json.dumps(state).encode())
+            finally:
+                os.close(fd) # releases the lock
+            self.last_sync = now
+            self._rebalance()
+            return taken
+
+    def _free(self, host, elsewhere, job=None):
+        # take a connection of host if fewer than the caps are held [holding cond]
+        cap = self._limit(host, 'connections')
+        if cap and self.connections.get(host, 0) + elsewhere >= cap:
+            return False
+        if job is not None and job.connections.get(host, 0) >= job.caps.get(host, cap or 1):
+            return False
+        self.connections[host] = self.connections.get(host, 0) + 1
+        if job is not None:
+            job.connections[host] = job.connections.get(host, 0) + 1
+        return True
+
+    @contextmanager
+    def connection(self, host, job=None):
+        if not self._limit(host, 'connections'):
+            yield
+            return
+        with self.cond:
+            while not self._maybe_sync(take=host, job=job):
+                self.cond.wait(self.refresh)
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.connections[host] -= 1
+                if job is not None:
+                    job.connections[host] -= 1
+                self.cond.notify_all()
+            self._maybe_sync(force=True)
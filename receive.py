@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Receive path: streams read into reusable aligned buffers and written to part files a large block at a time
+"""
+
+import os
+import mmap
+import errno
+import fcntl
+import threading
+from segmented import segment_file, read_block
+
+__all__ = ["BLOCKSIZE", "Receiver", "mark_file", "recover_part"]
+
+BLOCKSIZE = 1 << 20 # bytes per read / write / callback
+ALIGN = 4096 # O_DIRECT offsets and lengths
+FLUSH = 64 << 20 # with dontneed, written pages are dropped from the page cache every FLUSH bytes
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+CHECKPOINT = 64 << 20 # a fresh stream syncs and records its high-water mark every CHECKPOINT bytes
+
+def mark_file(part):
+    # high-water mark of <part>.seg: bytes written and synced, the rest may be preallocated zeros
+    return segment_file(part) + '.mark'
+
+def recover_part(part):
+    """
+    Turn the <part>.seg of a stream that was killed (SIGKILL, OOM, power loss)
+    into part, cut at its high-water mark, return the bytes recovered
+
+    Nothing is recovered while part exists or the .seg is still being written
+    """
+    mark = mark_file(part)
+    if not os.path.exists(mark):
+        return 0
+    seg = segment_file(part)
+    try:
+        fd = os.open(seg, os.O_RDWR)
+    except FileNotFoundError:
+        os.remove(mark) # moved to part already
+        return 0
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0 # a live writer
+        with open(mark) as f:
+            try:
+                pos = int(f.read() or 0)
+            except ValueError:
+                pos = 0
+        if os.path.exists(part) or pos <= 0:
+            os.remove(seg)
+            pos = 0
+        else:
+            os.ftruncate(fd, pos) # drop the unwritten preallocated tail
+            os.replace(seg, part)
+        os.remove(mark)
+    finally:
+        os.close(fd)
+    return pos
+
+class Receiver():
+    """
+    Receiver is a class: Receiver(), the receive path of the downloaders
+
+    Sockets are read with recv_into() into a page-aligned buffer reused by
+    each thread, and written with one pwrite (and one callback for metrics,
+    rate limits and checksums) per blocksize bytes instead of per 8 KiB
+    block of ftplib; HTTP bodies come as blocks of that size already. New files of known size are
+    preallocated (posix_fallocate) in <part>.seg and moved to the part file
+    when the stream ends or fails. Every 64 MiB the .seg is synced and its
+    high-water mark written to <part>.seg.mark, so recover_part() resumes a
+    stream that was killed from the last mark instead of from zero.
+
+    Parameters
+    ----------
+    blocksize : int, default 1 MiB
+        Bytes per read / write, rounded up to a multiple of 4 KiB
+    preallocate : bool, default True
+        Reserve the whole file up front when the remote size is known
+    direct : bool, default False
+        Write with O_DIRECT (page cache bypassed), files whose file system
+        does not support it are written normally
+    dontneed : bool, default False
+        Flush and drop written pages from the page cache every 64 MiB
+        (posix_fadvise DONTNEED), so bulk archives do not evict it
+    ----------
+
+    Method
+    ----------
+    receive(self, stream, part, size=None, callback=None, restart=False)
+        Append a stream to part, return the bytes received
+    ----------
+    """
+    def __init__(self, blocksize=BLOCKSIZE, preallocate=True, direct=False, dontneed=False):
+        self.blocksize = -(-max(blocksize, ALIGN) // ALIGN) * ALIGN
+        self.preallocate = preallocate
+        self.direct = direct and bool(O_DIRECT)
+        self.dontneed = dontneed and hasattr(os, 'posix_fadvise')
+        self.local = threading.local()
+
+    def _buffer(self):
+        # aligned buffer of the calling thread (anonymous mmap, page aligned for O_DIRECT)
+        buf = getattr(self.local, 'buf', None)
+        if buf is None:
+            buf = self.local.buf = mmap.mmap(-1, self.blocksize)
+            self.local.view = memoryview(buf)
+        return self.local.view
+
+    def _open(self, path, flags, direct):
+        # fd of path, (fd, True) if O_DIRECT is in use
+        if direct:
+            try:
+                return os.open(path, flags | O_DIRECT, 0o644), True
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise # tmpfs and some network file systems refuse O_DIRECT
+        return os.open(path, flags, 0o644), False
+
+    def _drop(self, fd, start, end):
+        # write back and evict [start, end) from the page cache
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_DONTNEED)
+
+    def _checkpoint(self, fd, mark, part, pos):
+        # data first, then the mark: a mark never covers bytes that are not on disk
+        os.fdatasync(fd)
+        if mark is None:
+            mark = os.open(mark_file(part), os.O_WRONLY | os.O_CREAT, 0o644)
+        os.pwrite(mark, b'%20d' % pos, 0)
+        return mark
+
+    def _blocks(self, stream, copy):
+        # memoryviews of the stream's blocks, copy into the aligned buffer for O_DIRECT
+        view = self._buffer()
+        if callable(stream):
+            while True:
+                n = read_block(stream, view)
+                if n:
+                    yield view[:n]
+                if n < len(view):
+                    return # end of stream
+        for chunk in stream:
+            chunk = memoryview(chunk)
+            if not copy:
+                yield chunk
+                continue
+            for i in range(0, len(chunk), len(view)):
+                n = min(len(view), len(chunk) - i)
+                view[:n] = chunk[i:i + n]
+                yield view[:n]
+
+    def receive(self, stream, part, size=None, callback=None, restart=False):
+        """
+        Append a stream to part, return the bytes received
+
+        Parameters
+        ----------
+        stream : callable or iterable
+            readinto(memoryview) -> bytes read, 0 at the end (e.g. socket.recv_into),
+            or the blocks themselves (e.g. response.iter_content(blocksize))
+        part : string
+            Part file, its bytes are the start of the stream unless restart
+        size : int, default None
+            Full remote size, the part file is preallocated if it is new
+        callback : callable, default None
+            Called with a memoryview of every block written
+        restart : bool, default False
+            Discard the bytes in part (server ignored the resume request)
+        ----------
+        """
+        if restart and os.path.exists(part):
+            os.remove(part)
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        fresh = self.preallocate and offset == 0 and size
+        path = segment_file(part) if fresh else part
+        fd, direct = self._open(path, os.O_WRONLY | os.O_CREAT, self.direct and offset % ALIGN == 0)
+        mark = None
+        pos = offset
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) # one writer per file, released on close
+            if fresh:
+                # the caller asked for the stream from 0, an old .seg is not recovered any more
+                os.ftruncate(fd, 0)
+                if os.path.exists(mark_file(part)):
+                    os.remove(mark_file(part))
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    pass # not supported, grow as written
+            flushed = marked = pos
+            for data in self._blocks(stream, direct):
+                n = len(data)
+                if direct and n % ALIGN:
+                    # unaligned tail, written through the page cache
+                    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~O_DIRECT)
+                    direct = False
+                os.pwrite(fd, data, pos)
+                pos += n
+                if callback is not None:
+                    callback(data)
+                if self.dontneed and not direct and pos - flushed >= FLUSH:
+                    self._drop(fd, flushed, pos)
+                    flushed = pos
+                if fresh and pos - marked >= CHECKPOINT:
+                    mark = self._checkpoint(fd, mark, part, pos)
+                    marked = pos
+            if self.dontneed and not direct and pos > flushed:
+                self._drop(fd, flushed, pos)
+        finally:
+            try:
+                if fresh:
+                    os.ftruncate(fd, pos) # drop the preallocated tail of a short stream
+            finally:
+                os.close(fd)
+                if mark is not None:
+                    os.close(mark)
+            if fresh:
+                # keep what arrived as a resumable part file
+                if pos:
+                    os.replace(path, part)
+                elif os.path.exists(path):
+                    os.remove(path)
+                if mark is not None:
+                    os.remove(mark_file(part))
+        return pos - offset
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Retry scheduler: error classification, jittered backoff and a priority work queue
+"""
+
+import json
+import time
+import heapq
+import random
+import threading
+from ftplib import error_temp, error_perm
+from concurrency import is_throttle
+
+__all__ = ["RetryScheduler", "classify_error", "backoff", "PERMANENT", "TRANSIENT", "THROTTLE"]
+
+PERMANENT = 'permanent'
+TRANSIENT = 'transient'
+THROTTLE = 'throttle'
+
+def classify_error(e):
+    """
+    Class of a download error: PERMANENT (do not retry), TRANSIENT or THROTTLE
+    """
+    if is_throttle(e):
+        return THROTTLE
+    if isinstance(e, error_perm):
+        return PERMANENT # 5xx, e.g. 550 file not found
+    if isinstance(e, error_temp):
+        return TRANSIENT # 4xx
+    status = getattr(getattr(e, 'response', None), 'status_code', None) # requests.HTTPError
+    if status is not None:
+        return TRANSIENT if status >= 500 or status in (408, 425) else PERMANENT
+    if isinstance(e, (ValueError, TypeError, KeyError)):
+        return PERMANENT # bug or bad input, retrying does not help
+    return TRANSIENT # network errors, timeouts, incomplete transfers, locked files
+
+def backoff(kind, attempt, base_delay=1, throttle_delay=15, max_delay=300):
+    """
+    Jittered exponential delay in seconds before retry number attempt (1 first) of an error class
+    """
+    base = throttle_delay if kind == THROTTLE else base_delay
+    delay = min(base * 2 ** (attempt - 1), max_delay)
+    return delay / 2 + random.uniform(0, delay / 2) # jitter
+
+class RetryScheduler():
+    """
+    RetryScheduler is a class: RetryScheduler(), a Queue-like scheduler of download items
+
+    Items are served by priority (lower first, fresh work is 0). Failed items
+    are requeued by retry() with jittered exponential backoff and a lower
+    priority, so retries never starve fresh work; permanent errors and items
+    out of retry budget end up in the failure report.
+
+    Parameters
+    ----------
+    maxsize : int, default 0 (unlimited)
+        put() blocks while this many items are waiting (retries do not block)
+    retries : int, default 3
+        Retry budget per item
+    base_delay : float, default 1
+        Backoff of the first retry of a transient error, doubled at every retry
+    throttle_delay : float, default 15
+        Backoff of the first retry of a throttled item
+    max_delay : float, default 300
+        Upper bound of the backoff
+    ----------
+
+    Method
+    ----------
+    put(self, item, priority=0), get(self), task_done(self), join(self)
+        Same as queue.Queue
+    retry(self, item, error)
+        Requeue item after an error, return the delay or None if it gave up
+    report(self) / write_report(self, path)
+        Items that never succeeded: item, error, class and attempts
+    ----------
+
+    """
+    def __init__(self, maxsize=0, retries=3, base_delay=1, throttle_delay=15, max_delay=300):
+        self.maxsize = maxsize
+        self.retries = retries
+        self.base_delay = base_delay
+        self.throttle_delay = throttle_delay
+        self.max_delay = max_delay
+        self.ready = [] # heap of (priority, seq, item)
+        self.delayed = [] # heap of (not before, seq, priority, item)
+        self.seq = 0
+        self.unfinished = 0
+        self.attempts = {}
+        self.failures = {}
+        self.cond = threading.Condition()
+
+    def _push(self, item, priority, not_before=0):
+        self.seq += 1
+        if not_before > time.time():
+            heapq.heappush(self.delayed, (not_before, self.seq, priority, item))
+        else:
+            heapq.heappush(self.ready, (priority, self.seq, item))
+        self.unfinished += 1
+        self.cond.notify()
+
+    def put(self, item, priority=0):
+        with self.cond:
+            while self.maxsize and len(self.ready) + len(self.delayed) >= self.maxsize:
+                self.cond.wait()
+            self._push(item, priority)
+
+    def get(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                while self.delayed and self.delayed[0][0] <= now:
+                    not_before, seq, priority, item = heapq.heappop(self.delayed)
+                    heapq.heappush(self.ready, (priority, seq, item))
+                if self.ready:
+                    item = heapq.heappop(self.ready)[2]
+                    self.cond.notify_all() # wake blocked put()
+                    return item
+                self.cond.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def task_done(self):
+        with self.cond:
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.cond.notify_all()
+
+    def join(self):
+        with self.cond:
+            while self.unfinished > 0:
+                self.cond.wait()
+
+    def retry(self, item, error):
+        """
+        Requeue item after error (call before task_done() of the failed get())
+
+        Return the backoff in seconds, None if the item failed for good
+        """
+        kind = classify_error(error)
+        with self.cond:
+            attempt = self.attempts.get(item, 0) + 1
+            self.attempts[item] = attempt
+            if kind == PERMANENT or attempt > self.retries:
+                self.failures[item] = {'item': item, 'error': str(error) or type(error).__name__,
+                                       'class': kind, 'attempts': attempt}
+                return None
+            delay = backoff(kind, attempt, self.base_delay, self.throttle_delay, self.max_delay)
+            self._push(item, attempt, time.time() + delay)
+            return delay
+
+    def report(self):
+        with self.cond:
+            return list(self.failures.values())
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Segmented transfers: one large file fetched as byte ranges over several sessions
+"""
+
+import os
+from ftplib import error_temp
+from concurrent.futures import wait, FIRST_EXCEPTION
+
+__all__ = ["SEGMENT_SIZE", "segment_file", "split_ranges", "preallocate", "ftp_range", "http_range", "fetch_segments"]
+
+SEGMENT_SIZE = 64 << 20 # files above this size are split into ranges of at most this size
+
+def segment_file(part):
+    # segmented transfers are assembled in <part>.seg, a preallocated file must never be resumed as a part
+    return part + '.seg'
+
+def split_ranges(size, segment_size=SEGMENT_SIZE, count=1):
+    # at least count [(start, end)] byte ranges of at most segment_size covering size, end exclusive
+    count = max(count, -(-size // segment_size), 1)
+    step = max(-(-size // count), 1)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+def preallocate(fd, size):
+    # reserve size bytes on disk, sparse file if fallocate is not supported
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+def read_block(readinto, view):
+    # fill view from readinto, short only at the end of the stream
+    got = 0
+    while got < len(view):
+        n = readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+def ftp_range(ftp, url, fd, start, end, size=None, blocksize=1 << 20):
+    """
+    Fetch bytes [start, end) of url with REST and write them to fd at the same offsets
+
+    The data connection is closed as soon as end is reached; the 426/451
+    reply of the aborted RETR is consumed so the session stays usable.
+    Blocks are received into one buffer and written blocksize bytes at a time.
+    """
+    ftp.voidcmd('TYPE I')
+    pos = start
+    view = memoryview(bytearray(min(blocksize, end - start)))
+    with ftp.transfercmd('RETR {}'.format(url), rest=start or None) as conn:
+        while pos < end:
+            n = read_block(conn.recv_into, view[:min(len(view), end - pos)])
+            if not n:
+                break
+            os.pwrite(fd, view[:n], pos)
+            pos += n
+    try:
+        ftp.voidresp()
+    except error_temp as e:
+        if str(e)[:3] not in ('426', '450', '451') or end == size:
+            raise
+    if pos < end:
+        raise IOError('Incomplete range {}-{} of {}: {} bytes'.format(start, end, url, pos - start))
+    return pos - start
+
+def http_range(session, url, fd, start, end, chunk_size=1 << 20):
+    # fetch bytes [start, end) of url with Range and write them to fd at the same offsets
+    headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+    pos = start
+    with session.get(url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError('Server ignored Range for {}'.format(url))
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            os.pwrite(fd, chunk[:end - pos], pos)
+            pos += len(chunk)
+            if pos >= end:
+                break
+    if pos < end:
+        raise IOError('Incomplete range {}-{} of {}: {} bytes'.format(start, end, url, pos - start))
+    return end - start
+
+def fetch_segments(fetch_range, path, size, segment_size, executor, count=1):
+    """
+    Preallocate path and run fetch_range(fd, start, end) for every range on executor,
+    the file is split into at least count ranges [see split_ranges]
+
+    Return the number of bytes received, the first error is raised once all
+    ranges stopped. The assembled size is checked against size.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        preallocate(fd, size)
+        futures = [executor.submit(fetch_range, fd, start, end) for start, end in split_ranges(size, segment_size, count)]
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in pending:
+            future.cancel()
+        wait(futures) # ranges write to fd, do not close it under them
+        for future in futures:
+            if not future.cancelled() and future.exception() is not None:
+                raise future.exception()
+        received = sum(f.result() for f in futures)
+    finally:
+        os.close(fd)
+    if os.path.getsize(path) != size or received != size:
+        raise IOError('Incomplete segmented transfer {}: {} of {} bytes'.format(path, received, size))
+    return received
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Legacy conversions of gtime_conv against the integer-MJD core, every day of 1600-2200
+
+Run from the repository root: python -m pytest tests (or python -m unittest discover tests)
+"""
+
+import os
+import sys
+import datetime
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gtime_conv import (ymdhms2jd, doy2jd, jd2ymdhms, civil2mjd, doy2mjd, mjd2civil, _mjd2civil,
+                        civil2mjd_list, mjd2civil_list)
+
+MJD_ORDINAL = 678576 # date.toordinal() - MJD
+
+def date_mjd(year, month, day):
+    # reference MJD from the standard library (proleptic Gregorian)
+    return datetime.date(year, month, day).toordinal() - MJD_ORDINAL
+
+class TestYear1600(unittest.TestCase):
+    # 1600 is a leap year and the epoch of the legacy functions, the old code was one day off all year
+
+    CASES = [((1600, 1, 1), 1), ((1600, 2, 29), 60), ((1600, 3, 1), 61), ((1600, 12, 31), 366), ((1601, 1, 1), 1)]
+
+    def test_pinned(self):
+        for (year, month, day), doy in self.CASES:
+            mjd = date_mjd(year, month, day)
+            jd = mjd + 2400000.5
+            with self.subTest(date=(year, month, day)):
+                self.assertEqual(ymdhms2jd([year, month, day, 0, 0, 0]), jd)
+                self.assertEqual(doy2jd(year, doy), jd)
+                self.assertEqual(jd2ymdhms(jd), ([year, month, day, 0, 0, 0.0], doy))
+                self.assertEqual(civil2mjd(year, month, day), mjd)
+                self.assertEqual(mjd2civil(mjd), (year, month, day, doy))
+
+    def test_known_values(self):
+        self.assertEqual(civil2mjd(1600, 1, 1), -94553)
+        self.assertEqual(civil2mjd(1600, 12, 31), -94188)
+
+class TestEquivalence(unittest.TestCase):
+    # exhaustive: the legacy functions and the core agree with each other and with datetime.date
+
+    BEGIN, END = 1600, 2200
+
+    def test_every_day(self):
+        day = datetime.date(self.BEGIN, 1, 1)
+        last = datetime.date(self.END, 12, 31)
+        one = datetime.timedelta(days=1)
+        while day <= last:
+            mjd = day.toordinal() - MJD_ORDINAL
+            doy = day.timetuple().tm_yday
+            jd = mjd + 2400000.5
+            expected = (day.year, day.month, day.day, doy)
+            self.assertEqual(_mjd2civil(mjd), expected)
+            self.assertEqual(civil2mjd(day.year, day.month, day.day), mjd, day)
+            self.assertEqual(doy2mjd(day.year, doy), mjd, day)
+            self.assertEqual(jd2ymdhms(jd), ([day.year, day.month, day.day, 0, 0, 0.0], doy), day)
+            self.assertEqual(ymdhms2jd([day.year, day.month, day.day, 0, 0, 0]), jd, day)
+            self.assertEqual(doy2jd(day.year, doy), jd, day)
+            day += one
+
+    def test_lists(self):
+        first, last = civil2mjd(self.BEGIN, 1, 1), civil2mjd(self.END, 12, 31)
+        civil = [_mjd2civil(mjd) for mjd in range(first, last + 1)]
+        self.assertEqual(mjd2civil_list(range(first, last + 1), cache=False), civil)
+        self.assertEqual(mjd2civil_list(range(first, last + 1)), civil)
+        years, months, days, doys = zip(*civil)
+        self.assertEqual(civil2mjd_list(years, months, days), list(range(first, last + 1)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Compiled URL templates: lazy, ordered expansion of a pattern by a request dictionary
+"""
+
+from functools import lru_cache
+
+__all__ = ["URL_KEYS", "url_fields", "fields_replace", "UrlTemplate", "iter_urls"]
+
+URL_KEYS = ["YYYY", "DDD", "YY", "MONTH", "HH", "CH", "MM", "GPSTW", "GPSTD", "GPSLW", "GPSLD"] # replace order
+
+_FIELDS = {
+    "YYYY": lambda gt: str(gt.year),
+    "DDD": lambda gt: str(gt.doy).zfill(3),
+    "YY": lambda gt: str(gt.year)[-2:],
+    "MONTH": lambda gt: str(gt.month).zfill(2)[-2:],
+    "HH": lambda gt: str(gt.hour).zfill(2),
+    "CH": lambda gt: gt.H,
+    "MM": lambda gt: str(gt.min).zfill(2),
+    "GPSTW": lambda gt: str(gt.gps_week).zfill(4),
+    "GPSTD": lambda gt: str(gt.gps_dow),
+}
+
+def url_fields(gt, keys=URL_KEYS):
+    # strings of the pattern keys for one GTime
+    fields = {key: _FIELDS[key](gt) for key in keys if key in _FIELDS}
+    if 'GPSLW' in keys or 'GPSLD' in keys:
+        last = gt - 1
+        fields['GPSLW'] = str(last.gps_week).zfill(4)
+        fields['GPSLD'] = str(last.gps_dow)
+    return fields
+
+def fields_replace(to_replace, fields):
+    for key in URL_KEYS:
+        to_replace = to_replace.replace(key, fields[key])
+    return to_replace
+
+def _split(segments, key):
+    # split the literal segments on a time key, the key becomes a (key,) token
+    out = []
+    for seg in segments:
+        if isinstance(seg, str):
+            parts = seg.split(key)
+            for i, part in enumerate(parts):
+                if i:
+                    out.append((key,))
+                if part:
+                    out.append(part)
+        else:
+            out.append(seg)
+    return tuple(out)
+
+def _substitute(segments, key, value):
+    # replace key by value in the literal segments, merging neighbouring literals
+    out = []
+    for seg in segments:
+        if isinstance(seg, str):
+            seg = seg.replace(key, value)
+            if out and isinstance(out[-1], str):
+                out[-1] = out[-1] + seg
+                continue
+        out.append(seg)
+    return tuple(out)
+
+@lru_cache(maxsize=4096)
+def _format(segments):
+    # segments -> str.format template, e.g. ('/CODE/', ('YYYY',), '/') -> '/CODE/{YYYY}/'
+    return ''.join(seg.replace('{', '{{').replace('}', '}}') if isinstance(seg, str) else '{' + seg[0] + '}'
+                   for seg in segments)
+
+class UrlTemplate():
+    """
+    UrlTemplate is a class: UrlTemplate(pattern, dic), a pattern compiled once into
+    literal and token segments
+
+    Keys of dic are applied in order, the first key varies slowest, exactly
+    like the former chained str.replace() expansion. Time fields are computed
+    once per GTime (only the keys used by the pattern) and URLs are yielded
+    lazily, so the product is never materialized.
+
+    Deduplication is exact per key: values giving the same partial pattern are
+    expanded once, and GTIME values are reduced to distinct combinations of
+    the time keys the pattern uses (e.g. 'YYYY/MONTH' over a daily list yields
+    each month once). Memory is bounded by the size of the value lists (and
+    the partial patterns of the keys after GTIME), not by the number of URLs.
+
+    Parameters
+    ----------
+    pattern : string
+        URL pattern [see downloader.download()]
+    dic : dictionary
+        Replace the keys in pattern string with values, 'GTIME' is a GTime list or GTimeArray
+    ----------
+    """
+    def __init__(self, pattern, dic={}):
+        self.pattern = pattern
+        self.items = list(dic.items())
+        self.time_fields = {}
+        self.leaves = {}
+        # first depth after which no GTIME key is left
+        self.static_depth = max([i + 1 for i, (key, values) in enumerate(self.items) if key == 'GTIME'] or [0])
+
+    def _time_fields(self, values, keys):
+        # distinct field dicts for the time keys in use, computed once per keys
+        keys = tuple(keys)
+        if keys not in self.time_fields:
+            if hasattr(values, 'url_fields'):
+                fields = ({k: f[k] for k in keys} for f in values.url_fields())
+            else:
+                fields = (url_fields(gt, keys) for gt in values)
+            distinct = {}
+            for f in fields:
+                distinct.setdefault(tuple(f[k] for k in keys), f)
+            self.time_fields[keys] = list(distinct.values())
+        return self.time_fields[keys]
+
+    def _leaves(self, segments, depth):
+        # str.format templates of the remaining (non GTIME) keys, built once
+        if depth == len(self.items):
+            return [_format(segments)]
+        if (segments, depth) not in self.leaves:
+            key, values = self.items[depth]
+            leaves = []
+            seen = set()
+            for v in values:
+                sub = _substitute(segments, key, str(v).zfill(len(key)))
+                if sub not in seen:
+                    seen.add(sub)
+                    leaves.extend(self._leaves(sub, depth + 1))
+            self.leaves[(segments, depth)] = leaves
+        return self.leaves[(segments, depth)]
+
+    def _expand(self, segments, depth, fields):
+        if depth >= self.static_depth:
+            for leaf in self._leaves(segments, depth):
+                yield leaf.format_map(fields)
+            return
+        key, values = self.items[depth]
+        if key == 'GTIME':
+            for k in URL_KEYS:
+                segments = _split(segments, k)
+            keys = [k for k in URL_KEYS if (k,) in segments]
+            if depth + 1 >= self.static_depth:
+                # innermost time level, no more recursion per GTime
+                leaves = self._leaves(segments, depth + 1)
+                for f in self._time_fields(values, keys):
+                    for leaf in leaves:
+                        yield leaf.format_map(f)
+                return
+            for f in self._time_fields(values, keys):
+                yield from self._expand(segments, depth + 1, f)
+        else:
+            seen = set()
+            for v in values:
+                sub = _substitute(segments, key, str(v).zfill(len(key)))
+                if sub in seen:
+                    continue
+                seen.add(sub)
+                yield from self._expand(sub, depth + 1, fields)
+
+    def __iter__(self):
+        return self._expand((self.pattern,), 0, {})
+
+def iter_urls(pattern, dic={}):
+    # lazy URL generator of pattern and dic
+    return iter(UrlTemplate(pattern, dic))
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Watch mode: follow hourly / high-rate products as they are published, newest first
+"""
+
+import os
+import time
+import fnmatch
+import logging
+import threading
+import posixpath
+from gtime import GTime
+from url_template import iter_urls
+from ftp_listing import ftp_listdir, has_wildcard
+from ftp_pool import get_pool
+from scheduler import RetryScheduler
+
+__all__ = ["Watcher", "WatchQueue", "cadence"]
+
+UNIT_SECONDS = {'day': 86400, 'hour': 3600, 'minute': 60}
+
+def cadence(pattern):
+    # (step, unit) of the files of a pattern: 15 minutes with 'MM', hourly with 'HH' / 'CH', else daily
+    if 'MM' in pattern:
+        return 15, 'minute'
+    if 'HH' in pattern or 'CH' in pattern:
+        return 1, 'hour'
+    return 1, 'day'
+
+def _gtime(t):
+    # GTime of unix time t (UTC)
+    tm = time.gmtime(t)
+    return GTime(year=tm.tm_year, month=tm.tm_mon, day=tm.tm_mday, hour=tm.tm_hour, min=tm.tm_min, sec=tm.tm_sec)
+
+class WatchQueue(RetryScheduler):
+    # RetryScheduler that stays open until close(), so the download threads and their sessions live on
+    def __init__(self, **kwargs):
+        RetryScheduler.__init__(self, **kwargs)
+        self.closed = False
+        self.given_up = {} # item: time it failed for good, kept in the report until pruned
+        self.dropped = [] # items given up since the last take_given_up()
+
+    def retry(self, item, error):
+        delay = RetryScheduler.retry(self, item, error)
+        if delay is None:
+            with self.cond:
+                self.given_up[item] = time.time()
+                self.dropped.append(item)
+        return delay
+
+    def take_given_up(self):
+        # items given up since the last call, their retry budget starts over if they are put again
+        with self.cond:
+            items, self.dropped = self.dropped, []
+            for item in items:
+                self.attempts.pop(item, None)
+            return items
+
+    def prune(self, items=(), before=None):
+        # forget the retry state and failures of items, and the failures given up before that time
+        with self.cond:
+            if before is not None:
+                items = list(items) + [item for item, t in self.given_up.items() if t < before]
+            for item in items:
+                self.attempts.pop(item, None)
+                self.failures.pop(item, None)
+                self.given_up.pop(item, None)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def join(self):
+        with self.cond:
+            while not self.closed or self.unfinished > 0:
+                self.cond.wait()
+
+class Watcher():
+    """
+    Watcher is a class: Watcher(dl, pattern, dic, out), a long-running download of new files
+
+    Instead of re-running download() from cron over a sliding GT_list, the
+    watcher keeps one downloader run (threads and FTP sessions / HTTP
+    keep-alive connections) open. From the pattern it computes the files
+    expected next: those of the newest `lookback` epochs that have ended
+    (a file of 13:15 with 15 minute cadence is expected from 13:30 on) and
+    are not on disk yet. Only the directories holding such files are polled,
+    every `interval` seconds: FTP by listing them (MLSD / NLST) and diffing
+    against the previous listing, HTTP by HEAD of the expected URLs. Found
+    files are queued newest first; when nothing is outstanding the watcher
+    sleeps until the next epoch ends.
+
+    FTP file names may contain wildcards (e.g. 'SSSS*.YYd.gz'); files of a
+    watched directory that change size / mtime after their download are
+    fetched again. HTTP needs exact names.
+
+    Parameters
+    ----------
+    dl : downloader or HTTP_Downloader
+        Downloader of the files, its threads and sessions are used
+    pattern : string
+        URL pattern [see downloader.download()], a full URL for HTTP_Downloader
+    dic : dictionary, default {}
+        Request dictionary without 'GTIME', the times come from the clock
+    out : string, default '.'
+        Output directory
+    interval : float, default 30
+        Seconds between polls while files are outstanding
+    lookback : int, default 4
+        Number of ended epochs watched, files missing beyond that are given up
+    step, unit : default from the pattern [see cadence()]
+        Epoch length, unit 'day', 'hour' or 'minute'
+    ----------
+
+    Method
+    ----------
+    run(self, duration=None)
+        Download new files until stop() (or Ctrl-C, or duration seconds)
+    poll(self, now=None)
+        One round: list / probe the outstanding directories, queue new files
+    stop(self)
+        End run() after the files in flight
+    ----------
+
+    Example
+    ----------
+        dl = downloader('ftp.geodetic.gov.hk', ftp_num=4)
+        Watcher(dl, '/rinex3/YYYY/DDD/SSSS/1s/HH/SSSS00HKG_R_YYYYDDDHHMM_15M_01S_MO.crx.gz',
+                {'SSSS': ['HKCL', 'HKKS']}, 'hk', interval=20).run()
+    ----------
+    """
+    def __init__(self, dl, pattern, dic={}, out='.', interval=30, lookback=4, step=None, unit=None):
+        self.dl = dl
+        self.pattern = pattern
+        self.dic = {key: values for key, values in dic.items() if key != 'GTIME'}
+        self.out = os.path.realpath(out)
+        self.interval = interval
+        self.lookback = lookback
+        default_step, default_unit = cadence(pattern)
+        self.step = step or default_step
+        self.unit = unit or default_unit
+        self.period = self.step * UNIT_SECONDS[self.unit]
+        self.http = not hasattr(dl, 'ftp_num')
+        self.queue = None
+        self.pool = None
+        self.queued = {} # url: ([size, mtime] when queued, epoch)
+        self.listings = {} # directory: entries of the previous poll
+        self.stopped = threading.Event()
+
+    def epochs(self, now=None):
+        # [(unix time, GTime)] of the newest lookback ended epochs, newest first
+        now = time.time() if now is None else now
+        last = (int(now) // self.period - 1) * self.period
+        return [(t, _gtime(t)) for t in range(last, last - self.lookback * self.period, -self.period)]
+
+    def expected(self, now=None):
+        # [(url, unix time of its epoch)] of the watched epochs, newest first
+        urls = {}
+        for t, gt in self.epochs(now):
+            for url in iter_urls(self.pattern, dict({'GTIME': [gt]}, **self.dic)):
+                urls.setdefault(url, t) # e.g. daily directories of hourly files
+        return list(urls.items())
+
+    def _local(self, url):
+        return os.path.join(self.out, url.split('/')[-1])
+
+    def outstanding(self, now=None):
+        # expected files not queued yet and not on disk (wildcards stay outstanding)
+        return [(url, t) for url, t in self.expected(now)
+                if has_wildcard(url.split('/')[-1]) or (url not in self.queued and not os.path.exists(self._local(url)))]
+
+    def _put(self, url, t, info=None, changed=False):
+        if changed and not self.http:
+            self.dl.changed.add(url) # reissued on the server, not skipped as existing
+        self.queue.prune([url]) # found again after it was given up
+        self.queued[url] = (info, t)
+        if self.dl.metrics is not None:
+            self.dl.metrics.queued(url)
+        self.queue.put(url, -t) # newest epoch first, retries (priority >= 1) come after
+        if self.dl.log:
+            logging.info('Watch: {} {}'.format('changed' if changed else 'new', url))
+
+    def _listdir(self, directory):
+        with self.dl._connection(), self.pool.session() as ftp:
+            self.dl._request()
+            return ftp_listdir(ftp, directory)
+
+    def _exists(self, url):
+        # HEAD over the keep-alive session of the polling thread
+        host = url.split('/')[2]
+        self.dl._request(host)
+        with self.dl._connection(host):
+            response = self.dl._session().head(url, allow_redirects=True)
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response.status_code == 200
+
+    def _poll_ftp(self, todo):
+        found = 0
+        by_dir = {}
+        for url, t in todo:
+            by_dir.setdefault(posixpath.dirname(url), []).append((url, t))
+        for directory, items in by_dir.items():
+            entries = self._listdir(directory)
+            before = self.listings.get(directory, {})
+            self.listings[directory] = entries
+            for url, t in items:
+                name = url.split('/')[-1]
+                names = sorted(fnmatch.filter(entries, name)) if has_wildcard(name) else [name] if name in entries else []
+                for n in names:
+                    full = posixpath.join(directory, n)
+                    if full not in self.queued and not os.path.exists(self._local(full)):
+                        self._put(full, t, entries[n])
+                        found += 1
+            diff = {name: info for name, info in entries.items() if before.get(name) != info}
+            # downloaded files changed on the server
+            for name, info in diff.items():
+                full = posixpath.join(directory, name)
+                if full in self.queued and name in before and self.queued[full][0] != info:
+                    self._put(full, self.queued[full][1], info, changed=True)
+                    found += 1
+        return found
+
+    def _poll_http(self, todo):
+        found = 0
+        for url, t in todo:
+            if has_wildcard(url.split('/')[-1]):
+                continue # no listings over HTTP
+            if self._exists(url):
+                self._put(url, t)
+                found += 1
+        return found
+
+    def _prune(self, now=None):
+        # keep the state of the watched epochs only, given up files are looked for again
+        for url in self.queue.take_given_up():
+            self.queued.pop(url, None)
+        oldest = self.epochs(now)[-1][0]
+        old = [url for url, (info, t) in self.queued.items() if t < oldest]
+        for url in old:
+            del self.queued[url]
+        now = time.time() if now is None else now
+        self.queue.prune(old, now - self.lookback * self.period)
+        directories = {posixpath.dirname(url) for url, t in self.expected(now)}
+        self.listings = {d: entries for d, entries in self.listings.items() if d in directories}
+
+    def poll(self, now=None):
+        """
+        One round: probe the files expected next, queue the ones published
+
+        Files of epochs out of the lookback window are forgotten, files
+        given up by the downloader are looked for again while watched.
+        Return (files queued, files still outstanding)
+        """
+        self._prune(now)
+        todo = self.outstanding(now)
+        if not todo:
+            return 0, 0
+        try:
+            found = self._poll_http(todo) if self.http else self._poll_ftp(todo)
+        except Exception as e:
+            # the next round tries again
+            print('Error when polling {}'.format(self.pattern))
+            if self.dl.log:
+                logging.warning('Error when polling {}: {}'.format(self.pattern, e))
+            return 0, len(todo)
+        return found, len(todo) - found
+
+    def _sleep(self, outstanding, end=None):
+        # interval while files are outstanding, else until the next epoch ends
+        now = time.time()
+        delay = self.interval if outstanding else self.period - now % self.period + 1
+        if end is not None:
+            delay = min(delay, end - now)
+        self.stopped.wait(max(delay, 0))
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self, duration=None):
+        """
+        Download new files until stop() (or Ctrl-C, or duration seconds)
+        """
+        os.makedirs(self.out, exist_ok=True)
+        self.stopped.clear()
+        self.queue = WatchQueue(retries=self.dl.retries)
+        if not self.http:
+            # one more session for the listings, so polls do not wait for transfers
+            self.pool = get_pool(self.dl.host, self.dl.port, self.dl.user, self.dl._connect, self.dl.ftp_num + 1)
+        runner = threading.Thread(target=self.dl._run, args=(self.queue, (), self.out, False, None), daemon=True)
+        self.dl.ready.clear()
+        runner.start()
+        # polls use the pool, metrics and rate limiter job set up by _run()
+        while not self.dl.ready.wait(0.1) and runner.is_alive():
+            pass
+        end = time.time() + duration if duration is not None else None
+        try:
+            while not self.stopped.is_set() and (end is None or time.time() < end):
+                found, outstanding = self.poll()
+                if found:
+                    print('{} new files'.format(found))
+                self._sleep(outstanding, end)
+        except KeyboardInterrupt:
+            pass
+        self.queue.close()
+        runner.join()
+        return self.dl.failures
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Shared work queue: URLs leased to worker processes / nodes from one SQLite file
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from collections import deque
+from scheduler import classify_error, backoff, PERMANENT
+
+__all__ = ["WorkQueue", "LeaseQueue"]
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+class WorkQueue():
+    """
+    WorkQueue is a class: WorkQueue(path), URLs of a job leased to any number of workers
+
+    Workers claim batches of URLs under a lease that they renew by
+    heartbeat. Items whose lease expired (crashed or stalled worker) are
+    claimed again by others. An item is completed only by the holder of
+    its current lease, so every completion is recorded exactly once.
+
+    Parameters
+    ----------
+    path : string
+        SQLite database file, on shared storage for several nodes
+    job : string, default 'default'
+        Name of the job, several jobs can share one file
+    lease : float, default 300
+        Seconds an item stays leased without heartbeat
+    wal : bool, default False
+        WAL journal, faster but only for workers on one machine (WAL does
+        not work on network file systems, the default rollback journal
+        relies on file locks only)
+    ----------
+
+    Method
+    ----------
+    add(self, urls, host='')
+        Add URLs (duplicates of the job are ignored), return the number added
+    claim(self, owner, batch)
+        Lease up to batch due items to owner: [(id, url, attempts)]
+    heartbeat(self, owner)
+        Renew the leases of owner
+    finish(self, results, owner)
+        Record [(id, status, error, not before)] of owner, return those accepted
+    release(self, owner, ids)
+        Give leased items back
+    counts(self) / failures(self)
+        Items per status / failed items
+    ----------
+
+    """
+    def __init__(self, path, job='default', lease=300, wal=False, timeout=60):
+        self.path = path
+        self.job = job
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        if wal:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS items (
+                            id INTEGER PRIMARY KEY,
+                            job TEXT NOT NULL,
+                            host TEXT,
+                            url TEXT NOT NULL,
+                            status TEXT NOT NULL,
+                            owner TEXT,
+                            lease_until REAL,
+                            not_before REAL DEFAULT 0,
+                            attempts INTEGER DEFAULT 0,
+                            error TEXT,
+                            updated REAL,
+                            UNIQUE (job, url))""")
+        self.db.execute('CREATE INDEX IF NOT EXISTS items_status ON items (job, status)')
+
+    def _transaction(self, func):
+        # run func(db) in one write transaction (BEGIN IMMEDIATE serializes writers across processes)
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(self.db)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def add(self, urls, host='', chunk=10000):
+        if isinstance(urls, str):
+            urls = [urls]
+        added = 0
+        rows = []
+
+        def _insert(db):
+            before = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO items (job, host, url, status, updated) VALUES (?, ?, ?, ?, ?)', rows)
+            return db.total_changes - before
+
+        now = time.time()
+        for url in urls:
+            rows.append((self.job, host, url, PENDING, now))
+            if len(rows) >= chunk:
+                added += self._transaction(_insert)
+                rows = []
+        if rows:
+            added += self._transaction(_insert)
+        return added
+
+    def claim(self, owner, batch=20):
+        def _claim(db):
+            now = time.time()
+            rows = db.execute("""SELECT id, url, attempts FROM items WHERE job=? AND
+                                 ((status=? AND not_before<=?) OR (status=? AND lease_until<?))
+                                 ORDER BY attempts, id LIMIT ?""",
+                              (self.job, PENDING, now, LEASED, now, batch)).fetchall()
+            db.executemany('UPDATE items SET status=?, owner=?, lease_until=?, attempts=attempts+1, updated=? WHERE id=?',
+                           [(LEASED, owner, now + self.lease, now, row[0]) for row in rows])
+            return [(row[0], row[1], row[2] + 1) for row in rows]
+        return self._transaction(_claim)
+
+    def heartbeat(self, owner):
+        def _renew(db):
+            now = time.time()
+            return db.execute('UPDATE items SET lease_until=? WHERE job=? AND owner=? AND status=?',
+                              (now + self.lease, self.job, owner, LEASED)).rowcount
+        return self._transaction(_renew)
+
+    def finish(self, results, owner):
+        """
+        Record results [(id, status, error, not_before)] of owner
+
+        Only items still leased to owner change, return the ids accepted
+        (a lost lease means another worker owns the item now).
+        """
+        def _finish(db):
+            now = time.time()
+            accepted = []
+            for id, status, error, not_before in results:
+                cursor = db.execute("""UPDATE items SET status=?, error=?, not_before=?, owner=NULL, lease_until=NULL,
+                                       updated=? WHERE id=? AND owner=? AND status=?""",
+                                    (status, error, not_before or 0, now, id, owner, LEASED))
+                if cursor.rowcount == 1:
+                    accepted.append(id)
+            return accepted
+        return self._transaction(_finish) if results else []
+
+    def release(self, owner, ids=None):
+        # leased items of owner (or only ids) back to pending, the attempt does not count
+        def _release(db):
+            if ids is None:
+                return db.execute('UPDATE items SET status=?, owner=NULL, attempts=attempts-1 WHERE job=? AND owner=? AND status=?',
+                                  (PENDING, self.job, owner, LEASED)).rowcount
+            return sum(db.execute('UPDATE items SET status=?, owner=NULL, attempts=attempts-1 WHERE id=? AND owner=? AND status=?',
+                                  (PENDING, id, owner, LEASED)).rowcount for id in ids)
+        return self._transaction(_release)
+
+    def counts(self):
+        with self.lock:
+            rows = self.db.execute('SELECT status, COUNT(*) FROM items WHERE job=? GROUP BY status', (self.job,)).fetchall()
+        return dict(rows)
+
+    def outstanding(self):
+        # items not finished yet (pending, delayed or leased by anyone)
+        counts = self.counts()
+        return counts.get(PENDING, 0) + counts.get(LEASED, 0)
+
+    def failures(self):
+        with self.lock:
+            rows = self.db.execute('SELECT url, error, attempts FROM items WHERE job=? AND status=?', (self.job, FAILED)).fetchall()
+        # error is recorded as '<class>: <message>'
+        return [{'item': url, 'error': error, 'class': error.split(':', 1)[0] if error else None, 'attempts': attempts}
+                for url, error, attempts in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class LeaseQueue():
+    """
+    LeaseQueue is a class: LeaseQueue(work_queue), a Queue-like view of a WorkQueue for one worker process
+
+    Used by downloader.download_from_queue() in place of RetryScheduler:
+    a feeder thread claims batches, renews the leases and writes results
+    back in batches; join() returns when the whole job is finished (items
+    leased by crashed workers are reclaimed after their lease expires).
+
+    Parameters
+    ----------
+    work_queue : WorkQueue
+        Shared queue
+    owner : string, default None (host:pid:random)
+        Lease owner name of this process
+    batch : int, default 20
+        URLs claimed at once
+    retries : int, default 3
+        Retry budget per URL for transient errors (counted across workers)
+    poll : float, default 0.5
+        Seconds between claims when nothing is due
+    ----------
+    """
+    def __init__(self, work_queue, owner=None, batch=20, retries=3, poll=0.5):
+        self.wq = work_queue
+        self.owner = owner or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.batch = batch
+        self.retries = retries
+        self.poll = poll
+        self.buffer = deque() # claimed, not started: (id, url, attempts)
+        self.results = [] # (id, status, error, not_before) waiting to be written
+        self.unfinished = 0
+        self.finished = False
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+    def _feed(self):
+        # claim, heartbeat and write results back [feeder thread]
+        last_beat = time.time()
+        while True:
+            with self.cond:
+                results, self.results = self.results, []
+                # refill below half a batch
+                want = self.batch - len(self.buffer) if len(self.buffer) <= self.batch // 2 else 0
+                idle = not self.buffer and self.unfinished == 0
+            try:
+                self.wq.finish(results, self.owner)
+                items = self.wq.claim(self.owner, want) if want else []
+                if time.time() - last_beat > self.wq.lease / 3:
+                    self.wq.heartbeat(self.owner)
+                    last_beat = time.time()
+                done = idle and not items and self.wq.outstanding() == 0
+            except sqlite3.Error as e:
+                # shared storage hiccup, keep the results and try again
+                logging.warning('Work queue {}: {}'.format(self.wq.path, e))
+                with self.cond:
+                    self.results = results + self.results
+                time.sleep(self.poll)
+                continue
+            with self.cond:
+                self.buffer.extend(items)
+                if items:
+                    self.cond.notify_all()
+                    continue
+                if done and not self.results and self.unfinished == 0:
+                    self.finished = True # job done, by us or others
+                    self.cond.notify_all()
+                    return
+                self.cond.wait(self.poll)
+
+    def get(self):
+        with self.cond:
+            while not self.buffer:
+                self.cond.wait()
+            item = self.buffer.popleft()
+            self.unfinished += 1
+        self.local.item = item
+        self.local.status = None
+        return item[1]
+
+    def retry(self, url, error):
+        """
+        Give the item of the calling thread back with a backoff, None if it failed for good
+        """
+        id, url, attempts = self.local.item
+        kind = classify_error(error)
+        message = '{}: {}'.format(kind, str(error) or type(error).__name__)
+        if kind == PERMANENT or attempts > self.retries:
+            self.local.status = (id, FAILED, message, 0)
+            return None
+        delay = backoff(kind, attempts)
+        self.local.status = (id, PENDING, message, time.time() + delay)
+        return delay
+
+    def task_done(self):
+        id = self.local.item[0]
+        with self.cond:
+            self.results.append(self.local.status or (id, DONE, None, 0))
+            self.unfinished -= 1
+            self.cond.notify_all()
+
+    def join(self):
+        with self.cond:
+            while not self.finished:
+                self.cond.wait()
+
+    def put(self, item, priority=0):
+        self.wq.add([item])
+
+    def report(self):
+        return self.wq.failures()
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)